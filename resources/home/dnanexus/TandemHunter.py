@@ -1,469 +1,5245 @@
-# Tandem Hunter: Identification of duplicated/amplified
-# regions based on the comparison
-# of normalise coverage between two intervals in given coverage file
-# (PER_TARGET_COVERAGE from Picard CollectHsMetrics).
-
-# Author: Helena L. Spiewak
-# Contributors: Nadia Mohammed
-# Date created: 2021-04-06
-# Date modified: 2021-04-06
-# Date modified for v2.0.0: 2022-08-18
-
-# It is used to identify KMT2A/MLL partial tandem duplications and is based on
-# the method described by McKerrell et al., 2016, where they compare
-# the coverage of exon 3 and exon 27 of MLL/KMT2A.
-
-import pandas as pd
-import numpy as np
-import argparse
-import sys
-import os
-import json
-import multiprocessing as mp
-import fnmatch
-import functools
-from datetime import datetime
-import glob
-
-# define Picard CollectHsMetrics PER_TARGET_COVERAGE columns
-COV_COLUMN_DTYPES = {
-    "chrom": "category",
-    "start": "int",
-    "end": "int",
-    "length": "int",
-    "name": "category",
-    "%gc": "float64",
-    "mean_coverage": "float64",
-    "normalized_coverage": "float64",
-    "min_normalized_coverage": "float64",
-    "max_normalized_coverage": "float64",
-    "min_coverage": "int",
-    "max_coverage": "int",
-    "pct_0x": "float64",
-    "read_count": "int",
-}
-
-
-def tdh_argument_parser(args):
-    """ Parse arguments for Tandem Hunter. """
-    parser = argparse.ArgumentParser(
-        description=(
-            "Tandem Hunter: Identification of duplicated/amplified regions"
-            "based on comparing normalised coverage between two intervals"
-        )
-    )
-    required = parser.add_mutually_exclusive_group(required=True)
-    required.add_argument(
-        "-F", "--file", default=False, help="Path to coverage file OR"
-    )
-    required.add_argument(
-        "-B",
-        "--batch",
-        default=False,
-        help="Path to coverage files folder. DON'T use -F and -B together.",
-    )
-    parser.add_argument(
-        "--intervals",
-        type=str,
-        required=True,
-        help=(
-            "Path to json file containing intervals to compare coverage at."
-            " These regions have to be in the coverage file as is as this "
-            " programme uses pattern matching"
-        ),
-    )
-    parser.add_argument(
-        "--dup-threshold",
-        type=float,
-        default=1.122995,
-        help="Default threshold for dup/amp regions if not in interval file",
-    )
-    parser.add_argument(
-        "-O", "--out_dir",
-        default=".", help="Output write directory"
-    )
-    parser.add_argument(
-        "--out-fname-suffix",
-        default=".cvg_comparison.csv",
-        help="Filename suffix to use when naming results file",
-    )
-    parser.add_argument(
-        "--processes", default=0,
-        help="Number of processes to run in parallel",
-    )
-    parser.add_argument(
-        "--cov-file-pattern",
-        default="coverage.tsv",
-        help="Filename suffix used to identify coverage files in batch mode",
-    )
-    parser.add_argument(
-        "--metric",
-        default="normalized_coverage",
-        help="Metric to used in comparison",
-    )
-    parser.add_argument("--version",
-        action="version",
-        version="%(prog)s 2.0.0")
-
-    return parser.parse_args(args)
-
-
-class TDHunter(object):
-    """ Object containg methods that compare normalised coverage
-        at two given intervals.
-        :param: file: Path to coverage file
-        :param: batch: Path to folder with a batch of coverage files
-        :param: intervals: Path to file with intervals to compare coverage at
-        :param: dup_threshold: Threshold used to identify dup/amp regions
-        :param: out_dir: Output write directory
-        :param: out_fname_suffix: Filename suffix for naming results file
-        :param: processes: Maximum number of processes to run (default is cpu
-                            count)
-        :param: cov_file_pattern: Filename suffix to identify coverage files
-                                    when in batch mode
-        :param: column_dtypes: Dictionary with column name and datatype for
-                            the given coverage file type
-        :param: metric: Metric to used in comparison
-        :returns: Writes a coverage comparison between two intervals to a text
-                    file on per-sample basis
-    """
-    def __init__(
-        self,
-        file=False,
-        batch=False,
-        intervals=False,
-        dup_threshold=1.122995,
-        out_dir=".",
-        out_fname_suffix=".cvg_comparison.csv",
-        processes=0,
-        cov_file_pattern=".qc.coverage.txt",
-        column_dtypes=COV_COLUMN_DTYPES,
-        metric="normalized_coverage",
-    ):
-
-        # store arguments
-        try:
-            self.file = os.path.abspath(file)
-        except Exception:
-            self.file = file
-        try:
-            self.batch = os.path.abspath(batch)
-        except Exception:
-            self.batch = batch
-        try:
-            self.intervals = os.path.abspath(intervals)
-        except Exception:
-            self.intervals = intervals
-        self.dup_threshold = dup_threshold
-        self.out_dir = os.path.abspath(out_dir)
-        self.out_fname_suffix = out_fname_suffix
-        self.processes = processes
-        # use max cpu count available as number of processes if value not given
-        if self.processes == 0:
-            self.processes = mp.cpu_count()
-        self.cov_file_pattern = cov_file_pattern
-        self.column_dtypes = column_dtypes
-        self.metric = metric
-
-        # process a single file
-        if self.file:
-            # check and process the file
-            self._process_file(
-                file=self.file, intervals=self.intervals, out_dir=self.out_dir
-            )
-
-        # process a batch of files
-        elif self.batch:
-            # find the coverage files
-            files = self._find_coverage_files(
-                batch_dir=batch, cov_file_pattern=self.cov_file_pattern
-            )
-            # process the files in paralllel
-            pool = mp.Pool(self.processes)
-            # instance of class is passed to map (uses __call__
-            # to call _process_file) for compatibility with python2.7
-            results = pool.map(self, [file for file in files])
-            pool.close()
-
-        # print error if neither file or batch given
-        else:
-            sys.stderr.write(
-                "[{0}] Error: File or batch folder not specified!".format(
-                    datetime.now()
-                )
-            )
-            sys.exit()
-
-    @classmethod
-    def _find_coverage_files(cls, batch_dir, cov_file_pattern):
-        """ Method to find coverage files in a directory.
-        :param: batch_dir: Path to batch directory
-        :param: cov_file_pattern: Filename suffix to identify coverage files
-        :returns: A list of coverage files found in given directory
-        """
-        print(
-            "[{0}] Finding coverage files in {1}".format(
-                datetime.now(), batch_dir
-            )
-        )
-
-        try:
-            coverage_files = glob.glob(
-                os.path.join(batch_dir, "**", "*{0}".format(cov_file_pattern)),
-                recursive=True,
-            )
-        # handle when glob recursive not available in older python versions
-        except TypeError:
-            coverage_files = []
-            for root, dirnames, filenames in os.walk(batch_dir):
-                for filename in fnmatch.filter(
-                        filenames, "*{0}".format(cov_file_pattern)):
-                    coverage_files.append(os.path.join(root, filename))
-        except Exception as e:
-            coverage_files = []
-        return coverage_files
-
-    @classmethod
-    def _import_coverage(cls, file, column_dtypes, sep="\t"):
-        """ Method to read output file from coverage file into a dataframe.
-        :param: file: Path to coverage file
-        :param: column_dtypes: Dictionary with column name and datatype for
-                            the given coverage file type
-        :param: sep: seperate used in coverage file (default is tab)
-        :returns: reader iterable containing Pandas dataframe.
-        """
-        reader = pd.read_csv(
-            file,
-            sep=sep,
-            header=0,
-            skipinitialspace=True,
-            na_values="-",
-            dtype=column_dtypes,
-            chunksize=10000,
-        )
-
-        return reader
-
-    @classmethod
-    def _import_intervals(cls, intervals, dup_threshold):
-        """ Method to process interval json file and store as a dictionary
-        :param: file: Path to interval json
-        :param: dup_threshold: Threshold used to identify dup/amp regions
-        :returns: Dictionary
-        """
-        # open json
-        with open(intervals) as json_file:
-            intervals = json.load(json_file)
-
-        # validation json contents
-        for interval in intervals:
-            [interval[k] for k in ["region1", "region2"]]
-            # add on default dup threshold if it has not been defined
-            try:
-                if interval["dup_threshold"] == "":
-                    interval["dup_threshold"] = dup_threshold
-            except KeyError:
-                interval["dup_threshold"] = dup_threshold
-
-        return intervals
-
-    @classmethod
-    def _filter_df(cls, df, filters):
-        """ Filter df.
-        :param: df: Pandas dataframe
-        :parma: filter: Filter values as a dictionary
-        :returns: filtered Pandas dataframe
-        """
-        query = " & ".join(
-            ['{} == "{}"'.format(k, v) for k, v in filters.items()]
-        )
-        filtered_df = df.query(query)
-
-        return filtered_df
-
-    @classmethod
-    def _get_sample_id(cls, file, cov_file_pattern):
-        """ Method to return sample ID from file name.
-        :param: file: Input file name
-        :param: cov_file_pattern: Coverage file suffix to remove from filename
-        :returns: sample id string
-        """
-        sample_id = (
-            os.path.basename(file).split(cov_file_pattern)[0].replace("-", "_")
-        )
-
-        return sample_id
-
-    def _compare_metric_at_intervals(self, cov_chunks, pair, metric):
-        """ Method to compare normalised coverage at given intervals and score
-        with a theshold value.
-        :param: cov_chunks: List of Dataframes containing coverage info
-        :param: pair: Dictionary containing info of intervals to be compared
-        :param: metric: Column name in the df corresponding to the metric that
-                        needs to be compared.
-        :returns: Pandas dataframe
-        """
-        # logging
-        print(
-            "[{0}] Comparing {1} at {2} with {3}.".format(
-                datetime.now(),
-                metric,
-                ",".join([str(i) for i in pair["region1"].values()]),
-                ",".join([str(i) for i in pair["region2"].values()]),
-            )
-        )
-        # iterate over each df chunk
-        chunk_list = []
-        for df in cov_chunks:
-            for region in ["region1", "region2"]:
-                # filter df for region of interest
-                filt = self._filter_df(
-                    df=df,
-                    filters={
-                        key: value
-                        for key, value in pair[region].items()
-                        if not key == "name"
-                    },
-                )
-                if filt.shape[0] == 1:
-                    # rename the interval for clarity
-                    filt["name"] = pair[region]["name"]
-                    chunk_list.append(filt)
-                    # add on sample id column
-                    filt["sample_id"] = self.sample_id
-
-        # concatent the list or dataframe rows into a dataframe
-        intv_comp = pd.concat(chunk_list)
-        # convert from long to wide
-        intv_comp = intv_comp.pivot(
-            index="sample_id", columns="name", values=metric
-        )
-        # calc fold change between the two values
-        intv_comp["fold_change"] = round(
-            (
-                intv_comp[pair["region1"]["name"]]
-                / intv_comp[pair["region2"]["name"]]
-            ),
-            9,
-        )
-        # take a log of the fold change
-        intv_comp["log2_fold_change"] = round(
-            np.log2(intv_comp["fold_change"]), 9
-        )
-
-        # is the score above given theshold?
-        intv_comp["above_cut_off"] = "FALSE"
-        intv_comp.loc[
-            intv_comp["fold_change"] > pair["dup_threshold"], "above_cut_off",
-        ] = "TRUE"
-
-        # reset index and sort
-        intv_comp = intv_comp.reset_index().sort_values(
-            by=["fold_change", "sample_id"], ascending=False
-        )
-        # order the columns
-        intv_comp = intv_comp[
-            [
-                "sample_id",
-                pair["region1"]["name"],
-                pair["region2"]["name"],
-                "fold_change",
-                "log2_fold_change",
-                "above_cut_off",
-            ]
-        ]
-
-        return intv_comp
-
-    def _process_file(self, file, intervals, out_dir):
-        """ Method to process the coverage file to identify potential
-        breakpoints.
-        :param: file: Path to coverage file
-        :param: intervals: Path of interval json file
-        :param: out_dir: Path to output fir
-        :returns: Writes a list of coverage comparisons and returns
-                True if file processed, othwise False.
-        """
-        print(
-            "[{0}] Processing {1}".format(
-                datetime.now(), os.path.basename(file)
-            )
-        )
-        # add to self so can be used elsewhere
-        self.file = file
-        # get sample
-        self.sample_id = self._get_sample_id(
-            file=self.file, cov_file_pattern=self.cov_file_pattern
-        )
-        # parse interval file to extract which region we want to process
-        try:
-            intervals = self._import_intervals(
-                intervals=intervals, dup_threshold=self.dup_threshold
-            )
-        except Exception as e:
-            sys.stderr.write(str(e))
-            sys.stderr.write(
-                "[{0}] Error: {1} interval file wrong format! Exiting...!"
-                .format(
-                    datetime.now(), os.path.basename(intervals)
-                )
-            )
-            sys.exit()
-        # parse the coverage file into chunks - helps with memory requirements
-        # for v. large files
-        try:
-            cov_chunks = self._import_coverage(
-                file=file, column_dtypes=self.column_dtypes
-            )
-        except Exception as e:
-            sys.stderr.write("[{0}] Error: {1}".format(datetime.now(), str(e)))
-
-        # for each interval pair find and compare the interval
-        try:
-            out_list = []
-            for pair in intervals:
-                out = self._compare_metric_at_intervals(
-                    cov_chunks, pair, metric=self.metric
-                )
-
-                out_list.append(out)
-            # concatent into single dataframe
-            out_df = pd.concat(out_list, axis=0, ignore_index=True)
-            # create filename
-            fname = os.path.join(
-                out_dir, "{0}{1}".format(self.sample_id, self.out_fname_suffix)
-            )
-            self.fname = fname
-            # write output to file
-            out_df.to_csv(fname, index=False)
-            # logging
-            print("[{0}] Results written to {1}".format(datetime.now(), fname))
-        except Exception as e:
-            sys.stderr.write("[{0}] Error: {1}".format(datetime.now(), str(e)))
-            sys.stderr.write(
-                "[{0}] Error: {1} tsv malformed/missing intervals".format(
-                    datetime.now(), os.path.basename(file)
-                )
-            )
-
-    def __call__(self, file):
-        return self._process_file(
-            file=file, intervals=self.intervals, out_dir=self.out_dir
-        )
-
-
-if __name__ == "__main__":
-    # parse the command line arguments
-    args = tdh_argument_parser(sys.argv[1:])
-    # process the coverage file(s)
-    TDHunter(
-        file=args.file,
-        batch=args.batch,
-        intervals=args.intervals,
-        dup_threshold=args.dup_threshold,
-        out_dir=args.out_dir,
-        out_fname_suffix=args.out_fname_suffix,
-        processes=args.processes,
-        cov_file_pattern=args.cov_file_pattern,
-        metric=args.metric,
-    )
+# Tandem Hunter: Identification of duplicated/amplified
+# regions based on the comparison
+# of normalise coverage between two intervals in given coverage file
+# (PER_TARGET_COVERAGE from Picard CollectHsMetrics).
+
+# Author: Helena L. Spiewak
+# Contributors: Nadia Mohammed
+# Date created: 2021-04-06
+# Date modified: 2021-04-06
+# Date modified for v2.0.0: 2022-08-18
+
+# It is used to identify KMT2A/MLL partial tandem duplications and is based on
+# the method described by McKerrell et al., 2016, where they compare
+# the coverage of exon 3 and exon 27 of MLL/KMT2A.
+
+import pandas as pd
+import numpy as np
+import argparse
+import bisect
+import collections
+from concurrent.futures import (
+    Future, ProcessPoolExecutor, ThreadPoolExecutor
+)
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import cProfile
+import sys
+import os
+import json
+import multiprocessing as mp
+from multiprocessing.util import Finalize
+import fnmatch
+import functools
+from datetime import datetime, timezone
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import mmap
+import resource
+import shutil
+import stat
+import socketserver
+import sqlite3
+import struct
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import zlib
+
+# define Picard CollectHsMetrics PER_TARGET_COVERAGE columns
+COV_COLUMN_DTYPES = {
+    "chrom": "category",
+    "start": "int",
+    "end": "int",
+    "length": "int",
+    "name": "category",
+    "%gc": "float64",
+    "mean_coverage": "float64",
+    "normalized_coverage": "float64",
+    "min_normalized_coverage": "float64",
+    "max_normalized_coverage": "float64",
+    "min_coverage": "int",
+    "max_coverage": "int",
+    "pct_0x": "float64",
+    "read_count": "int",
+}
+
+# coverage read engines; "auto" uses the line scanner for small region sets
+COV_ENGINES = ["auto", "pandas", "scan"]
+SCAN_MAX_REGIONS = 64
+
+# how regions are resolved to coverage targets; other than "exact", the
+# metric of regions spanning several targets is their length weighted mean
+MATCH_MODES = ["exact", "overlap", "contain", "nearest"]
+
+# byte offset index stored alongside coverage files (or in an index dir)
+INDEX_SUFFIX = ".tdhidx"
+INDEX_VERSION = 2
+
+# how batch mode treats symlinks: follow symlinked files and folders, only
+# symlinked files or none
+SYMLINK_POLICIES = ["follow", "files", "skip"]
+
+# how batch files are handed to the workers: stat'ed up front and largest
+# first, or in the order they are found
+SCHEDULES = ["size", "discovery"]
+# rough ratio of the decompressed to the compressed size of coverage files,
+# to budget the memory of compressed files
+COMPRESSION_RATIO = 4
+
+# file name of a coverage file read from stdin
+STDIN = "-"
+
+# gzip and BGZF (blocked gzip, as written by bgzip) compressed coverage files
+GZIP_MAGIC = b"\x1f\x8b"
+COMPRESSED_SUFFIXES = [".gz", ".bgz"]
+
+# columnar cache of parsed coverage files, keyed by path, size and mtime
+CACHE_VERSION = 1
+
+# combined outputs for a whole cohort, named as by
+# generate_comparison_csv_to_xls.py
+COHORT_FORMATS = ["csv", "xlsx"]
+COHORT_FNAMES = {"csv": "comparison.csv", "xlsx": "comparison_csv.xlsx"}
+
+# layouts of the results of several metrics: a row per sample, metric and
+# pair, or a row per sample and pair with the columns of each metric
+RESULT_LAYOUTS = ["long", "wide"]
+
+# partial results of one shard of a batch, merged by the merge subcommand
+SHARD_FNAME = "shard_{0}_of_{1}.json"
+SHARD_VERSION = 1
+
+# manifest of the files processed in incremental batch mode, kept in the
+# output directory
+MANIFEST_FNAME = ".tdh_manifest.json"
+MANIFEST_VERSION = 1
+
+# results of the exon segment scan, one row per sample and gene
+EXON_SCAN_COLUMNS = [
+    "sample_id",
+    "gene",
+    "first_exon",
+    "last_exon",
+    "n_exons",
+    "chrom",
+    "start",
+    "end",
+    "segment_mean",
+    "flank_mean",
+    "fold_change",
+    "log2_fold_change",
+    "above_cut_off",
+]
+EXON_SCAN_FNAME = "exon_scan.csv"
+
+# SQLite store of the results of every run, a row per sample and pair
+DB_VERSION = 1
+DB_COLUMNS = [
+    "run",
+    "sample_id",
+    "file",
+    "name1",
+    "name2",
+    "region1",
+    "region2",
+    "metric",
+    "value1",
+    "value2",
+    "fold_change",
+    "log2_fold_change",
+    "dup_threshold",
+    "above_cut_off",
+    "z_score",
+    "p_value",
+    "plan",
+    "created",
+]
+DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)""",
+    """CREATE TABLE IF NOT EXISTS results (
+        run TEXT NOT NULL,
+        sample_id TEXT NOT NULL,
+        file TEXT,
+        name1 TEXT NOT NULL,
+        name2 TEXT NOT NULL,
+        region1 TEXT,
+        region2 TEXT,
+        metric TEXT NOT NULL,
+        value1 REAL,
+        value2 REAL,
+        fold_change REAL,
+        log2_fold_change REAL,
+        dup_threshold REAL,
+        above_cut_off INTEGER,
+        z_score REAL,
+        p_value REAL,
+        plan TEXT,
+        created TEXT,
+        UNIQUE (run, sample_id, name1, name2, metric)
+    )""",
+    "CREATE INDEX IF NOT EXISTS results_sample ON results (sample_id)",
+    "CREATE INDEX IF NOT EXISTS results_pair ON results (name1, name2)",
+    "CREATE INDEX IF NOT EXISTS results_run ON results (run, created)",
+]
+
+# panel of normals baseline of the metric at each region and the fold change
+# of each pair, stored as a compressed numpy archive. MADs are scaled by
+# MAD_SCALE to estimate the standard deviation of z-scores
+BASELINE_VERSION = 1
+MAD_SCALE = 1.4826
+
+# stages timed by the profiler, in the order they run
+PROFILE_STAGES = [
+    "find_coverage_files",
+    "import_intervals",
+    "parse_coverage",
+    "compare_intervals",
+    "scan_exon_segments",
+    "write_baseline",
+    "write_db",
+    "write_csv",
+    "write_cohort_csv",
+    "write_cohort_xlsx",
+]
+
+
+def tdh_shard_type(value):
+    """ Parse a shard of a batch given as I/N, e.g. 2/8. """
+    try:
+        index, n_shards = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "{0} is not a shard I/N, e.g. 2/8".format(value)
+        )
+    if not 1 <= index <= n_shards:
+        raise argparse.ArgumentTypeError(
+            "Shard {0} must be from 1/{1} to {1}/{1}".format(value, n_shards)
+        )
+
+    return index, n_shards
+
+
+def tdh_argument_parser(args):
+    """ Parse arguments for Tandem Hunter. """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Tandem Hunter: Identification of duplicated/amplified regions"
+            "based on comparing normalised coverage between two intervals"
+        )
+    )
+    required = parser.add_mutually_exclusive_group(required=True)
+    required.add_argument(
+        "-F", "--file", default=False,
+        help="Path to coverage file, - to read it from stdin, OR",
+    )
+    required.add_argument(
+        "-B",
+        "--batch",
+        default=False,
+        help="Path to coverage files folder. DON'T use -F and -B together.",
+    )
+    parser.add_argument(
+        "--sample-id",
+        default="stdin",
+        help="Sample id of a coverage file read from stdin with -F -",
+    )
+    parser.add_argument(
+        "--stdout",
+        choices=["csv", "ndjson"],
+        default=None,
+        help=(
+            "Write results to stdout as csv or newline delimited json "
+            "instead of a results file per sample, logging to stderr"
+        ),
+    )
+    parser.add_argument(
+        "--intervals",
+        type=str,
+        required=True,
+        help=(
+            "Path to json file containing intervals to compare coverage at."
+            " These regions have to be in the coverage file as is as this "
+            " programme uses pattern matching"
+        ),
+    )
+    parser.add_argument(
+        "--dup-threshold",
+        type=float,
+        default=1.122995,
+        help="Default threshold for dup/amp regions if not in interval file",
+    )
+    parser.add_argument(
+        "-O", "--out_dir",
+        default=".", help="Output write directory"
+    )
+    parser.add_argument(
+        "--out-fname-suffix",
+        default=".cvg_comparison.csv",
+        help="Filename suffix to use when naming results file",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help=(
+            "Maximum number of processes to run in parallel (default is the "
+            "number of available cores)"
+        ),
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=0,
+        help=(
+            "In batch mode, maximum MB of coverage files being processed at "
+            "once, also limiting the number of processes to what the typical "
+            "file fits (default is no limit)"
+        ),
+    )
+    parser.add_argument(
+        "--shard",
+        type=tdh_shard_type,
+        default=None,
+        metavar="I/N",
+        help=(
+            "In batch mode, only process shard I of N of the coverage "
+            "files, by a stable hash of their path within the batch folder, "
+            "and write the shard's results for the merge subcommand"
+        ),
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=SCHEDULES,
+        default="discovery",
+        help=(
+            "In batch mode, process each coverage file as soon as it is "
+            "found ('discovery'), or find every file first and process the "
+            "largest first ('size')"
+        ),
+    )
+    parser.add_argument(
+        "--cov-file-pattern",
+        nargs="+",
+        default="coverage.tsv",
+        help=(
+            "Filename suffix(es) used to identify coverage files in batch "
+            "mode"
+        ),
+    )
+    parser.add_argument(
+        "--include",
+        nargs="+",
+        default=None,
+        help=(
+            "In batch mode, only process coverage files whose path within "
+            "the batch folder matches one of these globs"
+        ),
+    )
+    parser.add_argument(
+        "--exclude",
+        nargs="+",
+        default=None,
+        help=(
+            "In batch mode, skip coverage files whose path within the batch "
+            "folder matches one of these globs"
+        ),
+    )
+    parser.add_argument(
+        "--symlinks",
+        choices=SYMLINK_POLICIES,
+        default="follow",
+        help=(
+            "In batch mode, follow symlinked files and folders, only "
+            "symlinked files, or skip symlinks"
+        ),
+    )
+    parser.add_argument(
+        "--metric",
+        nargs="+",
+        default="normalized_coverage",
+        help=(
+            "Metric(s) to used in comparison, several metrics are all "
+            "compared from the same read of each coverage file"
+        ),
+    )
+    parser.add_argument(
+        "--layout",
+        choices=RESULT_LAYOUTS,
+        default="long",
+        help=(
+            "With several metrics, write a row per sample, metric and pair "
+            "with a metric column ('long'), or a row per sample and pair "
+            "with the columns of each metric suffixed by its name ('wide')"
+        ),
+    )
+    parser.add_argument(
+        "--engine",
+        choices=COV_ENGINES,
+        default="auto",
+        help=(
+            "Coverage file reader. 'scan' only parses the lines of the "
+            "requested regions, 'pandas' parses the whole file, 'auto' "
+            "scans when there are {0} regions or fewer".format(
+                SCAN_MAX_REGIONS
+            )
+        ),
+    )
+    parser.add_argument(
+        "--match",
+        choices=MATCH_MODES,
+        default="exact",
+        help=(
+            "How intervals are found in coverage files. 'exact' needs a "
+            "target with the same chrom, start and end, 'overlap' uses the "
+            "targets overlapping the interval, 'contain' the targets within "
+            "it and 'nearest' the overlapping targets or else the closest "
+            "one. The metric of several targets is their length weighted "
+            "mean"
+        ),
+    )
+    parser.add_argument(
+        "--full-scan",
+        action="store_true",
+        help=(
+            "Read coverage files to the end instead of stopping once all "
+            "requested regions have been passed in a sorted file"
+        ),
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help=(
+            "Jump straight to the chroms of the requested regions using a "
+            "byte offset index of each coverage file, which is built on "
+            "first read if missing or out of date"
+        ),
+    )
+    parser.add_argument(
+        "--index-dir",
+        default=None,
+        help="Directory to keep indexes in instead of next to coverage files",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help=(
+            "Directory to cache parsed coverage files in, as columnar numpy "
+            "arrays read before the coverage files themselves (default is "
+            "not to)"
+        ),
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=2048,
+        help=(
+            "Maximum size of the cache in MB, least recently used files are "
+            "evicted first"
+        ),
+    )
+    parser.add_argument(
+        "--cohort-dir",
+        default=None,
+        help=(
+            "Write the results of all samples to a single table in this "
+            "directory, as [run_]comparison.csv and/or "
+            "[run_]comparison_csv.xlsx"
+        ),
+    )
+    parser.add_argument(
+        "--cohort-formats",
+        nargs="+",
+        choices=COHORT_FORMATS,
+        default=COHORT_FORMATS,
+        help="Formats to write the cohort table in",
+    )
+    parser.add_argument(
+        "--run", default=None, help="Name of run to prefix cohort tables with"
+    )
+    parser.add_argument(
+        "--no-sample-csv",
+        action="store_true",
+        help="Don't write a results file per sample",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="REPORT",
+        help=(
+            "Write the wall time, cpu time, rows, bytes and peak memory of "
+            "each stage, per file and for the whole run, to this json file"
+        ),
+    )
+    parser.add_argument(
+        "--cprofile-dir",
+        default=None,
+        help="Write a cProfile dump of the main and each worker process here",
+    )
+    parser.add_argument(
+        "--db",
+        default=None,
+        help=(
+            "SQLite database to add the results of the run to, a row per "
+            "sample and interval pair, for the query subcommand"
+        ),
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help=(
+            "Panel of normals baseline built with the baseline subcommand, "
+            "adds the z-score of each interval and of the fold change, and "
+            "the empirical p-value of the fold change, to the results"
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "In batch mode, only process coverage files that are new or "
+            "changed since the last run with the same output directory, "
+            "intervals and metric, reusing the results of the others from a "
+            "manifest in the output directory"
+        ),
+    )
+    parser.add_argument(
+        "--prefetch-threads",
+        type=int,
+        default=0,
+        help=(
+            "In batch mode, read upcoming coverage files into memory with "
+            "this many threads while the workers parse and compare others, "
+            "needs --index or --full-scan (default is for workers to read "
+            "their own files)"
+        ),
+    )
+    parser.add_argument(
+        "--prefetch-budget",
+        type=int,
+        default=512,
+        help=(
+            "Maximum MB of prefetched coverage files held in memory at once, "
+            "reading pauses until workers finish with earlier files"
+        ),
+    )
+    parser.add_argument("--version",
+        action="version",
+        version="%(prog)s 2.0.0")
+
+    args = parser.parse_args(args)
+    # prefetching reads all a worker would, which is the whole file unless
+    # only the indexed chroms are needed or the file is read to the end
+    if args.prefetch_threads and not (args.index or args.full_scan):
+        parser.error(
+            "--prefetch-threads needs --index or --full-scan, otherwise "
+            "workers stop reading each file once all regions are passed"
+        )
+
+    return args
+
+
+def tdh_index_argument_parser(args):
+    """ Parse arguments for the Tandem Hunter index subcommand. """
+    parser = argparse.ArgumentParser(
+        prog="TandemHunter.py index",
+        description=(
+            "Build byte offset indexes for coverage files, for use with "
+            "--index"
+        ),
+    )
+    required = parser.add_mutually_exclusive_group(required=True)
+    required.add_argument(
+        "-F", "--file", default=False, help="Path to coverage file OR"
+    )
+    required.add_argument(
+        "-B",
+        "--batch",
+        default=False,
+        help="Path to coverage files folder. DON'T use -F and -B together.",
+    )
+    parser.add_argument(
+        "--index-dir",
+        default=None,
+        help="Directory to keep indexes in instead of next to coverage files",
+    )
+    parser.add_argument(
+        "--cov-file-pattern",
+        nargs="+",
+        default="coverage.tsv",
+        help=(
+            "Filename suffix(es) used to identify coverage files in batch "
+            "mode"
+        ),
+    )
+
+    return parser.parse_args(args)
+
+
+def tdh_baseline_argument_parser(args):
+    """ Parse arguments for the Tandem Hunter baseline subcommand. """
+    parser = argparse.ArgumentParser(
+        prog="TandemHunter.py baseline",
+        description=(
+            "Build a panel of normals baseline of the metric at each interval "
+            "and the fold change of each interval pair from a batch of "
+            "known-normal coverage files, for use with --baseline"
+        ),
+    )
+    parser.add_argument(
+        "-B",
+        "--batch",
+        required=True,
+        help="Path to folder of known-normal coverage files",
+    )
+    parser.add_argument(
+        "--intervals",
+        required=True,
+        help="Path to json file containing intervals to compare coverage at",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        required=True,
+        help="Path to write the baseline to (.npz)",
+    )
+    parser.add_argument(
+        "--processes", type=int, default=0,
+        help="Number of processes to run in parallel",
+    )
+    parser.add_argument(
+        "--cov-file-pattern",
+        nargs="+",
+        default="coverage.tsv",
+        help=(
+            "Filename suffix(es) used to identify coverage files in batch "
+            "mode"
+        ),
+    )
+    parser.add_argument(
+        "--metric",
+        default="normalized_coverage",
+        help="Metric to used in comparison",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=COV_ENGINES,
+        default="auto",
+        help="Coverage file reader, as for the main command",
+    )
+    parser.add_argument(
+        "--match",
+        choices=MATCH_MODES,
+        default="exact",
+        help="How intervals are found in coverage files",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Read coverage files using their byte offset index",
+    )
+    parser.add_argument(
+        "--index-dir",
+        default=None,
+        help="Directory to keep indexes in instead of next to coverage files",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory to cache parsed coverage files in (default is not to)",
+    )
+
+    return parser.parse_args(args)
+
+
+def tdh_query_argument_parser(args):
+    """ Parse arguments for the Tandem Hunter query subcommand. """
+    parser = argparse.ArgumentParser(
+        prog="TandemHunter.py query",
+        description=(
+            "Export results from a database written with --db, filtered by "
+            "run, sample, interval pair and call"
+        ),
+    )
+    parser.add_argument(
+        "--db", required=True, help="Path to the results database"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        required=True,
+        help="Path to write the results to, as csv or .xlsx",
+    )
+    parser.add_argument(
+        "--format",
+        choices=COHORT_FORMATS,
+        default=None,
+        help="Output format (default is from the output file extension)",
+    )
+    parser.add_argument(
+        "--run", nargs="+", default=None, help="Only these runs"
+    )
+    parser.add_argument(
+        "--last-runs",
+        type=int,
+        default=None,
+        help="Only the most recently added N runs",
+    )
+    parser.add_argument(
+        "--sample",
+        nargs="+",
+        default=None,
+        help="Only samples matching these globs, e.g. 'X001*'",
+    )
+    parser.add_argument(
+        "--pair",
+        nargs=2,
+        default=None,
+        metavar=("NAME1", "NAME2"),
+        help="Only this interval pair, e.g. MLL_EXON3 MLL_EXON27",
+    )
+    parser.add_argument(
+        "--metric", default=None, help="Only results of this metric"
+    )
+    parser.add_argument(
+        "--plan", default=None, help="Only results of this intervals hash"
+    )
+    parser.add_argument(
+        "--calls-only",
+        action="store_true",
+        help="Only results above the cut off",
+    )
+
+    return parser.parse_args(args)
+
+
+def tdh_merge_argument_parser(args):
+    """ Parse arguments for the Tandem Hunter merge subcommand. """
+    parser = argparse.ArgumentParser(
+        prog="TandemHunter.py merge",
+        description=(
+            "Merge the results of every shard of a batch, written with "
+            "--shard, into the cohort tables of the whole batch"
+        ),
+    )
+    parser.add_argument(
+        "shards",
+        nargs="+",
+        help=(
+            "Shard results ([run_]shard_I_of_N.json), or folders holding "
+            "them"
+        ),
+    )
+    parser.add_argument(
+        "-O", "--cohort-dir",
+        default=".",
+        help="Directory to write the cohort tables to",
+    )
+    parser.add_argument(
+        "--cohort-formats",
+        nargs="+",
+        choices=COHORT_FORMATS,
+        default=COHORT_FORMATS,
+        help="Formats to write the cohort table in",
+    )
+    parser.add_argument(
+        "--run",
+        default=None,
+        help=(
+            "Name of run to prefix cohort tables with (default is the run "
+            "of the shards)"
+        ),
+    )
+
+    return parser.parse_args(args)
+
+
+def tdh_serve_argument_parser(args):
+    """ Parse arguments for the Tandem Hunter serve subcommand. """
+    parser = argparse.ArgumentParser(
+        prog="TandemHunter.py serve",
+        description=(
+            "Serve per-sample scoring requests with the intervals (and "
+            "baseline) loaded once, reloading them when the files change"
+        ),
+    )
+    parser.add_argument(
+        "--intervals",
+        required=True,
+        help="Path to json file containing intervals to compare coverage at",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Panel of normals baseline to score samples against",
+    )
+    address = parser.add_mutually_exclusive_group()
+    address.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port to serve HTTP requests on",
+    )
+    address.add_argument(
+        "--socket",
+        default=None,
+        help="Serve on a Unix socket at this path instead of a port",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Address to serve HTTP requests on",
+    )
+    parser.add_argument(
+        "--dup-threshold",
+        type=float,
+        default=1.122995,
+        help="Default threshold for dup/amp regions if not in interval file",
+    )
+    parser.add_argument(
+        "--cov-file-pattern",
+        nargs="+",
+        default="coverage.tsv",
+        help="Filename suffix(es) removed from coverage files for sample ids",
+    )
+    parser.add_argument(
+        "--metric",
+        default="normalized_coverage",
+        help="Metric to used in comparison",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=COV_ENGINES,
+        default="auto",
+        help="Coverage file reader, as for the main command",
+    )
+    parser.add_argument(
+        "--match",
+        choices=MATCH_MODES,
+        default="exact",
+        help="How intervals are found in coverage files",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Read coverage files on disk using their byte offset index",
+    )
+    parser.add_argument(
+        "--index-dir",
+        default=None,
+        help="Directory to keep indexes in instead of next to coverage files",
+    )
+
+    return parser.parse_args(args)
+
+
+def tdh_scan_argument_parser(args):
+    """ Parse arguments for the Tandem Hunter scan subcommand. """
+    parser = argparse.ArgumentParser(
+        prog="TandemHunter.py scan",
+        description=(
+            "Scan every run of consecutive exons of whole genes for the most "
+            "duplicated segment of each sample, comparing its coverage to "
+            "the rest of the gene"
+        ),
+    )
+    required = parser.add_mutually_exclusive_group(required=True)
+    required.add_argument(
+        "-F", "--file", default=False, help="Path to coverage file OR"
+    )
+    required.add_argument(
+        "-B",
+        "--batch",
+        default=False,
+        help="Path to coverage files folder. DON'T use -F and -B together.",
+    )
+    parser.add_argument(
+        "--bed",
+        nargs="+",
+        required=True,
+        help=(
+            "BED file(s) of the exons of a gene, one gene per file named "
+            "after the file, e.g. Picard_inputs/KMT2A_all_exons.bed. Exons "
+            "have to be targets of the coverage files unless --match is "
+            "given"
+        ),
+    )
+    parser.add_argument(
+        "--min-exons",
+        type=int,
+        default=2,
+        help="Minimum number of exons in a duplicated segment",
+    )
+    parser.add_argument(
+        "--min-flank",
+        type=int,
+        default=2,
+        help="Minimum number of exons of the gene on each side of the segment",
+    )
+    parser.add_argument(
+        "--dup-threshold",
+        type=float,
+        default=1.122995,
+        help="Threshold of the segment to flank fold change for dup/amp",
+    )
+    parser.add_argument(
+        "-O", "--out_dir",
+        default=".", help="Output write directory"
+    )
+    parser.add_argument(
+        "--run",
+        default=None,
+        help="Name of run to prefix the {0} table with".format(
+            EXON_SCAN_FNAME
+        ),
+    )
+    parser.add_argument(
+        "--processes", type=int, default=0,
+        help="Number of processes to run in parallel",
+    )
+    parser.add_argument(
+        "--cov-file-pattern",
+        nargs="+",
+        default="coverage.tsv",
+        help=(
+            "Filename suffix(es) used to identify coverage files in batch "
+            "mode"
+        ),
+    )
+    parser.add_argument(
+        "--metric",
+        default="normalized_coverage",
+        help="Metric to used in comparison",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=COV_ENGINES,
+        default="auto",
+        help="Coverage file reader, as for the main command",
+    )
+    parser.add_argument(
+        "--match",
+        choices=MATCH_MODES,
+        default="exact",
+        help="How exons are found in coverage files, as for --intervals",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Read coverage files using their byte offset index",
+    )
+    parser.add_argument(
+        "--index-dir",
+        default=None,
+        help="Directory to keep indexes in instead of next to coverage files",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory to cache parsed coverage files in (default is not to)",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="REPORT",
+        help="Write the time and resources used by each stage to this json",
+    )
+
+    return parser.parse_args(args)
+
+
+class IntervalPair(
+    collections.namedtuple(
+        "IntervalPair",
+        [
+            "region1",
+            "region2",
+            "name1",
+            "name2",
+            "dup_threshold",
+            "metric_thresholds",
+        ],
+    )
+):
+    """ Pair of intervals to compare, with (chrom, start, end) region keys,
+        interval names and the threshold used to identify dup/amp regions,
+        with a tuple of (metric, threshold) for metrics whose threshold
+        differs.
+    """
+    __slots__ = ()
+
+
+class IntervalPlan(
+    collections.namedtuple(
+        "IntervalPlan",
+        [
+            "pairs",
+            "regions",
+            "region_set",
+            "region1_columns",
+            "region2_columns",
+            "thresholds",
+            "name_columns",
+            "columns",
+            "genes",
+        ],
+    )
+):
+    """ Immutable plan of the intervals to compare, compiled once from the
+        intervals json and shared read-only with batch workers.
+        :param: pairs: Tuple of IntervalPair
+        :param: regions: Tuple of every (chrom, start, end) region key, in
+                        the column order of the samples x regions matrix
+        :param: region_set: Frozenset of the region keys for lookups
+        :param: region1_columns: Tuple of the matrix column of each pair's
+                                first region
+        :param: region2_columns: Tuple of the matrix column of each pair's
+                                second region
+        :param: thresholds: Tuple of the dup threshold of each pair
+        :param: name_columns: Tuple of (name, columns) for each interval name
+                            in order of appearance, where columns holds the
+                            matrix column of the name in each pair, or None
+        :param: columns: Tuple of results table column names
+        :param: genes: Tuple of (gene, columns) for each exon catalog to scan,
+                    where columns holds the matrix column of each exon in
+                    genomic order
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """ Method to compile a plan from validated interval pairs.
+        :param: intervals: List of interval pairs, as from
+                            TDHunter._import_intervals
+        :returns: IntervalPlan
+        """
+        pairs = tuple(
+            IntervalPair(
+                region1=TDHunter._region_key(pair["region1"]),
+                region2=TDHunter._region_key(pair["region2"]),
+                name1=pair["region1"]["name"],
+                name2=pair["region2"]["name"],
+                dup_threshold=float(pair["dup_threshold"]),
+                metric_thresholds=tuple(sorted(
+                    (metric, float(threshold)) for metric, threshold
+                    in pair.get("metric_thresholds", {}).items()
+                )),
+            )
+            for pair in intervals
+        )
+        regions = tuple(sorted(TDHunter._compile_regions(intervals)))
+        region_index = {key: i for i, key in enumerate(regions)}
+
+        # find the matrix column of each interval name in each pair
+        names = []
+        name_columns = {}
+        for p, pair in enumerate(pairs):
+            for name, key in [
+                (pair.name1, pair.region1), (pair.name2, pair.region2)
+            ]:
+                if name not in name_columns:
+                    names.append(name)
+                    name_columns[name] = [None] * len(pairs)
+                name_columns[name][p] = region_index[key]
+
+        # the names of the first pair come before the comparison columns, any
+        # other names after them
+        first_pair = [pairs[0].name1, pairs[0].name2] if pairs else []
+        columns = (
+            ["sample_id"]
+            + sorted(set(first_pair), key=first_pair.index)
+            + ["fold_change", "log2_fold_change", "above_cut_off"]
+            + [name for name in names if name not in first_pair]
+        )
+
+        return cls(
+            pairs=pairs,
+            regions=regions,
+            region_set=frozenset(regions),
+            region1_columns=tuple(region_index[p.region1] for p in pairs),
+            region2_columns=tuple(region_index[p.region2] for p in pairs),
+            thresholds=tuple(p.dup_threshold for p in pairs),
+            name_columns=tuple(
+                (name, tuple(name_columns[name])) for name in names
+            ),
+            columns=tuple(columns),
+            genes=(),
+        )
+
+    @classmethod
+    def from_exon_catalog(cls, catalog):
+        """ Method to compile a plan scanning the exons of whole genes for
+        duplicated segments, instead of comparing interval pairs.
+        :param: catalog: List of (gene, exons) as from
+                        TDHunter._import_exon_catalog
+        :returns: IntervalPlan
+        """
+        regions = tuple(sorted(set(
+            exon for gene, exons in catalog for exon in exons
+        )))
+        region_index = {key: i for i, key in enumerate(regions)}
+
+        return cls(
+            pairs=(),
+            regions=regions,
+            region_set=frozenset(regions),
+            region1_columns=(),
+            region2_columns=(),
+            thresholds=(),
+            name_columns=(),
+            columns=tuple(EXON_SCAN_COLUMNS),
+            genes=tuple(
+                (gene, tuple(region_index[exon] for exon in exons))
+                for gene, exons in catalog
+            ),
+        )
+
+    def metric_plan(self, metric):
+        """ Method to return the plan with the dup threshold of each pair for
+        the given metric.
+        :param: metric: Column name of the metric
+        :returns: IntervalPlan
+        """
+        return self._replace(thresholds=tuple(
+            dict(pair.metric_thresholds).get(metric, pair.dup_threshold)
+            for pair in self.pairs
+        ))
+
+    @property
+    def digest(self):
+        """ Sha1 hex digest of the interval pairs (and exon catalogs),
+        identifying the plan across runs. """
+        # pairs without metric thresholds are hashed as they were before
+        # thresholds could be given per metric
+        plan = [
+            list(pair) if pair.metric_thresholds else list(pair[:-1])
+            for pair in self.pairs
+        ]
+        if self.genes:
+            plan.append([
+                [gene, [self.regions[column] for column in columns]]
+                for gene, columns in self.genes
+            ])
+        return hashlib.sha1(json.dumps(plan).encode()).hexdigest()
+
+
+class SortedScanTracker(object):
+    """ Object tracking a reader's position in a coverage file sorted by
+        target, to tell when every requested region has been passed and the
+        rest of the file can be skipped. Reading only stops while everything
+        read so far is sorted: each chrom in one contiguous block and starts
+        not decreasing within the chroms of requested regions.
+        :param: bounds: Dictionary of chrom to the largest requested start
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.pending = set(bounds)
+        self.seen = set()
+        self.chrom = None
+        self.last_start = None
+        self.sorted = True
+
+    def _enter_chrom(self, chrom):
+        """ Method to move the tracker on to the block of the given chrom. """
+        # a chrom seen before in another block means the file is unsorted
+        if chrom in self.seen:
+            self.sorted = False
+        self.seen.add(chrom)
+        # leaving a chrom block means all its regions have been passed
+        self.pending.discard(self.chrom)
+        self.chrom = chrom
+        self.last_start = None
+
+    def update(self, chrom, start):
+        """ Method to track a single coverage row.
+        :param: chrom: Chrom of the row
+        :param: start: Start of the row, only needed for requested chroms
+        :returns: True if reading can stop
+        """
+        if chrom != self.chrom:
+            self._enter_chrom(chrom)
+        if chrom in self.bounds:
+            if self.last_start is not None and start < self.last_start:
+                self.sorted = False
+            self.last_start = start
+            if start > self.bounds[chrom]:
+                self.pending.discard(chrom)
+
+        return self.sorted and not self.pending
+
+    def update_chunk(self, chroms, starts):
+        """ Method to track a chunk of coverage rows.
+        :param: chroms: Array of the chrom of each row
+        :param: starts: Array of the start of each row
+        :returns: True if reading can stop
+        """
+        # split the chunk into blocks of the same chrom
+        edges = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+        firsts = np.concatenate([[0], edges])
+        lasts = np.concatenate([edges, [len(chroms)]])
+        for first, last in zip(firsts, lasts):
+            chrom = chroms[first]
+            if chrom != self.chrom:
+                self._enter_chrom(chrom)
+            if chrom in self.bounds:
+                block = starts[first:last]
+                if (
+                    self.last_start is not None and block[0] < self.last_start
+                ) or np.any(block[1:] < block[:-1]):
+                    self.sorted = False
+                self.last_start = block[-1]
+                if block[-1] > self.bounds[chrom]:
+                    self.pending.discard(chrom)
+
+        return self.sorted and not self.pending
+
+
+class StdinReader(io.RawIOBase):
+    """ Unbuffered reader of stdin counting the bytes read, as pipes can't
+        tell their position. Closing it leaves stdin open.
+    """
+    def __init__(self):
+        self.fd = sys.stdin.fileno()
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = os.read(self.fd, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+
+class StageProfiler(object):
+    """ Object recording the wall time, cpu time, rows, bytes read or
+        written and peak memory of each stage of a run. Stages of a single
+        coverage file are recorded in its result record instead, so they
+        can be sent back from batch workers and aggregated.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, stages=None):
+        """ Context manager timing a stage.
+        :param: name: Stage name, from PROFILE_STAGES
+        :param: stages: Dictionary to record the stage in (default is the
+                        stages of the run)
+        :returns: Yields a dictionary the stage adds its rows and bytes to
+        """
+        counts = {"rows": 0, "bytes": 0}
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield counts
+        finally:
+            wall = time.perf_counter() - wall
+            self.merge(
+                self.stages if stages is None else stages,
+                name,
+                {
+                    "calls": 1,
+                    "wall_s": wall,
+                    "max_wall_s": wall,
+                    "cpu_s": time.process_time() - cpu,
+                    "rows": counts["rows"],
+                    "bytes": counts["bytes"],
+                    # high water mark of the process at the end of the stage
+                    "peak_rss_kb": resource.getrusage(
+                        resource.RUSAGE_SELF
+                    ).ru_maxrss,
+                },
+            )
+
+    @classmethod
+    def merge(cls, stages, name, stats):
+        """ Method to add the stats of a stage to a stages dictionary.
+        :param: stages: Dictionary of stage name to stats
+        :param: name: Stage name
+        :param: stats: Dictionary of the stats of the stage
+        """
+        if name not in stages:
+            stages[name] = dict(stats)
+            return
+        totals = stages[name]
+        for key in ["calls", "wall_s", "cpu_s", "rows", "bytes"]:
+            totals[key] += stats[key]
+        for key in ["max_wall_s", "peak_rss_kb"]:
+            totals[key] = max(totals[key], stats[key])
+
+    def report(self, records, **run):
+        """ Method to build the profile report of a run.
+        :param: records: List of result records, with the stages of each file
+        :param: run: Settings of the run to include in the report
+        :returns: Dictionary of the run settings, total wall time, stages
+                    aggregated across all files and the stages of each file
+        """
+        stages = {name: dict(stats) for name, stats in self.stages.items()}
+        for record in records:
+            for name, stats in record["stages"].items():
+                self.merge(stages, name, stats)
+
+        def ordered(stages):
+            return collections.OrderedDict(
+                (name, stages[name]) for name in PROFILE_STAGES
+                if name in stages
+            )
+
+        report = collections.OrderedDict(run)
+        report["wall_s"] = time.perf_counter() - self.start
+        report["peak_rss_kb"] = resource.getrusage(
+            resource.RUSAGE_SELF
+        ).ru_maxrss
+        report["stages"] = ordered(stages)
+        report["files"] = [
+            collections.OrderedDict([
+                ("file", record["file"]),
+                ("sample_id", record["sample_id"]),
+                ("pid", record["pid"]),
+                ("error", record["error"]),
+                ("stages", ordered(record["stages"])),
+            ])
+            for record in records
+        ]
+
+        return report
+
+    @classmethod
+    def start_cprofile(cls, cprofile_dir, name):
+        """ Method to start profiling the current process with cProfile,
+        dumping the stats to cprofile_dir/<name>_<pid>.prof on exit.
+        :param: cprofile_dir: Directory to write the dump to
+        :param: name: Name of the process, e.g. main or worker
+        :returns: The running cProfile.Profile
+        """
+        if not os.path.isdir(cprofile_dir):
+            os.makedirs(cprofile_dir, exist_ok=True)
+        profile = cProfile.Profile()
+        profile.dump_path = os.path.join(
+            cprofile_dir, "{0}_{1}.prof".format(name, os.getpid())
+        )
+        profile.enable()
+
+        return profile
+
+    @classmethod
+    def stop_cprofile(cls, profile):
+        """ Method to stop a profile from start_cprofile and dump its stats.
+        :param: profile: The running cProfile.Profile
+        """
+        profile.disable()
+        profile.dump_stats(profile.dump_path)
+
+
+class PrefetchBudget(object):
+    """ Object limiting the bytes of coverage files held in memory, from
+        when a file is prefetched or handed to a worker until its worker
+        returns. A file larger than the budget is let through on its own.
+        :param: budget: Maximum bytes in flight
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_flight = {}
+        self.used = 0
+        self.peak = 0
+        self.files = 0
+        self.bytes = 0
+        self.condition = threading.Condition()
+
+    def try_acquire(self, file, size):
+        """ Method to reserve memory for a file if there is room.
+        :param: file: Path to coverage file
+        :param: size: Size of the file in bytes
+        :returns: True if the memory was reserved
+        """
+        with self.condition:
+            if self.used and self.used + size > self.budget:
+                return False
+            self.in_flight[file] = size
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            self.files += 1
+            self.bytes += size
+            return True
+
+    def wait(self, timeout=1):
+        """ Method to wait for memory to be released. """
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def resize(self, file, size):
+        """ Method to correct the memory reserved for a file once read,
+        e.g. when it was decompressed.
+        :param: file: Path to coverage file
+        :param: size: Size of the file in memory in bytes
+        """
+        with self.condition:
+            if file in self.in_flight:
+                self.used += size - self.in_flight[file]
+                self.bytes += size - self.in_flight[file]
+                self.in_flight[file] = size
+                self.peak = max(self.peak, self.used)
+                self.condition.notify_all()
+
+    def release(self, file):
+        """ Method to release the memory reserved for a file.
+        :param: file: Path to coverage file
+        """
+        with self.condition:
+            self.used -= self.in_flight.pop(file, 0)
+            self.condition.notify_all()
+
+
+class TDHunter(object):
+    """ Object containg methods that compare normalised coverage
+        at two given intervals.
+        :param: file: Path to coverage file
+        :param: batch: Path to folder with a batch of coverage files
+        :param: intervals: Path to file with intervals to compare coverage at
+        :param: dup_threshold: Threshold used to identify dup/amp regions
+        :param: out_dir: Output write directory
+        :param: out_fname_suffix: Filename suffix for naming results file
+        :param: processes: Maximum number of processes to run (default is the
+                            number of available cores)
+        :param: memory_budget: Maximum MB of coverage files being processed
+                            at once in batch mode, which also limits the
+                            processes to as many as typical files fit
+                            (default is no limit)
+        :param: schedule: Process batch files as soon as each is found
+                        ("discovery") or largest first once all are found
+                        ("size")
+        :param: shard: Tuple of the shard number (from 1) and number of
+                        shards, to only process that shard of a batch and
+                        write its results for merge_shards (default is the
+                        whole batch)
+        :param: cov_file_pattern: Filename suffix, or list of suffixes, to
+                                identify coverage files when in batch mode
+        :param: include: List of globs, only coverage files whose path within
+                        the batch folder matches one are processed
+        :param: exclude: List of globs of coverage files to skip
+        :param: symlinks: Follow symlinked files and folders ("follow"), only
+                        symlinked files ("files") or no symlinks ("skip") in
+                        batch mode
+        :param: column_dtypes: Dictionary with column name and datatype for
+                            the given coverage file type
+        :param: metric: Metric to used in comparison, or list of metrics to
+                        all compare from the same read of each file
+        :param: layout: Layout of the results of several metrics, a row per
+                        sample, metric and pair ("long") or a row per sample
+                        and pair with the columns of each metric ("wide")
+        :param: engine: Coverage file reader (auto, pandas or scan)
+        :param: match: How intervals are matched to coverage targets (exact,
+                        overlap, contain or nearest)
+        :param: full_scan: Read coverage files to the end instead of stopping
+                            once all regions have been passed
+        :param: index: Use a byte offset index to only read the chroms of
+                        the requested regions
+        :param: index_dir: Directory to keep indexes in (default is next to
+                            the coverage files)
+        :param: cache_dir: Directory to cache parsed coverage files in
+                            (default is no cache)
+        :param: cache_size: Maximum size of the cache in MB
+        :param: cohort_dir: Directory to write the combined results of all
+                            samples to (default is not to)
+        :param: cohort_formats: List of formats to write the cohort table in
+        :param: run: Name of run to prefix cohort tables with
+        :param: sample_csv: Write a results file per sample
+        :param: profile: Path to write a json report of the time and
+                        resources used by each stage to (default is not to)
+        :param: cprofile_dir: Directory to write cProfile dumps of the main
+                            and worker processes to (default is not to)
+        :param: prefetch_threads: Number of threads reading upcoming coverage
+                                files into memory for the batch workers, needs
+                                the index or full scan (default is for
+                                workers to read their files)
+        :param: prefetch_budget: Maximum MB of prefetched files held in
+                                memory at once
+        :param: incremental: In batch mode, only process new or changed
+                            files, reusing the results of the others from
+                            the manifest in out_dir
+        :param: exons: List of BED files of gene exons to scan for the most
+                        duplicated run of exons, one gene per file, instead
+                        of comparing the interval pairs
+        :param: min_exons: Minimum number of exons in a scanned segment
+        :param: min_flank: Minimum number of exons of the gene on each side
+                            of a scanned segment
+        :param: baseline: Path to a panel of normals baseline to score
+                        samples against (default is not to)
+        :param: baseline_out: Path to write a panel of normals baseline of
+                            the processed files to, instead of scoring them
+        :param: db: Path to a SQLite database to add the results of every
+                    sample and pair to (default is not to)
+        :param: stdin_sample_id: Sample id of a coverage file read from
+                                stdin (file "-")
+        :param: stdout_format: Write the results to stdout as csv or ndjson,
+                            instead of a results file per sample (logs go to
+                            stderr)
+        :param: serve: Serve scoring requests on (host, port) over HTTP, or
+                        on a Unix socket at this path, instead of processing
+                        a file or batch
+        :returns: Writes a coverage comparison between two intervals to a text
+                    file on per-sample basis
+    """
+    def __init__(
+        self,
+        file=False,
+        batch=False,
+        intervals=False,
+        dup_threshold=1.122995,
+        out_dir=".",
+        out_fname_suffix=".cvg_comparison.csv",
+        processes=0,
+        memory_budget=0,
+        schedule="discovery",
+        shard=None,
+        cov_file_pattern=".qc.coverage.txt",
+        include=None,
+        exclude=None,
+        symlinks="follow",
+        column_dtypes=COV_COLUMN_DTYPES,
+        metric="normalized_coverage",
+        layout="long",
+        engine="auto",
+        match="exact",
+        full_scan=False,
+        index=False,
+        index_dir=None,
+        cache_dir=None,
+        cache_size=2048,
+        cohort_dir=None,
+        cohort_formats=COHORT_FORMATS,
+        run=None,
+        sample_csv=True,
+        profile=None,
+        cprofile_dir=None,
+        prefetch_threads=0,
+        prefetch_budget=512,
+        incremental=False,
+        exons=None,
+        min_exons=2,
+        min_flank=2,
+        baseline=None,
+        baseline_out=None,
+        stdin_sample_id="stdin",
+        stdout_format=None,
+        serve=None,
+        db=None,
+    ):
+
+        # store arguments
+        try:
+            self.file = file if file == STDIN else os.path.abspath(file)
+        except Exception:
+            self.file = file
+        try:
+            self.batch = os.path.abspath(batch)
+        except Exception:
+            self.batch = batch
+        try:
+            self.intervals = os.path.abspath(intervals)
+        except Exception:
+            self.intervals = intervals
+        self.dup_threshold = dup_threshold
+        self.out_dir = os.path.abspath(out_dir)
+        self.out_fname_suffix = out_fname_suffix
+        self.processes = int(processes)
+        # use the cores available as number of processes if value not given
+        if self.processes == 0:
+            self.processes = self._available_cores()
+        self.memory_budget = memory_budget
+        self.schedule = schedule
+        self.schedule_stats = None
+        self.shard = tuple(shard) if shard else None
+        self.cov_file_pattern = cov_file_pattern
+        self.include = include
+        self.exclude = exclude
+        self.symlinks = symlinks
+        self.column_dtypes = column_dtypes
+        # a single metric is kept as its name, several are read together
+        self.metrics = self._metric_columns(metric)
+        self.metric = (
+            self.metrics[0] if len(self.metrics) == 1 else self.metrics
+        )
+        self.layout = layout
+        self.engine = engine
+        self.match = match
+        self.full_scan = full_scan
+        self.index = index
+        self.index_dir = index_dir
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        try:
+            self.cohort_dir = os.path.abspath(cohort_dir)
+        except Exception:
+            self.cohort_dir = cohort_dir
+        self.cohort_formats = cohort_formats
+        self.run = run
+        self.sample_csv = sample_csv and not stdout_format
+        self.profile = profile
+        self.cprofile_dir = cprofile_dir
+        self.prefetch_threads = prefetch_threads
+        self.prefetch_budget = prefetch_budget
+        self.incremental = incremental
+        self.exons = exons
+        self.min_exons = min_exons
+        self.min_flank = min_flank
+        self.baseline = baseline
+        self.baseline_out = baseline_out
+        self.baseline_data = None
+        self.db = db
+        self.stdin_sample_id = stdin_sample_id
+        self.stdout_format = stdout_format
+        self.serve = serve
+        # guards reloading the plan and baseline while serving
+        self.plan_lock = threading.Lock()
+        self.profiler = StageProfiler()
+        # results written to stdout are kept apart from the logs
+        self.stdout = sys.stdout
+        if self.stdout_format:
+            with contextlib.redirect_stdout(sys.stderr):
+                self._run(batch)
+        else:
+            self._run(batch)
+
+    def _run(self, batch):
+        """ Method to process the coverage file, batch or requests the
+        instance was created for.
+        :param: batch: Path to batch directory, as given
+        """
+        main_cprofile = None
+        if self.cprofile_dir:
+            main_cprofile = StageProfiler.start_cprofile(
+                self.cprofile_dir, "main"
+            )
+
+        # print error if neither file or batch given
+        if not (self.file or self.batch or self.serve):
+            sys.stderr.write(
+                "[{0}] Error: File or batch folder not specified!".format(
+                    datetime.now()
+                )
+            )
+            sys.exit()
+
+        # exon scans and baselines are of a single metric
+        if len(self.metrics) > 1 and (
+            self.exons or self.baseline or self.baseline_out
+        ):
+            sys.stderr.write(
+                "[{0}] Error: Exon scans and baselines use a single metric, "
+                "not {1}! Exiting...!".format(
+                    datetime.now(), ", ".join(self.metrics)
+                )
+            )
+            sys.exit()
+
+        # baselines summarise the whole panel of normals at once
+        if self.shard and self.baseline_out:
+            sys.stderr.write(
+                "[{0}] Error: Baselines can't be built in shards! "
+                "Exiting...!".format(datetime.now())
+            )
+            sys.exit()
+
+        # prefetching reads all a worker would, so only the indexed chroms
+        # or whole files read to the end
+        if self.prefetch_threads and not (self.index or self.full_scan):
+            sys.stderr.write(
+                "[{0}] Error: Prefetching needs the index or a full scan! "
+                "Exiting...!".format(datetime.now())
+            )
+            sys.exit()
+
+        # parse interval file once to compile which regions we want to
+        # process, before any coverage file is read
+        try:
+            with self.profiler.stage("import_intervals") as counts:
+                if self.exons:
+                    self.plan = IntervalPlan.from_exon_catalog(
+                        self._import_exon_catalog(
+                            beds=self.exons,
+                            min_exons=self.min_exons,
+                            min_flank=self.min_flank,
+                        )
+                    )
+                    counts["rows"] = len(self.plan.regions)
+                    counts["bytes"] = sum(
+                        os.path.getsize(bed) for bed in self.exons
+                    )
+                else:
+                    self.plan = IntervalPlan.from_intervals(
+                        self._import_intervals(
+                            intervals=self.intervals,
+                            dup_threshold=self.dup_threshold,
+                        )
+                    )
+                    counts["rows"] = len(self.plan.pairs)
+                    counts["bytes"] = os.path.getsize(self.intervals)
+        except Exception as e:
+            sys.stderr.write("{0}\n".format(str(e)))
+            sys.stderr.write(
+                "[{0}] Error: {1} interval file wrong format! Exiting...!"
+                .format(
+                    datetime.now(),
+                    ", ".join(
+                        os.path.basename(str(fname))
+                        for fname in (self.exons or [self.intervals])
+                    ),
+                )
+            )
+            sys.exit()
+
+        # load the baseline before reading any coverage file, so a baseline
+        # of other intervals or metric fails straight away
+        if self.baseline:
+            try:
+                self.baseline_data = self._load_baseline(
+                    self.baseline, plan=self.plan, metric=self.metric
+                )
+            except Exception as e:
+                sys.stderr.write("{0}\n".format(str(e)))
+                sys.stderr.write(
+                    "[{0}] Error: {1} baseline can't be used! Exiting...!"
+                    .format(datetime.now(), os.path.basename(self.baseline))
+                )
+                sys.exit()
+        self.plan_mtimes = self._plan_mtimes()
+
+        # answer requests until interrupted
+        if self.serve:
+            self._serve()
+            return
+
+        # process a single file
+        if self.file:
+            # check and process the file
+            self.results = [
+                self._process_file(
+                    file=self.file, plan=self.plan, out_dir=self.out_dir
+                )
+            ]
+
+        # process a batch of files
+        else:
+            # find the coverage files, handing each to the workers as soon
+            # as it is found
+            discovery = {}
+            files = self._iter_coverage_files(
+                batch_dir=batch,
+                cov_file_pattern=self.cov_file_pattern,
+                include=self.include,
+                exclude=self.exclude,
+                symlinks=self.symlinks,
+                stats=discovery,
+            )
+            if self.shard:
+                files = self._shard_files(files, batch, self.shard)
+            if self.incremental or self.schedule == "size":
+                # the whole batch is found first, to check it against the
+                # manifest and schedule it by size
+                files = list(files)
+                self._record_discovery(discovery)
+                self.results = []
+                if self.incremental:
+                    # reuse the results of files unchanged since the last run
+                    self.results, files = self._reuse_unchanged(
+                        files, self._load_manifest(self.out_dir)
+                    )
+                if files:
+                    self.results.extend(self._process_batch(files))
+            else:
+                self.results = self._process_batch(files)
+                self._record_discovery(discovery)
+
+        if self.baseline_out:
+            # summarise the normals instead of scoring them
+            self._write_baseline(self.results, self.baseline_out)
+            results_df = pd.DataFrame()
+        elif self.exons:
+            # scan the exons of every gene of all samples at once
+            results_df = self._scan_results(
+                self.results, plan=self.plan, out_dir=self.out_dir
+            )
+        else:
+            # compare the intervals of all samples at once
+            results_df = self._score_results(
+                self.results, plan=self.plan, out_dir=self.out_dir
+            )
+
+        if self.stdout_format:
+            self._write_stdout(results_df)
+        # let whatever writes to stdin finish
+        if self.file == STDIN:
+            self._drain_stdin()
+
+        if self.db and not (self.exons or self.baseline_out):
+            self._write_db(self.results)
+
+        if self.shard and not self.file:
+            self._write_shard(self.results, results_df, discovery)
+
+        if self.incremental and not self.file:
+            self._write_manifest(self.results)
+
+        # combine the results of all samples straight from the workers, or
+        # once all shards are merged
+        if self.cohort_dir and self.shard and not self.file:
+            print(
+                "[{0}] Cohort tables of shard {1}/{2} are written by the "
+                "merge subcommand".format(datetime.now(), *self.shard)
+            )
+        elif self.cohort_dir:
+            for cohort_format in self.cohort_formats:
+                with self.profiler.stage(
+                    "write_cohort_{0}".format(cohort_format)
+                ) as counts:
+                    try:
+                        fnames = self._write_cohort(
+                            results_df,
+                            cohort_dir=self.cohort_dir,
+                            cohort_formats=[cohort_format],
+                            run=self.run,
+                            sample_ids=[
+                                record["sample_id"]
+                                for record in self.results
+                                if record["error"] is None
+                            ],
+                        )
+                    except (IOError, OSError, ValueError) as e:
+                        sys.stderr.write("{0}\n".format(str(e)))
+                        sys.stderr.write(
+                            "[{0}] Error: Cohort tables can't be written! "
+                            "Exiting...!\n".format(datetime.now())
+                        )
+                        sys.exit(1)
+                    counts["rows"] = len(results_df)
+                    counts["bytes"] = sum(
+                        os.path.getsize(fname) for fname in fnames
+                    )
+
+        if main_cprofile is not None:
+            StageProfiler.stop_cprofile(main_cprofile)
+        if self.profile:
+            self._write_profile(self.profile)
+
+    def __getstate__(self):
+        """ Only send workers the settings and interval plan they need, not
+        the results of the parent process. """
+        state = self.__dict__.copy()
+        state.pop("results", None)
+        state.pop("baseline_data", None)
+        state.pop("plan_lock", None)
+        state.pop("stdout", None)
+        return state
+
+    @classmethod
+    def _load_manifest(cls, out_dir):
+        """ Method to load the manifest of the files processed by earlier
+        incremental runs.
+        :param: out_dir: Output directory the manifest is kept in
+        :returns: Dictionary of file path to manifest entry, empty if there
+                    is no manifest or it can't be read
+        """
+        try:
+            with open(os.path.join(out_dir, MANIFEST_FNAME)) as json_file:
+                manifest = json.load(json_file)
+            if manifest["version"] == MANIFEST_VERSION:
+                return manifest["files"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        return {}
+
+    def _reuse_unchanged(self, files, manifest):
+        """ Method to split a batch into files unchanged since they were
+        processed with the same intervals, metric, match mode and baseline,
+        and files to process.
+        :param: files: List of paths to coverage files
+        :param: manifest: Dictionary from _load_manifest
+        :returns: Tuple of the list of result records of unchanged files and
+                    the list of files to process
+        """
+        digest = self.plan.digest
+        baseline = self._baseline_digest()
+        reused = []
+        changed = []
+        for file in files:
+            entry = manifest.get(os.path.abspath(file))
+            try:
+                stat = os.stat(file)
+            except OSError:
+                entry = None
+            if (
+                entry is None
+                or entry["size"] != stat.st_size
+                or entry["mtime"] != stat.st_mtime
+                or entry["plan"] != digest
+                or entry["metric"] != self.metric
+                or entry.get("match", "exact") != self.match
+                or entry.get("baseline") != baseline
+            ):
+                changed.append(file)
+                continue
+            reused.append({
+                "file": file,
+                "sample_id": self._get_sample_id(
+                    file=file, cov_file_pattern=self.cov_file_pattern
+                ),
+                "values": entry["values"],
+                "fname": entry["fname"],
+                "columns": [],
+                "rows": [],
+                "error": None,
+                "pid": os.getpid(),
+                "stages": {},
+                "reused": True,
+            })
+        print(
+            "[{0}] Reusing results of {1} unchanged file(s), processing {2} "
+            "new or changed file(s)".format(
+                datetime.now(), len(reused), len(changed)
+            )
+        )
+
+        return reused, changed
+
+    def _write_manifest(self, records):
+        """ Method to write the manifest of the files processed without
+        errors, for the next incremental run.
+        :param: records: List of result records
+        """
+        digest = self.plan.digest
+        baseline = self._baseline_digest()
+        files = {}
+        for record in records:
+            if record["error"] is not None:
+                continue
+            stat = os.stat(record["file"])
+            files[os.path.abspath(record["file"])] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "plan": digest,
+                "metric": self.metric,
+                "match": self.match,
+                "baseline": baseline,
+                "sample_id": record["sample_id"],
+                "values": [
+                    value.item() if hasattr(value, "item") else value
+                    for value in record["values"]
+                ],
+                "fname": record["fname"],
+            }
+        fname = os.path.join(self.out_dir, MANIFEST_FNAME)
+        # write then rename so an interrupted run leaves the old manifest
+        tmp_fname = "{0}.{1}.tmp".format(fname, os.getpid())
+        with open(tmp_fname, "w") as json_file:
+            json.dump(
+                {"version": MANIFEST_VERSION, "files": files}, json_file
+            )
+        os.rename(tmp_fname, fname)
+
+    def _write_profile(self, fname):
+        """ Method to write the profile report of the run.
+        :param: fname: Path to write the json report to
+        """
+        report = self.profiler.report(
+            self.results,
+            file=self.file,
+            batch=self.batch,
+            metric=self.metric,
+            engine=self.engine,
+            match=self.match,
+            processes=self.processes,
+            cache=bool(self.cache_dir),
+            index=self.index,
+            n_files=len(self.results),
+            scheduler=self.schedule_stats,
+        )
+        with open(fname, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+        print("[{0}] Profile written to {1}".format(datetime.now(), fname))
+
+    def _process_batch(self, files):
+        """ Method to process a batch of coverage files in parallel.
+        :param: files: List of paths to coverage files, scheduled largest
+                        first with the size schedule, or a generator of paths
+                        handed to the workers as they are found
+        :returns: List of result records, as returned by _process_file, in
+                    order of completion
+        """
+        if isinstance(files, list):
+            tasks = [(file, self._file_cost(file)) for file in files]
+            if self.schedule == "size":
+                # the longest files first, so none is left to run alone at
+                # the end of the batch
+                tasks.sort(key=lambda task: (-task[1], task[0]))
+            workers = self._scheduler_workers(
+                [cost for file, cost in tasks]
+            )
+        else:
+            tasks = ((file, self._file_cost(file)) for file in files)
+            workers = self._scheduler_workers()
+
+        # workers are sent this instance, with the compiled interval plan,
+        # once when the pool starts rather than with every file
+        pool = ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(self,)
+        )
+        try:
+            results = self._dispatch(
+                pool, tasks, workers, self.prefetch_threads > 0
+            )
+        finally:
+            pool.shutdown()
+
+        return results
+
+    @classmethod
+    def _available_cores(cls):
+        """ Method to return the number of cores this process can run on,
+        which can be fewer than the cpu count in a container. """
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return mp.cpu_count()
+
+    @classmethod
+    def _file_cost(cls, file):
+        """ Method to estimate the bytes of memory a coverage file takes
+        while it is processed, from its size.
+        :param: file: Path to coverage file
+        :returns: Bytes, 0 if the file can't be stat'ed (its worker reports
+                    the error)
+        """
+        try:
+            size = os.path.getsize(file)
+        except OSError:
+            return 0
+        if file.endswith(tuple(COMPRESSED_SUFFIXES)):
+            size *= COMPRESSION_RATIO
+
+        return size
+
+    def _scheduler_workers(self, costs=None):
+        """ Method to pick the number of worker processes of a batch from the
+        cores, the memory budget and the files.
+        :param: costs: List of the estimated bytes of each file, if known
+        :returns: Number of workers
+        """
+        workers = self.processes
+        if costs:
+            # as many workers as files of the median size fit the budget
+            if self.memory_budget:
+                workers = min(workers, max(
+                    1,
+                    int(self.memory_budget * 1024 * 1024
+                        // max(1, np.median(costs))),
+                ))
+            workers = min(workers, len(costs))
+
+        return max(1, workers)
+
+    def _dispatch(self, pool, tasks, workers, prefetch=False):
+        """ Method to hand coverage files to the workers in order, one per
+        idle worker and within the memory budget, and report the schedule
+        once they are all processed. Stops handing out files if a worker
+        fails or dies, rather than waiting for it.
+        :param: pool: ProcessPoolExecutor from _process_batch
+        :param: tasks: Iterable of (file, estimated bytes)
+        :param: workers: Number of workers in the pool
+        :param: prefetch: Read upcoming files into memory with a thread pool
+                        while the workers process others
+        :returns: List of result records in order of completion
+        """
+        budget = PrefetchBudget(
+            self.memory_budget * 1024 * 1024 or float("inf")
+        )
+        if prefetch:
+            # files are read ahead in schedule order, and released once
+            # their worker returns
+            prefetched = PrefetchBudget(self.prefetch_budget * 1024 * 1024)
+            tasks = self._prefetch_files(tasks, prefetched)
+        else:
+            prefetched = None
+            tasks = ((file, cost, None) for file, cost in tasks)
+        results = []
+        errors = []
+        started = {}
+        stats = collections.OrderedDict([
+            ("schedule", self.schedule),
+            ("workers", workers),
+            ("memory_budget_mb", self.memory_budget or None),
+            ("files", 0),
+            ("mb", 0.0),
+            ("largest_mb", 0.0),
+            ("peak_mb", 0.0),
+            ("peak_files", 0),
+            ("budget_waits", 0),
+            ("max_queued_s", 0.0),
+            ("busy_s", 0.0),
+            ("wall_s", 0.0),
+            ("utilisation", None),
+        ])
+        start = time.perf_counter()
+
+        def finish(file, future):
+            # called by the pool's management thread, also with the error
+            # of every file in flight if a worker dies
+            with budget.condition:
+                stats["busy_s"] += time.perf_counter() - started.pop(file)
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    errors.append((file, e))
+                budget.release(file)
+            if prefetched is not None:
+                prefetched.release(file)
+
+        for file, cost, data in tasks:
+            with budget.condition:
+                waited = False
+                # wait for an idle worker and room in the budget
+                while not errors and (
+                    len(budget.in_flight) >= workers
+                    or not budget.try_acquire(file, cost)
+                ):
+                    if len(budget.in_flight) < workers:
+                        waited = True
+                    budget.condition.wait()
+                if errors:
+                    break
+                stats["budget_waits"] += waited
+                started[file] = time.perf_counter()
+                stats["max_queued_s"] = max(
+                    stats["max_queued_s"], started[file] - start
+                )
+                stats["peak_files"] = max(
+                    stats["peak_files"], len(budget.in_flight)
+                )
+            stats["files"] += 1
+            stats["largest_mb"] = max(stats["largest_mb"], cost / 1048576.0)
+            try:
+                if prefetch:
+                    future = pool.submit(
+                        _process_prefetched_worker, (file, data)
+                    )
+                else:
+                    future = pool.submit(_process_worker, file)
+            except BrokenProcessPool as e:
+                # a worker died before its files were reported
+                future = Future()
+                future.set_exception(e)
+            future.add_done_callback(functools.partial(finish, file))
+        # stop reading ahead if the batch stopped early
+        tasks.close()
+        with budget.condition:
+            while budget.in_flight:
+                budget.condition.wait()
+        if errors:
+            file, error = errors[0]
+            if isinstance(error, BrokenProcessPool):
+                sys.stderr.write(
+                    "[{0}] Error: A worker stopped unexpectedly, e.g. killed "
+                    "when out of memory, while processing {1}\n".format(
+                        datetime.now(),
+                        ", ".join(sorted(file for file, e in errors)),
+                    )
+                )
+            raise error
+        if prefetch:
+            print(
+                "[{0}] Prefetched {1} file(s), {2:.1f} MB, at most {3:.1f} "
+                "MB in memory".format(
+                    datetime.now(),
+                    prefetched.files,
+                    prefetched.bytes / 1024.0 / 1024,
+                    prefetched.peak / 1024.0 / 1024,
+                )
+            )
+
+        stats["mb"] = budget.bytes / 1048576.0
+        stats["peak_mb"] = budget.peak / 1048576.0
+        stats["wall_s"] = time.perf_counter() - start
+        if stats["wall_s"] > 0:
+            stats["utilisation"] = stats["busy_s"] / (
+                workers * stats["wall_s"]
+            )
+        self.schedule_stats = stats
+        self._report_schedule(stats)
+
+        return results
+
+    @classmethod
+    def _report_schedule(cls, stats):
+        """ Method to log the queue and worker stats of a batch.
+        :param: stats: Dictionary of stats from _dispatch
+        """
+        print(
+            "[{0}] Processed {1} file(s), {2:.1f} MB, {3} on {4} worker(s)"
+            "{5}: at most {6:.1f} MB and {7} file(s) in flight, {8} held "
+            "back by the budget, the last started after {9:.2f}s, workers "
+            "busy {10:.0%} of {11:.2f}s".format(
+                datetime.now(),
+                stats["files"],
+                stats["mb"],
+                "largest first" if stats["schedule"] == "size"
+                else "as found",
+                stats["workers"],
+                "" if stats["memory_budget_mb"] is None
+                else " within {0} MB".format(stats["memory_budget_mb"]),
+                stats["peak_mb"],
+                stats["peak_files"],
+                stats["budget_waits"],
+                stats["max_queued_s"],
+                stats["utilisation"] or 0.0,
+                stats["wall_s"],
+            )
+        )
+
+    def _prefetch_files(self, tasks, budget):
+        """ Method to read coverage files ahead with a thread pool, within
+        the prefetch budget.
+        :param: tasks: Iterable of (file, estimated bytes), in the order the
+                        files are handed to the workers
+        :param: budget: PrefetchBudget released by _dispatch as each worker
+                        returns
+        :returns: Generator of (file, estimated bytes, data) tuples in the
+                    order of tasks, where data is None if the file couldn't
+                    be read
+        """
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.prefetch_threads) as executor:
+            for file, cost in tasks:
+                try:
+                    size = os.path.getsize(file)
+                except OSError:
+                    size = 0
+                # hand out files already read until there is room, or wait
+                # for the workers if all reserved files are with them
+                while not budget.try_acquire(file, size):
+                    if pending:
+                        yield self._prefetched(pending.popleft(), budget)
+                    else:
+                        budget.wait()
+                pending.append((
+                    file,
+                    cost,
+                    executor.submit(self._read_coverage_bytes, file),
+                ))
+                while pending and pending[0][2].done():
+                    yield self._prefetched(pending.popleft(), budget)
+            while pending:
+                yield self._prefetched(pending.popleft(), budget)
+
+    @classmethod
+    def _prefetched(cls, item, budget):
+        """ Method to wait for a prefetched file.
+        :param: item: Tuple of file, estimated bytes and read future
+        :param: budget: PrefetchBudget the file was reserved in
+        :returns: Tuple of file, estimated bytes and data, where data is None
+                    if the file couldn't be read so the worker reports the
+                    error
+        """
+        file, cost, future = item
+        try:
+            data = future.result()
+        except (OSError, EOFError, ValueError, zlib.error):
+            return file, cost, None
+        # decompressed files take more memory than reserved for them
+        budget.resize(file, len(data))
+
+        return file, cost, data
+
+    def _read_coverage_bytes(self, file):
+        """ Method to read what the workers need of a coverage file into
+        memory: the indexed chroms if using the index, or the whole file,
+        decompressed, for a full scan.
+        :param: file: Path to coverage file
+        :returns: Bytes
+        """
+        # a cache miss parses the whole file
+        if self.index and not self.cache_dir:
+            return self._indexed_source(
+                file, self.plan.region_set, self.index_dir
+            )
+        # compressed files are decompressed here, off the workers
+        with self._open_coverage(file) as cov_file:
+            return cov_file.read()
+
+    @classmethod
+    def _write_cohort(
+        cls, cohort_df, cohort_dir, cohort_formats, run=None, sample_ids=None
+    ):
+        """ Method to write the combined results of a batch.
+        :param: cohort_df: Pandas dataframe from _score_results
+        :param: cohort_dir: Directory to write to
+        :param: cohort_formats: List of formats to write (csv and/or xlsx)
+        :param: run: Name of run to prefix the files with
+        :param: sample_ids: Sample id of every coverage file in the table
+                            (default is the sample_id column, for tables
+                            with a row per sample)
+        :returns: List of files written
+        """
+        # check df has no duplicate results, as
+        # generate_comparison_csv_to_xls.py did
+        if sample_ids is None:
+            sample_ids = cohort_df.get("sample_id", [])
+        duplicates = sorted({
+            sample_id for sample_id, n in
+            collections.Counter(sample_ids).items() if n > 1
+        })
+        if duplicates:
+            raise ValueError(
+                "Cohort table has duplicate sample ids: {0}".format(
+                    ", ".join(duplicates)
+                )
+            )
+
+        if not os.path.isdir(cohort_dir):
+            os.makedirs(cohort_dir)
+        fnames = []
+        for cohort_format in cohort_formats:
+            fname = os.path.join(
+                cohort_dir,
+                "{0}{1}".format(
+                    "{0}_".format(run) if run else "",
+                    COHORT_FNAMES[cohort_format],
+                ),
+            )
+            if cohort_format == "csv":
+                cohort_df.to_csv(fname, index=False)
+            else:
+                # calls are written as True/False, as they are when the
+                # per-sample files are read back in to make the xlsx
+                xlsx_df = cohort_df.copy()
+                if "above_cut_off" in xlsx_df:
+                    xlsx_df["above_cut_off"] = xlsx_df["above_cut_off"].map(
+                        {"TRUE": "True", "FALSE": "False"}
+                    )
+                xlsx_df.to_excel(fname, index=False, header=True)
+            print("[{0}] Cohort written to {1}".format(datetime.now(), fname))
+            fnames.append(fname)
+
+        return fnames
+
+    @classmethod
+    def _shard_of(cls, path, n_shards):
+        """ Method to return the shard of a coverage file, from a hash of its
+        path that is the same on every node and python process.
+        :param: path: Path of the file within the batch folder
+        :param: n_shards: Number of shards
+        :returns: Shard number, from 1
+        """
+        digest = hashlib.sha1(path.replace(os.sep, "/").encode()).digest()
+
+        return int.from_bytes(digest[:8], "big") % n_shards + 1
+
+    @classmethod
+    def _shard_files(cls, files, batch_dir, shard):
+        """ Method to keep the coverage files of one shard of a batch.
+        :param: files: Iterable of paths to coverage files
+        :param: batch_dir: Path to the batch folder
+        :param: shard: Tuple of the shard number (from 1) and number of
+                        shards
+        :returns: Generator of the paths of the shard's files
+        """
+        index, n_shards = shard
+        for file in files:
+            if cls._shard_of(
+                os.path.relpath(file, batch_dir), n_shards
+            ) == index:
+                yield file
+
+    def _write_shard(self, records, results_df, discovery):
+        """ Method to write the results of a shard of a batch, with what
+        merge_shards needs to check it belongs with the other shards.
+        :param: records: List of result records of the shard's files
+        :param: results_df: Pandas dataframe of the shard's results
+        :param: discovery: Dictionary of stats from _iter_coverage_files
+        """
+        def plain(value):
+            # json has no numpy types or nan
+            value = value.item() if hasattr(value, "item") else value
+            if isinstance(value, float) and np.isnan(value):
+                return None
+            return value
+
+        files = []
+        for record in sorted(
+            records, key=lambda record: (
+                self._result_key(record), record["file"]
+            )
+        ):
+            files.append(collections.OrderedDict([
+                ("file", os.path.relpath(record["file"], self.batch)),
+                ("sample_id", record["sample_id"]),
+                ("key", self._result_key(record)),
+                ("error", record["error"]),
+                ("rows", [
+                    [plain(value) for value in row]
+                    for row in record["rows"]
+                ]),
+            ]))
+        shard = collections.OrderedDict([
+            ("version", SHARD_VERSION),
+            ("shard", self.shard[0]),
+            ("shards", self.shard[1]),
+            ("plan", self.plan.digest),
+            ("metric", self.metric),
+            ("layout", self.layout),
+            ("match", self.match),
+            ("exons", bool(self.exons)),
+            ("baseline", self._baseline_digest()),
+            ("run", self.run),
+            ("batch", self.batch),
+            ("files_found", discovery.get("files")),
+            ("created", datetime.now().isoformat()),
+            ("columns", results_df.columns.tolist()),
+            ("dtypes", [str(dtype) for dtype in results_df.dtypes]),
+            ("files", files),
+        ])
+        fname = os.path.join(
+            self.out_dir,
+            "{0}{1}".format(
+                "{0}_".format(self.run) if self.run else "",
+                SHARD_FNAME.format(*self.shard),
+            ),
+        )
+        # write then rename so a merge never reads half a shard
+        tmp_fname = "{0}.{1}.tmp".format(fname, os.getpid())
+        with open(tmp_fname, "w") as json_file:
+            json.dump(shard, json_file)
+        os.rename(tmp_fname, fname)
+        print(
+            "[{0}] Shard {1}/{2} of {3} of the {4} coverage file(s) found "
+            "written to {5}".format(
+                datetime.now(), self.shard[0], self.shard[1], len(files),
+                discovery.get("files"), fname,
+            )
+        )
+
+    @classmethod
+    def merge_shards(cls, partials):
+        """ Method to combine the results of every shard of a batch into the
+        results of the whole batch, as if it was processed at once.
+        :param: partials: List of paths to shard results from _write_shard
+        :returns: Tuple of the pandas dataframe of the results of all
+                    samples, the run name of the shards, the list of files
+                    that couldn't be processed and the list of the sample id
+                    of every file in the results
+        """
+        shards = []
+        for fname in partials:
+            with open(fname) as json_file:
+                shard = json.load(json_file)
+            if shard.get("version") != SHARD_VERSION:
+                raise ValueError(
+                    "{0} is not a shard of version {1}".format(
+                        fname, SHARD_VERSION
+                    )
+                )
+            shards.append(shard)
+        if not shards:
+            raise ValueError("No shards given")
+
+        # every shard has to be of the same batch, processed the same way
+        errors = []
+        for key in [
+            "shards", "plan", "metric", "layout", "match", "exons",
+            "baseline", "run",
+        ]:
+            values = sorted({json.dumps(shard[key]) for shard in shards})
+            if len(values) > 1:
+                errors.append(
+                    "Shards have different {0}: {1}".format(
+                        key, ", ".join(values)
+                    )
+                )
+        n_shards = max(shard["shards"] for shard in shards)
+        found = collections.Counter(shard["shard"] for shard in shards)
+        missing = sorted(set(range(1, n_shards + 1)).difference(found))
+        if missing:
+            errors.append(
+                "Missing shard(s) {0} of {1}".format(
+                    ", ".join(str(index) for index in missing), n_shards
+                )
+            )
+        repeated = sorted(index for index, n in found.items() if n > 1)
+        if repeated:
+            errors.append(
+                "Shard(s) {0} given more than once".format(
+                    ", ".join(str(index) for index in repeated)
+                )
+            )
+        tables = {
+            json.dumps([shard["columns"], shard["dtypes"]])
+            for shard in shards if shard["columns"]
+        }
+        if len(tables) > 1:
+            errors.append("Shards have different result columns")
+        if errors:
+            raise ValueError("\n".join(errors))
+
+        files = sorted(
+            (file for shard in shards for file in shard["files"]),
+            key=lambda file: file["key"],
+        )
+        failed = [file["file"] for file in files if file["error"]]
+        sample_ids = [
+            file["sample_id"] for file in files if not file["error"]
+        ]
+        if not tables:
+            return pd.DataFrame(), shards[0]["run"], failed, sample_ids
+        columns, dtypes = json.loads(tables.pop())
+        results_df = pd.DataFrame(
+            [row for file in files for row in file["rows"]],
+            columns=columns,
+        ).astype(dict(zip(columns, dtypes)))
+
+        return results_df, shards[0]["run"], failed, sample_ids
+
+    @classmethod
+    def _cov_file_patterns(cls, cov_file_pattern):
+        """ Method to return the coverage file suffixes as a list.
+        :param: cov_file_pattern: Filename suffix or list of suffixes
+        :returns: List of suffixes
+        """
+        if isinstance(cov_file_pattern, str):
+            return [cov_file_pattern]
+
+        return list(cov_file_pattern)
+
+    def _write_db(self, records):
+        """ Method to add the results of the run to the SQLite database, in
+        a single transaction. Results of a sample already stored for the
+        run, pair and metric are replaced. Runs without a name are stored
+        under a new run id of the UTC time and intervals hash.
+        :param: records: List of result records
+        """
+        plan = self.plan
+        digest = plan.digest
+        created = datetime.now().isoformat()
+        run = self.run or "{0}_{1}".format(
+            datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ"),
+            digest[:8],
+        )
+        records = [record for record in records if record["error"] is None]
+        rows = []
+        for metric, metric_plan, matrix in self._metric_matrices(
+            [record["values"] for record in records], plan, self.metric
+        ):
+            if not records:
+                break
+            fold_change, log2_fold_change, above_cut_off = (
+                self._compare_metric_matrix(matrix, metric_plan)
+            )
+            z_score = p_value = np.full(fold_change.shape, np.nan)
+            if self.baseline_data is not None:
+                _, z_score, p_value = self._baseline_scores(
+                    matrix, fold_change, self.baseline_data
+                )
+            for i, record in enumerate(records):
+                for p, pair in enumerate(plan.pairs):
+                    value1 = matrix[i, plan.region1_columns[p]]
+                    value2 = matrix[i, plan.region2_columns[p]]
+                    rows.append((
+                        run,
+                        record["sample_id"],
+                        None if record["file"] == STDIN
+                        else os.path.abspath(record["file"]),
+                        pair.name1,
+                        pair.name2,
+                        "{0}:{1}-{2}".format(*pair.region1),
+                        "{0}:{1}-{2}".format(*pair.region2),
+                        metric,
+                        value1.item(),
+                        value2.item(),
+                        float(fold_change[i, p]),
+                        float(log2_fold_change[i, p]),
+                        metric_plan.thresholds[p],
+                        int(above_cut_off[i, p]),
+                        # sqlite stores nan as null
+                        float(z_score[i, p]),
+                        float(p_value[i, p]),
+                        digest,
+                        created,
+                    ))
+
+        with self.profiler.stage("write_db") as counts:
+            connection = self._connect_db(self.db)
+            try:
+                # one transaction for the whole run
+                with connection:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO results ({0}) VALUES ({1})"
+                        .format(
+                            ", ".join(DB_COLUMNS),
+                            ", ".join("?" * len(DB_COLUMNS)),
+                        ),
+                        rows,
+                    )
+            finally:
+                connection.close()
+            counts["rows"] = len(rows)
+        print(
+            "[{0}] {1} result(s) added to {2} as run {3}".format(
+                datetime.now(), len(rows), self.db, run
+            )
+        )
+
+    @classmethod
+    def _connect_db(cls, db):
+        """ Method to open the results database, creating its tables and
+        indexes if they don't exist.
+        :param: db: Path to SQLite database
+        :returns: sqlite3 connection
+        """
+        connection = sqlite3.connect(db)
+        with connection:
+            for statement in DB_SCHEMA:
+                connection.execute(statement)
+            version = connection.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+            if version is None:
+                connection.execute(
+                    "INSERT INTO meta VALUES ('version', ?)", (DB_VERSION,)
+                )
+            elif int(version[0]) != DB_VERSION:
+                connection.close()
+                raise ValueError(
+                    "Results database version {0} is not supported".format(
+                        version[0]
+                    )
+                )
+
+        return connection
+
+    @classmethod
+    def query_db(
+        cls, db, runs=None, last_runs=None, samples=None, pair=None,
+        metric=None, plan=None, calls_only=False,
+    ):
+        """ Method to read filtered results from the results database.
+        :param: db: Path to SQLite database written with --db
+        :param: runs: List of runs to keep
+        :param: last_runs: Keep the N runs most recently added
+        :param: samples: List of globs of sample ids to keep
+        :param: pair: (name1, name2) of the interval pair to keep
+        :param: metric: Metric to keep
+        :param: plan: Intervals plan hash to keep
+        :param: calls_only: Only keep results above the cut off
+        :returns: Pandas dataframe of results, oldest first
+        """
+        where = []
+        params = []
+        if runs:
+            where.append("run IN ({0})".format(", ".join("?" * len(runs))))
+            params.extend(runs)
+        if last_runs:
+            where.append(
+                "run IN (SELECT run FROM results GROUP BY run "
+                "ORDER BY MAX(created) DESC LIMIT ?)"
+            )
+            params.append(last_runs)
+        if samples:
+            where.append("({0})".format(
+                " OR ".join(["sample_id GLOB ?"] * len(samples))
+            ))
+            params.extend(samples)
+        if pair:
+            where.append("name1 = ? AND name2 = ?")
+            params.extend(pair)
+        if metric:
+            where.append("metric = ?")
+            params.append(metric)
+        if plan:
+            where.append("plan = ?")
+            params.append(plan)
+        if calls_only:
+            where.append("above_cut_off = 1")
+
+        connection = cls._connect_db(db)
+        try:
+            results_df = pd.read_sql_query(
+                "SELECT {0} FROM results{1} ORDER BY created, run, sample_id, "
+                "name1, name2".format(
+                    ", ".join(DB_COLUMNS),
+                    " WHERE " + " AND ".join(where) if where else "",
+                ),
+                connection,
+                params=params,
+            )
+        finally:
+            connection.close()
+        # calls as in the results files
+        results_df["above_cut_off"] = np.where(
+            results_df["above_cut_off"] == 1, "TRUE", "FALSE"
+        )
+
+        return results_df
+
+    @classmethod
+    def _find_coverage_files(
+        cls, batch_dir, cov_file_pattern, include=None, exclude=None,
+        symlinks="follow",
+    ):
+        """ Method to find coverage files in a directory.
+        :param: batch_dir: Path to batch directory
+        :param: cov_file_pattern: Filename suffix, or list of suffixes, to
+                                identify coverage files
+        :param: include: List of globs of coverage files to keep
+        :param: exclude: List of globs of coverage files to skip
+        :param: symlinks: Symlink policy, from SYMLINK_POLICIES
+        :returns: A list of coverage files found in given directory
+        """
+        stats = {}
+        coverage_files = list(cls._iter_coverage_files(
+            batch_dir,
+            cov_file_pattern,
+            include=include,
+            exclude=exclude,
+            symlinks=symlinks,
+            stats=stats,
+        ))
+        cls._report_discovery(stats)
+
+        return coverage_files
+
+    @classmethod
+    def _iter_coverage_files(
+        cls, batch_dir, cov_file_pattern, include=None, exclude=None,
+        symlinks="follow", stats=None,
+    ):
+        """ Generator walking a directory tree with os.scandir, yielding each
+        coverage file as soon as it is found. Folders are walked depth first
+        in name order, hidden files and folders are skipped as by glob, and
+        compressed (.gz/.bgz) coverage files are found as well.
+        :param: batch_dir: Path to batch directory
+        :param: cov_file_pattern: Filename suffix, or list of suffixes, to
+                                identify coverage files
+        :param: include: List of globs, only files whose path relative to
+                        batch_dir matches one are yielded
+        :param: exclude: List of globs of relative paths to skip
+        :param: symlinks: Follow symlinked files and folders ("follow"), only
+                        symlinked files ("files") or no symlinks ("skip")
+        :param: stats: Dictionary to record the folders and entries seen,
+                    files found, excluded and symlinks skipped, folders that
+                    couldn't be read, the seconds until the first file was
+                    found and the seconds spent walking
+        :returns: Generator of paths to coverage files
+        """
+        if stats is None:
+            stats = {}
+        stats.update({
+            "dirs": 0,
+            "entries": 0,
+            "files": 0,
+            "excluded": 0,
+            "symlinks_skipped": 0,
+            "errors": [],
+            "first_s": None,
+            "wall_s": 0.0,
+        })
+        print(
+            "[{0}] Finding coverage files in {1}".format(
+                datetime.now(), batch_dir
+            )
+        )
+        suffixes = tuple(
+            pattern + suffix
+            for pattern in cls._cov_file_patterns(cov_file_pattern)
+            for suffix in [""] + COMPRESSED_SUFFIXES
+        )
+        start = resumed = time.perf_counter()
+        # folders already walked, so symlink loops are walked once
+        walked = set()
+        dirs = [batch_dir]
+        while dirs:
+            dir_path = dirs.pop()
+            try:
+                dir_stat = os.stat(dir_path)
+                if (dir_stat.st_dev, dir_stat.st_ino) in walked:
+                    continue
+                walked.add((dir_stat.st_dev, dir_stat.st_ino))
+                with os.scandir(dir_path) as dir_entries:
+                    entries = sorted(dir_entries, key=lambda entry: entry.name)
+            except OSError as e:
+                stats["errors"].append(
+                    "{0}: {1}".format(dir_path, e.strerror or str(e))
+                )
+                continue
+            stats["dirs"] += 1
+            subdirs = []
+            for entry in entries:
+                stats["entries"] += 1
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    symlink = entry.is_symlink()
+                    if symlink and symlinks == "skip":
+                        stats["symlinks_skipped"] += 1
+                        continue
+                    if entry.is_dir():
+                        if symlink and symlinks == "files":
+                            stats["symlinks_skipped"] += 1
+                        else:
+                            subdirs.append(entry.path)
+                        continue
+                    if not (entry.name.endswith(suffixes) and entry.is_file()):
+                        continue
+                except OSError as e:
+                    stats["errors"].append(
+                        "{0}: {1}".format(entry.path, e.strerror or str(e))
+                    )
+                    continue
+                relpath = os.path.relpath(entry.path, batch_dir)
+                if (
+                    include and not any(
+                        fnmatch.fnmatch(relpath, pattern)
+                        for pattern in include
+                    )
+                ) or (
+                    exclude and any(
+                        fnmatch.fnmatch(relpath, pattern)
+                        for pattern in exclude
+                    )
+                ):
+                    stats["excluded"] += 1
+                    continue
+                stats["files"] += 1
+                if stats["first_s"] is None:
+                    stats["first_s"] = time.perf_counter() - start
+                # time spent by the consumer between files isn't counted
+                stats["wall_s"] += time.perf_counter() - resumed
+                yield entry.path
+                resumed = time.perf_counter()
+            # walk subfolders in name order
+            dirs.extend(reversed(subdirs))
+        stats["wall_s"] += time.perf_counter() - resumed
+
+    @classmethod
+    def _report_discovery(cls, stats):
+        """ Method to log the stats of finding coverage files, and every
+        folder that couldn't be read.
+        :param: stats: Dictionary of stats from _iter_coverage_files
+        """
+        for error in stats["errors"]:
+            sys.stderr.write(
+                "[{0}] Error: Couldn't read {1}\n".format(
+                    datetime.now(), error
+                )
+            )
+        print(
+            "[{0}] Found {1} coverage file(s) in {2} folder(s) of {3} "
+            "entries in {4:.3f}s ({5} excluded, {6} symlinks skipped, {7} "
+            "unreadable){8}".format(
+                datetime.now(),
+                stats["files"],
+                stats["dirs"],
+                stats["entries"],
+                stats["wall_s"],
+                stats["excluded"],
+                stats["symlinks_skipped"],
+                len(stats["errors"]),
+                "" if stats["first_s"] is None
+                else ", first after {0:.1f}ms".format(
+                    stats["first_s"] * 1000
+                ),
+            )
+        )
+
+    def _record_discovery(self, stats):
+        """ Method to log the stats of finding the coverage files of the
+        batch and add them to the profile, once they have all been found.
+        :param: stats: Dictionary of stats from _iter_coverage_files
+        """
+        self._report_discovery(stats)
+        self.profiler.merge(
+            self.profiler.stages,
+            "find_coverage_files",
+            {
+                "calls": 1,
+                "wall_s": stats["wall_s"],
+                "max_wall_s": stats["wall_s"],
+                # walked alongside the workers, so cpu time isn't separable
+                "cpu_s": 0.0,
+                "rows": stats["files"],
+                "bytes": 0,
+                "peak_rss_kb": resource.getrusage(
+                    resource.RUSAGE_SELF
+                ).ru_maxrss,
+            },
+        )
+
+    @classmethod
+    def _compression(cls, file):
+        """ Method to detect whether a coverage file is compressed from its
+        first bytes.
+        :param: file: Path to coverage file
+        :returns: "bgzf", "gzip" or None if not compressed
+        """
+        with open(file, "rb") as cov_file:
+            header = cov_file.read(12)
+            if header[:2] != GZIP_MAGIC:
+                return None
+            # BGZF blocks are gzip members with a BC extra subfield
+            if len(header) == 12 and header[3] & 4:
+                extra = cov_file.read(struct.unpack("<H", header[10:12])[0])
+                if cls._bgzf_block_size(extra) is not None:
+                    return "bgzf"
+
+        return "gzip"
+
+    @classmethod
+    def _open_coverage(cls, file):
+        """ Method to open a coverage file for reading as bytes,
+        decompressing gzip and BGZF files as they are read.
+        :param: file: Path to coverage file or binary file object
+        :returns: Binary file object
+        """
+        if hasattr(file, "read"):
+            return file
+        if cls._compression(file):
+            return gzip.open(file, "rb")
+
+        return open(file, "rb")
+
+    @classmethod
+    def _stdin_source(cls):
+        """ Method to open stdin for reading a coverage file as it streams
+        in, decompressing it if gzip or BGZF compressed.
+        :returns: Binary file object, closing it leaves stdin open
+        """
+        stream = io.BufferedReader(StdinReader(), 1 << 16)
+        if stream.peek(2)[:2] == GZIP_MAGIC:
+            return gzip.GzipFile(fileobj=stream, mode="rb")
+
+        return stream
+
+    @classmethod
+    def _drain_stdin(cls):
+        """ Method to read the rest of stdin once the requested regions have
+        been read, so the process writing to it isn't cut off. """
+        fd = sys.stdin.fileno()
+        while os.read(fd, 1 << 20):
+            pass
+
+    def _write_stdout(self, results_df):
+        """ Method to write the results of all samples to stdout.
+        :param: results_df: Pandas dataframe of results
+        """
+        if results_df.empty:
+            return
+        if self.stdout_format == "ndjson":
+            # nan isn't valid json
+            rows = results_df.astype(object).where(results_df.notna(), None)
+            for row in rows.to_dict(orient="records"):
+                self.stdout.write(json.dumps(row) + "\n")
+        else:
+            results_df.to_csv(self.stdout, index=False)
+        self.stdout.flush()
+
+    @classmethod
+    def _bgzf_block_size(cls, extra):
+        """ Method to find the size of a BGZF block from the extra field of
+        its gzip header.
+        :param: extra: Bytes of the extra field
+        :returns: Size of the whole block in bytes, or None if the extra
+                    field has no BC subfield
+        """
+        pos = 0
+        while pos + 4 <= len(extra):
+            length = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == b"BC" and length == 2:
+                return struct.unpack("<H", extra[pos + 4:pos + 6])[0] + 1
+            pos += 4 + length
+
+        return None
+
+    @classmethod
+    def _read_bgzf_block(cls, raw):
+        """ Method to read and decompress the BGZF block at the current
+        position of a compressed file.
+        :param: raw: Binary file object of the compressed file
+        :returns: Tuple of the compressed size and decompressed bytes of the
+                    block, or None at the end of the file
+        """
+        header = raw.read(12)
+        if len(header) < 12:
+            return None
+        extra = raw.read(struct.unpack("<H", header[10:12])[0])
+        size = cls._bgzf_block_size(extra)
+        if header[:2] != GZIP_MAGIC or size is None:
+            raise ValueError("Invalid BGZF block at {0}".format(
+                raw.tell() - 12 - len(extra)
+            ))
+        block = raw.read(size - 12 - len(extra))
+        # the deflate data is followed by the crc32 and decompressed size
+        return size, zlib.decompress(block[:-8], -15)
+
+    @classmethod
+    def _bgzf_blocks(cls, file):
+        """ Method to list the blocks of a BGZF file from their headers,
+        without decompressing them.
+        :param: file: Path to BGZF coverage file
+        :returns: List of [compressed offset, decompressed offset] of each
+                    non-empty block
+        """
+        blocks = []
+        coffset = uoffset = 0
+        with open(file, "rb") as raw:
+            while True:
+                header = raw.read(12)
+                if len(header) < 12:
+                    break
+                extra = raw.read(struct.unpack("<H", header[10:12])[0])
+                size = cls._bgzf_block_size(extra)
+                if size is None:
+                    raise ValueError("Invalid BGZF block at {0}".format(
+                        coffset
+                    ))
+                raw.seek(coffset + size - 4)
+                block_usize = struct.unpack("<I", raw.read(4))[0]
+                if block_usize:
+                    blocks.append([coffset, uoffset])
+                coffset += size
+                uoffset += block_usize
+
+        return blocks
+
+    @classmethod
+    def _read_bgzf_range(cls, raw, blocks, uoffsets, start, end):
+        """ Method to read a range of the decompressed data of a BGZF file,
+        only decompressing the blocks that cover it.
+        :param: raw: Binary file object of the compressed file
+        :param: blocks: Block table from _bgzf_blocks
+        :param: uoffsets: List of the decompressed offset of each block
+        :param: start: Decompressed offset to read from
+        :param: end: Decompressed offset to read to
+        :returns: Bytes
+        """
+        first = bisect.bisect_right(uoffsets, start) - 1
+        raw.seek(blocks[first][0])
+        offset = read_to = blocks[first][1]
+        data = []
+        while read_to < end:
+            block = cls._read_bgzf_block(raw)
+            if block is None:
+                break
+            data.append(block[1])
+            read_to += len(block[1])
+
+        return b"".join(data)[start - offset:end - offset]
+
+    @classmethod
+    def _import_coverage(cls, file, column_dtypes, sep="\t"):
+        """ Method to read output file from coverage file into a dataframe.
+        :param: file: Path to coverage file or binary file object
+        :param: column_dtypes: Dictionary with column name and datatype for
+                            the given coverage file type
+        :param: sep: seperate used in coverage file (default is tab)
+        :returns: reader iterable containing Pandas dataframe.
+        """
+        reader = pd.read_csv(
+            file,
+            sep=sep,
+            header=0,
+            skipinitialspace=True,
+            na_values="-",
+            dtype=column_dtypes,
+            chunksize=10000,
+        )
+
+        return reader
+
+    @classmethod
+    def _import_intervals(cls, intervals, dup_threshold):
+        """ Method to process interval json file and store as a dictionary
+        :param: file: Path to interval json
+        :param: dup_threshold: Threshold used to identify dup/amp regions
+        :returns: Dictionary
+        """
+        # open json
+        with open(intervals) as json_file:
+            intervals = json.load(json_file)
+
+        # validation json contents, collecting every problem so they can be
+        # reported together
+        if not isinstance(intervals, list):
+            raise ValueError("Intervals must be a list of interval pairs")
+        errors = []
+        for n, interval in enumerate(intervals, 1):
+            if not isinstance(interval, dict):
+                errors.append("Pair {0} is not an object".format(n))
+                continue
+            for region in ["region1", "region2"]:
+                if not isinstance(interval.get(region), dict):
+                    errors.append("Pair {0} has no {1}".format(n, region))
+                    continue
+                missing = [
+                    key for key in ["chrom", "start", "end", "name"]
+                    if key not in interval[region]
+                ]
+                if missing:
+                    errors.append(
+                        "Pair {0} {1} has no {2}".format(
+                            n, region, ", ".join(missing)
+                        )
+                    )
+                    continue
+                try:
+                    start, end = [
+                        int(interval[region][key]) for key in ["start", "end"]
+                    ]
+                except (TypeError, ValueError):
+                    errors.append(
+                        "Pair {0} {1} start and end must be integers".format(
+                            n, region
+                        )
+                    )
+                    continue
+                if start > end:
+                    errors.append(
+                        "Pair {0} {1} starts after it ends".format(n, region)
+                    )
+            # add on default dup threshold if it has not been defined
+            if interval.get("dup_threshold", "") == "":
+                interval["dup_threshold"] = dup_threshold
+            try:
+                float(interval["dup_threshold"])
+            except (TypeError, ValueError):
+                errors.append(
+                    "Pair {0} dup_threshold must be a number".format(n)
+                )
+            # thresholds of metrics other than the default one
+            metric_thresholds = interval.get("metric_thresholds", {})
+            if not isinstance(metric_thresholds, dict):
+                errors.append(
+                    "Pair {0} metric_thresholds must be an object of metric "
+                    "to threshold".format(n)
+                )
+                continue
+            for metric, threshold in metric_thresholds.items():
+                try:
+                    float(threshold)
+                except (TypeError, ValueError):
+                    errors.append(
+                        "Pair {0} {1} threshold must be a number".format(
+                            n, metric
+                        )
+                    )
+        if not intervals:
+            errors.append("No interval pairs given")
+        if errors:
+            raise ValueError("\n".join(errors))
+
+        return intervals
+
+    @classmethod
+    def _import_exon_catalog(cls, beds, min_exons=2, min_flank=2):
+        """ Method to read the exons of each gene to scan from BED files,
+        one gene per file named after the file, e.g. KMT2A_all_exons.bed.
+        :param: beds: List of paths to BED files (0-based chrom, start, end)
+        :param: min_exons: Minimum number of exons in a scanned segment
+        :param: min_flank: Minimum number of exons on each side of a scanned
+                            segment
+        :returns: List of (gene, exons), exons being (chrom, start, end)
+                    region keys with 1-based starts, in genomic order
+        """
+        catalog = []
+        errors = []
+        for bed in beds:
+            gene = os.path.basename(bed).split(".")[0]
+            exons = set()
+            with open(bed) as bed_file:
+                for n, line in enumerate(bed_file, 1):
+                    if not line.strip() or line.startswith(
+                        ("#", "track", "browser")
+                    ):
+                        continue
+                    fields = line.rstrip("\n").split("\t")
+                    try:
+                        exon = (fields[0], int(fields[1]) + 1, int(fields[2]))
+                    except (IndexError, ValueError):
+                        errors.append(
+                            "{0} line {1} is not chrom, start, end".format(
+                                gene, n
+                            )
+                        )
+                        continue
+                    if exon[1] > exon[2]:
+                        errors.append(
+                            "{0} line {1} starts after it ends".format(
+                                gene, n
+                            )
+                        )
+                    exons.add(exon)
+            if gene in [name for name, _ in catalog]:
+                errors.append("{0} given more than once".format(gene))
+            if len(set(chrom for chrom, _, _ in exons)) > 1:
+                errors.append("{0} exons are on several chroms".format(gene))
+            if len(exons) < min_exons + 2 * min_flank:
+                errors.append(
+                    "{0} has {1} exon(s), at least {2} are needed".format(
+                        gene, len(exons), min_exons + 2 * min_flank
+                    )
+                )
+            catalog.append((gene, sorted(exons)))
+        if errors:
+            raise ValueError("\n".join(errors))
+
+        return catalog
+
+    @classmethod
+    def _compile_regions(cls, intervals):
+        """ Method to compile every region of every interval pair into a
+        single lookup set, so the coverage file only has to be read once.
+        :param: intervals: List of interval pair dictionaries
+        :returns: Set of (chrom, start, end) region keys
+        """
+        regions = set()
+        for pair in intervals:
+            for region in ["region1", "region2"]:
+                regions.add(cls._region_key(pair[region]))
+
+        return regions
+
+    @classmethod
+    def _region_key(cls, region):
+        """ Method to return the lookup key of a region.
+        :param: region: Dictionary with chrom, start and end of the region
+        :returns: (chrom, start, end) tuple with integer coordinates
+        """
+        return (str(region["chrom"]), int(region["start"]), int(region["end"]))
+
+    @classmethod
+    def _region_bounds(cls, regions, ends=False):
+        """ Method to return the largest requested start on each chrom.
+        :param: regions: Compiled regions from _compile_regions
+        :param: ends: Return the largest end instead
+        :returns: Dictionary of chrom to largest start (or end)
+        """
+        bounds = {}
+        for chrom, start, end in regions:
+            bound = end if ends else start
+            bounds[chrom] = max(bound, bounds.get(chrom, bound))
+
+        return bounds
+
+    @classmethod
+    def _metric_columns(cls, metric):
+        """ Method to return the metric column names to read.
+        :param: metric: Column name of the metric, or list of column names
+        :returns: List of column names
+        """
+        if isinstance(metric, str):
+            return [metric]
+
+        return list(metric)
+
+    @classmethod
+    def _metric_getter(cls, df, metric):
+        """ Method to return a function giving the metric of a row of a
+        coverage dataframe chunk by position.
+        :param: df: Coverage Dataframe chunk
+        :param: metric: Column name of the metric, or list of column names
+        :returns: Function of the row position returning the value, or a
+                    tuple of the value of each column
+        """
+        if isinstance(metric, str):
+            return df[metric].values.__getitem__
+        columns = [df[column].values for column in metric]
+
+        return lambda i: tuple(values[i] for values in columns)
+
+    @classmethod
+    def _read_targets(
+        cls, cov_chunks, regions, metric, full_scan=False, stats=None
+    ):
+        """ Method to read the targets on the chroms of the requested
+        regions, for matching regions to targets other than exactly.
+        :param: cov_chunks: Iterable of coverage Dataframe chunks
+        :param: regions: Compiled regions from _compile_regions
+        :param: metric: Column name of the metric to extract, or list of
+                        column names
+        :param: full_scan: Read to the end instead of stopping once all
+                            regions have been passed in a sorted file
+        :param: stats: Dictionary to add the number of rows read to
+        :returns: Pandas dataframe with chrom, start, end and metric columns
+        """
+        tracker = None
+        if not full_scan:
+            # targets past the region ends are only needed up to the first,
+            # which is in the chunk that stops the read
+            tracker = SortedScanTracker(cls._region_bounds(regions, ends=True))
+        chroms = {key[0] for key in regions}
+        columns = ["chrom", "start", "end"] + cls._metric_columns(metric)
+        targets = []
+        rows = 0
+        for df in cov_chunks:
+            rows += len(df)
+            targets.append(df.loc[df["chrom"].isin(chroms), columns])
+            if tracker is not None and tracker.update_chunk(
+                df["chrom"].values.astype(str), df["start"].values
+            ):
+                break
+        if hasattr(cov_chunks, "close"):
+            cov_chunks.close()
+        if stats is not None:
+            stats["rows"] += rows
+        if not targets:
+            return pd.DataFrame(columns=columns)
+
+        return pd.concat(targets, ignore_index=True)
+
+    @classmethod
+    def _match_regions(cls, targets, regions, metric, match):
+        """ Method to resolve each region to the coverage targets it
+        overlaps, contains or is nearest to, using sorted arrays of the
+        targets of each chrom so each lookup is a binary search.
+        :param: targets: Pandas dataframe with chrom, start, end and metric
+                        columns, as from _read_targets
+        :param: regions: Compiled regions from _compile_regions
+        :param: metric: Column name of the metric to extract, or list of
+                        column names
+        :param: match: Match mode, one of overlap, contain or nearest
+        :returns: Dictionary of region key to the metric of the single
+                    matching target or the length weighted mean of several,
+                    for regions matching any target, as a tuple of the value
+                    of each column for a list of columns
+        """
+        by_chrom = {}
+        for key in regions:
+            by_chrom.setdefault(key[0], []).append(key)
+        chrom_column = targets["chrom"].astype(str).values
+
+        region_values = {}
+        for chrom, keys in by_chrom.items():
+            on_chrom = targets[chrom_column == chrom].sort_values(
+                "start", kind="mergesort"
+            )
+            starts = on_chrom["start"].values
+            ends = on_chrom["end"].values
+            values = [
+                on_chrom[column].values
+                for column in cls._metric_columns(metric)
+            ]
+            if not len(starts):
+                continue
+            lengths = ends - starts + 1
+            # targets can overlap, so ends are searched by their running max
+            max_ends = np.maximum.accumulate(ends)
+            # and the target reaching the running max, for nearest lookups
+            max_end_targets = np.maximum.accumulate(
+                np.where(ends >= max_ends, np.arange(len(ends)), 0)
+            )
+            # search for the bounds of every region of the chrom at once
+            region_starts = np.array([key[1] for key in keys])
+            region_ends = np.array([key[2] for key in keys])
+            lasts = np.searchsorted(starts, region_ends, side="right")
+            if match == "contain":
+                firsts = np.searchsorted(starts, region_starts, side="left")
+            else:
+                firsts = np.searchsorted(max_ends, region_starts, side="left")
+            for key, first, last in zip(keys, firsts, lasts):
+                start, end = key[1], key[2]
+                if match == "contain":
+                    hits = first + np.flatnonzero(ends[first:last] <= end)
+                else:
+                    hits = first + np.flatnonzero(ends[first:last] >= start)
+                if match == "nearest" and not len(hits):
+                    # closest of the target ending before and starting after
+                    before = after = None
+                    if first > 0:
+                        before = start - max_ends[first - 1]
+                    if last < len(starts):
+                        after = starts[last] - end
+                    if after is None or (
+                        before is not None and before <= after
+                    ):
+                        hits = [max_end_targets[first - 1]]
+                    else:
+                        hits = [last]
+                if len(hits) == 1:
+                    value = [column[hits[0]] for column in values]
+                elif len(hits) > 1:
+                    value = [
+                        np.average(column[hits], weights=lengths[hits])
+                        for column in values
+                    ]
+                else:
+                    continue
+                region_values[key] = (
+                    value[0] if isinstance(metric, str) else tuple(value)
+                )
+
+        return region_values
+
+    @classmethod
+    def _extract_regions(
+        cls, cov_chunks, regions, metric, full_scan=False, stats=None
+    ):
+        """ Method to find all compiled regions in a single pass over the
+        coverage file.
+        :param: cov_chunks: Iterable of coverage Dataframe chunks
+        :param: regions: Compiled regions from _compile_regions
+        :param: metric: Column name of the metric to extract, or list of
+                        column names
+        :param: full_scan: Read to the end instead of stopping once all
+                            regions have been passed in a sorted file
+        :param: stats: Dictionary to add the number of rows read to
+        :returns: Dictionary of region key to the metric of the single
+                    matching row, as a tuple of the value of each column for
+                    a list of columns
+        """
+        tracker = None
+        if not full_scan:
+            tracker = SortedScanTracker(cls._region_bounds(regions))
+        matches = {key: [] for key in regions}
+        rows = 0
+        # iterate over each df chunk once, looking up every region in it
+        for df in cov_chunks:
+            rows += len(df)
+            value = cls._metric_getter(df, metric)
+            for key, positions in cls._index_df(df, regions).items():
+                matches[key].extend(value(i) for i in positions)
+            if tracker is not None and tracker.update_chunk(
+                df["chrom"].values.astype(str), df["start"].values
+            ):
+                break
+        if hasattr(cov_chunks, "close"):
+            cov_chunks.close()
+        if stats is not None:
+            stats["rows"] += rows
+
+        # only keep regions that are found exactly once in the file
+        region_rows = {}
+        for key, rows in matches.items():
+            if len(rows) == 1:
+                region_rows[key] = rows[0]
+
+        return region_rows
+
+    @classmethod
+    def _scan_regions(
+        cls, file, regions, metric, column_dtypes, full_scan=False,
+        stats=None,
+    ):
+        """ Method to find all compiled regions by scanning the raw lines of
+        the coverage file, only parsing the lines of requested regions.
+        :param: file: Path to coverage file or binary file object
+        :param: regions: Compiled regions from _compile_regions
+        :param: metric: Column name of the metric to extract, or list of
+                        column names
+        :param: column_dtypes: Dictionary with column name and datatype for
+                            the given coverage file type
+        :param: full_scan: Read to the end instead of stopping once all
+                            regions have been passed in a sorted file
+        :param: stats: Dictionary to add the number of rows and bytes read to
+        :returns: Dictionary of region key to the metric of the single
+                    matching row (a tuple of the value of each column for a
+                    list of columns), or None if the header is not as
+                    expected
+        """
+        # each region is identified by the chrom, start and end at the start
+        # of its line
+        prefixes = {
+            "{0}\t{1}\t{2}\t".format(*key).encode(): key for key in regions
+        }
+        lengths = sorted({len(prefix) for prefix in prefixes})
+        matches = {key: [] for key in regions}
+        bounds = {
+            chrom.encode(): start
+            for chrom, start in cls._region_bounds(regions).items()
+        }
+        tracker = None if full_scan else SortedScanTracker(bounds)
+        chrom_prefix = b"\n"
+        relevant = False
+        rows = 0
+
+        with cls._open_coverage(file) as cov_file:
+            header = [
+                column.strip()
+                for column in cov_file.readline().decode().split("\t")
+            ]
+            # leave anything unexpected to the pandas reader, which reports
+            # the problem with the file
+            metrics = cls._metric_columns(metric)
+            if header != list(column_dtypes) or not set(metrics).issubset(
+                header
+            ):
+                return None
+            fields = [
+                (header.index(column),
+                 cls._scan_converter(column_dtypes[column]))
+                for column in metrics
+            ]
+            if isinstance(metric, str):
+                (column, convert), = fields
+
+                def parse(line):
+                    return convert(line.split(b"\t")[column].strip())
+            else:
+                def parse(line):
+                    line = line.split(b"\t")
+                    return tuple(
+                        convert(line[column].strip())
+                        for column, convert in fields
+                    )
+
+            for rows, line in enumerate(cov_file, 1):
+                for length in lengths:
+                    key = prefixes.get(line[:length])
+                    if key is not None:
+                        matches[key].append(parse(line))
+                        break
+                if tracker is None:
+                    continue
+                # only chrom changes matter outside the requested chroms
+                if not line.startswith(chrom_prefix):
+                    chrom_prefix = line[:line.find(b"\t") + 1]
+                    chrom = chrom_prefix[:-1]
+                    relevant = chrom in bounds
+                    if not relevant and tracker.update(chrom, None):
+                        break
+                if relevant:
+                    tab = len(chrom_prefix)
+                    start = int(line[tab:line.find(b"\t", tab)])
+                    if tracker.update(chrom, start):
+                        break
+
+            if stats is not None:
+                stats["rows"] += rows
+                stats["bytes"] += cov_file.tell()
+
+        # only keep regions that are found exactly once in the file
+        return {
+            key: values[0] for key, values in matches.items()
+            if len(values) == 1
+        }
+
+    @classmethod
+    def _scan_converter(cls, dtype):
+        """ Method to return a function that parses a raw field of the given
+        column dtype the same way as the pandas reader.
+        :param: dtype: Column dtype from the column dtypes dictionary
+        :returns: Function taking a bytes field
+        """
+        if dtype.startswith("float"):
+            def convert(field):
+                return float("nan") if field == b"-" else np.float64(field)
+        elif dtype.startswith("int"):
+            def convert(field):
+                return np.int64(field)
+        else:
+            def convert(field):
+                return field.decode()
+
+        return convert
+
+    def _read_regions(self, file, regions, metric, stats=None, data=None):
+        """ Method to read the metric of every compiled region from the
+        coverage file with the selected engine.
+        :param: file: Path to coverage file
+        :param: regions: Compiled regions from _compile_regions
+        :param: metric: Column name of the metric to extract, or list of
+                        column names
+        :param: stats: Dictionary to add the number of rows and bytes read to
+        :param: data: Bytes of the file already read by
+                    _read_coverage_bytes, instead of reading the file
+        :returns: Dictionary of region key to metric value, or tuple of the
+                    value of each column
+        """
+        # stdin can only be read once, so isn't cached or indexed and is
+        # read as it streams in
+        stream = self._stdin_source() if file == STDIN else None
+
+        # a cached file is read without parsing any text, so before the
+        # index, scanner or early exit
+        if self.cache_dir and stream is None:
+            return self._read_regions_cached(
+                file, regions, metric, stats, data
+            )
+
+        engine = self.engine
+        if engine == "auto":
+            engine = "scan" if len(regions) <= SCAN_MAX_REGIONS else "pandas"
+
+        # only read the chroms of requested regions if the file is indexed
+        if data is None and self.index and stream is None:
+            data = self._indexed_source(file, regions, self.index_dir)
+
+        # the scanner only finds exact matches
+        if engine == "scan" and self.match == "exact":
+            region_values = self._scan_regions(
+                stream or (file if data is None else io.BytesIO(data)),
+                regions,
+                metric,
+                self.column_dtypes,
+                self.full_scan,
+                stats,
+            )
+            if region_values is not None:
+                return region_values
+            # the header has been read, so can't be left to pandas
+            if stream is not None:
+                raise ValueError(
+                    "Coverage stream header is not {0}".format(
+                        ", ".join(self.column_dtypes)
+                    )
+                )
+
+        # parse the coverage file into chunks - helps with memory
+        # requirements for v. large files
+        with (
+            stream
+            or (
+                self._open_coverage(file) if data is None
+                else io.BytesIO(data)
+            )
+        ) as cov_file:
+            cov_chunks = self._import_coverage(
+                file=cov_file, column_dtypes=self.column_dtypes
+            )
+            if self.match == "exact":
+                region_values = self._extract_regions(
+                    cov_chunks, regions, metric, self.full_scan, stats
+                )
+            else:
+                region_values = self._match_regions(
+                    self._read_targets(
+                        cov_chunks, regions, metric, self.full_scan, stats
+                    ),
+                    regions,
+                    metric,
+                    self.match,
+                )
+            if stats is not None:
+                stats["bytes"] += cov_file.tell()
+
+        return region_values
+
+    def _read_regions_cached(
+        self, file, regions, metric, stats=None, data=None
+    ):
+        """ Method to read the metric of every compiled region from the
+        columnar cache of the coverage file, parsing and caching the whole
+        file first if it is not cached yet.
+        :param: file: Path to coverage file
+        :param: regions: Compiled regions from _compile_regions
+        :param: metric: Column name of the metric to extract, or list of
+                        column names
+        :param: stats: Dictionary to add the number of rows and bytes read
+                        from the coverage file to, nothing is read from it
+                        if it is cached
+        :param: data: Bytes of the whole file if already read
+        :returns: Dictionary of region key to metric value, or tuple of the
+                    value of each column
+        """
+        entry = os.path.join(self.cache_dir, self._cache_key(file))
+        df = self._load_cached_coverage(
+            entry, ["chrom", "start", "end"] + self._metric_columns(metric)
+        )
+        if df is None:
+            with (
+                self._open_coverage(file) if data is None
+                else io.BytesIO(data)
+            ) as cov_file:
+                df = pd.read_csv(
+                    cov_file,
+                    sep="\t",
+                    header=0,
+                    skipinitialspace=True,
+                    na_values="-",
+                    dtype=self.column_dtypes,
+                )
+                if stats is not None:
+                    stats["rows"] += len(df)
+                    stats["bytes"] += cov_file.tell()
+            self._store_cached_coverage(entry, df)
+            self._evict_cache(self.cache_dir, self.cache_size)
+
+        # rows were counted as they were parsed, or not read from the file
+        if self.match != "exact":
+            return self._match_regions(
+                self._read_targets([df], regions, metric, full_scan=True),
+                regions,
+                metric,
+                self.match,
+            )
+
+        return self._extract_regions([df], regions, metric, full_scan=True)
+
+    @classmethod
+    def _cache_key(cls, file):
+        """ Method to return the cache key of a coverage file, from its path,
+        size and mtime so that looking it up doesn't read the file.
+        :param: file: Path to coverage file
+        :returns: Hex digest string
+        """
+        stat = os.stat(file)
+        return hashlib.sha1(
+            "{0}\t{1}\t{2}".format(
+                os.path.realpath(file), stat.st_size, stat.st_mtime_ns
+            ).encode()
+        ).hexdigest()
+
+    @classmethod
+    def _load_cached_coverage(cls, entry, columns):
+        """ Method to load columns of a cached coverage file as a dataframe
+        backed by memory mapped arrays.
+        :param: entry: Path to the cache entry directory
+        :param: columns: List of column names to load
+        :returns: Pandas dataframe, or None if the entry isn't cached
+        """
+        try:
+            with open(os.path.join(entry, "meta.json")) as meta_file:
+                meta = json.load(meta_file)
+            if meta["version"] != CACHE_VERSION:
+                return None
+            data = {}
+            for column in columns:
+                info = meta["columns"][column]
+                values = np.load(
+                    os.path.join(entry, info["file"]), mmap_mode="r"
+                )
+                if "categories" in info:
+                    with open(
+                        os.path.join(entry, info["categories"])
+                    ) as categories_file:
+                        values = pd.Categorical.from_codes(
+                            values, json.load(categories_file)
+                        )
+                data[column] = values
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        # mark the entry as recently used for eviction
+        os.utime(os.path.join(entry, "meta.json"), None)
+
+        return pd.DataFrame(data, columns=columns, copy=False)
+
+    @classmethod
+    def _store_cached_coverage(cls, entry, df):
+        """ Method to store a parsed coverage file in the cache as one numpy
+        array per column, warning rather than failing if it can't be written.
+        :param: entry: Path to the cache entry directory
+        :param: df: Pandas dataframe of the whole coverage file
+        """
+        tmp_entry = "{0}.{1}.tmp".format(entry, os.getpid())
+        try:
+            os.makedirs(tmp_entry)
+            meta = {"version": CACHE_VERSION, "columns": {}}
+            for i, column in enumerate(df.columns):
+                info = {"file": "col_{0}.npy".format(i)}
+                values = df[column]
+                if values.dtype.name == "category":
+                    info["categories"] = "col_{0}.categories.json".format(i)
+                    with open(
+                        os.path.join(tmp_entry, info["categories"]), "w"
+                    ) as categories_file:
+                        json.dump(
+                            values.cat.categories.tolist(), categories_file
+                        )
+                    values = values.cat.codes
+                np.save(os.path.join(tmp_entry, info["file"]), values.values)
+                meta["columns"][column] = info
+            # meta is written last, so entries without it are incomplete
+            with open(os.path.join(tmp_entry, "meta.json"), "w") as meta_file:
+                json.dump(meta, meta_file)
+            os.rename(tmp_entry, entry)
+        except (IOError, OSError) as e:
+            # another process may have cached the same file first
+            if not os.path.isdir(entry):
+                sys.stderr.write(
+                    "[{0}] Warning: could not cache {1}: {2}\n".format(
+                        datetime.now(), entry, str(e)
+                    )
+                )
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    @classmethod
+    def _evict_cache(cls, cache_dir, cache_size):
+        """ Method to remove the least recently used cache entries until the
+        cache fits in the given size.
+        :param: cache_dir: Cache directory
+        :param: cache_size: Maximum size of the cache in MB
+        """
+        entries = []
+        for name in os.listdir(cache_dir):
+            entry = os.path.join(cache_dir, name)
+            try:
+                last_used = os.path.getmtime(os.path.join(entry, "meta.json"))
+                size = sum(
+                    os.path.getsize(os.path.join(entry, f))
+                    for f in os.listdir(entry)
+                )
+            except (IOError, OSError):
+                continue
+            entries.append((last_used, size, entry))
+
+        total = sum(size for last_used, size, entry in entries)
+        for last_used, size, entry in sorted(entries):
+            if total <= cache_size * 1024 * 1024:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    @classmethod
+    def _index_path(cls, file, index_dir=None):
+        """ Method to return the path of the index of a coverage file.
+        :param: file: Path to coverage file
+        :param: index_dir: Directory to keep indexes in (default is next to
+                            the coverage file)
+        :returns: Path to index file
+        """
+        if index_dir is None:
+            return "{0}{1}".format(file, INDEX_SUFFIX)
+
+        # key indexes in a shared directory on the full path of the file
+        path_hash = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()
+        return os.path.join(
+            index_dir,
+            "{0}.{1}{2}".format(
+                os.path.basename(file), path_hash[:16], INDEX_SUFFIX
+            ),
+        )
+
+    @classmethod
+    def _build_coverage_index(cls, file):
+        """ Method to index the byte offsets of each chrom in a coverage file.
+        Offsets of compressed files are in the decompressed data, with a
+        table of the blocks of BGZF files to seek to them.
+        :param: file: Path to coverage file
+        :returns: Dictionary with the file size, mtime and sha1, compression,
+                    the offset of the end of the header, the [start, end]
+                    byte ranges of each chrom and the BGZF block table
+        """
+        stat = os.stat(file)
+        compression = cls._compression(file)
+        chroms = {}
+        # the sha1 is of the file as stored
+        sha1 = hashlib.sha1() if compression is None else None
+        with cls._open_coverage(file) as cov_file:
+            header = cov_file.readline()
+            if sha1 is not None:
+                sha1.update(header)
+            offset = len(header)
+            chrom = None
+            for line in cov_file:
+                if sha1 is not None:
+                    sha1.update(line)
+                line_chrom = line[:line.find(b"\t")]
+                if line_chrom != chrom:
+                    chrom = line_chrom
+                    # unsorted files can have more than one range per chrom
+                    chroms.setdefault(chrom.decode(), []).append(
+                        [offset, offset]
+                    )
+                offset += len(line)
+                chroms[chrom.decode()][-1][1] = offset
+
+        return {
+            "version": INDEX_VERSION,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha1": (
+                cls._file_sha1(file) if sha1 is None else sha1.hexdigest()
+            ),
+            "compression": compression,
+            "header_end": len(header),
+            "chroms": chroms,
+            "blocks": cls._bgzf_blocks(file) if compression == "bgzf" else [],
+        }
+
+    @classmethod
+    def _file_sha1(cls, file, decompress=False):
+        """ Method to return the sha1 hex digest of a file's contents.
+        :param: file: Path to file
+        :param: decompress: Hash the decompressed contents of compressed
+                            coverage files
+        :returns: Hex digest string
+        """
+        sha1 = hashlib.sha1()
+        with (
+            cls._open_coverage(file) if decompress else open(file, "rb")
+        ) as in_file:
+            for block in iter(functools.partial(in_file.read, 1 << 20), b""):
+                sha1.update(block)
+
+        return sha1.hexdigest()
+
+    @classmethod
+    def _load_coverage_index(cls, file, index_dir=None):
+        """ Method to load the index of a coverage file, building it if it is
+        missing or out of date. An index is out of date if the file size has
+        changed, or the mtime has changed along with the contents (files
+        downloaded again get a new mtime but keep their contents).
+        :param: file: Path to coverage file
+        :param: index_dir: Directory to keep indexes in (default is next to
+                            the coverage file)
+        :returns: Index dictionary as from _build_coverage_index
+        """
+        index_path = cls._index_path(file, index_dir)
+        stat = os.stat(file)
+        try:
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            if (
+                index["version"] == INDEX_VERSION
+                and index["size"] == stat.st_size
+            ):
+                if index["mtime"] == stat.st_mtime:
+                    return index
+                if index["sha1"] == cls._file_sha1(file):
+                    index["mtime"] = stat.st_mtime
+                    cls._write_coverage_index(index, index_path)
+                    return index
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        return cls.index_coverage_file(file, index_dir)
+
+    @classmethod
+    def _write_coverage_index(cls, index, index_path):
+        """ Method to write an index next to a coverage file or in the index
+        directory, warning rather than failing if it can't be written.
+        :param: index: Index dictionary as from _build_coverage_index
+        :param: index_path: Path to write the index to
+        """
+        try:
+            index_dir = os.path.dirname(index_path)
+            if index_dir and not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            # write then rename so parallel readers never see partial indexes
+            tmp_path = "{0}.{1}.tmp".format(index_path, os.getpid())
+            with open(tmp_path, "w") as index_file:
+                json.dump(index, index_file)
+            os.rename(tmp_path, index_path)
+        except (IOError, OSError) as e:
+            sys.stderr.write(
+                "[{0}] Warning: could not write index {1}: {2}\n".format(
+                    datetime.now(), index_path, str(e)
+                )
+            )
+
+    @classmethod
+    def index_coverage_file(cls, file, index_dir=None):
+        """ Method to build and write the byte offset index of a coverage
+        file.
+        :param: file: Path to coverage file
+        :param: index_dir: Directory to keep indexes in (default is next to
+                            the coverage file)
+        :returns: Index dictionary as from _build_coverage_index
+        """
+        print(
+            "[{0}] Indexing {1}".format(datetime.now(), os.path.basename(file))
+        )
+        index = cls._build_coverage_index(file)
+        cls._write_coverage_index(index, cls._index_path(file, index_dir))
+
+        return index
+
+    @classmethod
+    def _indexed_source(cls, file, regions, index_dir=None):
+        """ Method to read only the header and the chroms of the requested
+        regions from a coverage file, using its byte offset index.
+        :param: file: Path to coverage file
+        :param: regions: Compiled regions from _compile_regions
+        :param: index_dir: Directory to keep indexes in (default is next to
+                            the coverage file)
+        :returns: Bytes of the header and requested chroms
+        """
+        index = cls._load_coverage_index(file, index_dir)
+        chroms = {key[0] for key in regions}
+        # keep the ranges in file order so sorted files stay sorted
+        ranges = sorted(
+            offsets
+            for chrom, chrom_ranges in index["chroms"].items()
+            if chrom in chroms
+            for offsets in chrom_ranges
+        )
+        if index["size"] == 0:
+            return b""
+        if index["compression"] == "bgzf":
+            # only decompress the blocks covering the header and ranges
+            uoffsets = [block[1] for block in index["blocks"]]
+            with open(file, "rb") as raw:
+                data = [
+                    cls._read_bgzf_range(
+                        raw, index["blocks"], uoffsets, start, end
+                    )
+                    for start, end in [[0, index["header_end"]]] + ranges
+                ]
+        elif index["compression"] == "gzip":
+            # gzip streams can't be seeked into, skip forward to each range
+            with gzip.open(file, "rb") as cov_file:
+                data = [cov_file.read(index["header_end"])]
+                for start, end in ranges:
+                    cov_file.seek(start)
+                    data.append(cov_file.read(end - start))
+        else:
+            with open(file, "rb") as cov_file:
+                cov_map = mmap.mmap(
+                    cov_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+                try:
+                    data = [cov_map[:index["header_end"]]]
+                    data.extend(cov_map[start:end] for start, end in ranges)
+                finally:
+                    cov_map.close()
+
+        return b"".join(data)
+
+    @classmethod
+    def _index_df(cls, df, regions):
+        """ Method to index the rows of a coverage dataframe on
+        (chrom, start, end) for constant time region lookups.
+        :param: df: Pandas dataframe
+        :param: regions: Set of (chrom, start, end) region keys
+        :returns: Dictionary of requested region key to row positions
+        """
+        # only rows starting at a requested coordinate can match, so narrow
+        # the chunk down with a vectorised hash lookup before indexing
+        starts = {key[1] for key in regions}
+        candidates = np.flatnonzero(df["start"].isin(starts).values)
+
+        index = {}
+        for i, key in zip(
+            candidates,
+            zip(
+                df["chrom"].values[candidates].astype(str).tolist(),
+                df["start"].values[candidates].tolist(),
+                df["end"].values[candidates].tolist(),
+            ),
+        ):
+            if key in regions:
+                index.setdefault(key, []).append(i)
+
+        return index
+
+    @classmethod
+    def _get_sample_id(cls, file, cov_file_pattern):
+        """ Method to return sample ID from file name.
+        :param: file: Input file name
+        :param: cov_file_pattern: Coverage file suffix, or list of suffixes,
+                                to remove from filename
+        :returns: sample id string
+        """
+        fname = os.path.basename(file)
+        patterns = cls._cov_file_patterns(cov_file_pattern)
+        # remove the first suffix in the filename
+        pattern = next(
+            (pattern for pattern in patterns if pattern in fname), patterns[0]
+        )
+        sample_id = fname.split(pattern)[0].replace("-", "_")
+
+        return sample_id
+
+    @classmethod
+    def _compare_metric_matrix(cls, matrix, plan):
+        """ Method to compare the metric at every interval pair for every
+        sample at once and score with the threshold of each pair.
+        :param: matrix: Numpy array of the metric, samples x regions
+        :param: plan: IntervalPlan of the intervals to compare
+        :returns: Tuple of fold change, log2 fold change and above cut off
+                    numpy arrays, each samples x pairs
+        """
+        region1 = list(plan.region1_columns)
+        region2 = list(plan.region2_columns)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # calc fold change between the two values
+            fold_change = np.round(matrix[:, region1] / matrix[:, region2], 9)
+            # take a log of the fold change
+            log2_fold_change = np.round(np.log2(fold_change), 9)
+        # is the score above given theshold?
+        above_cut_off = fold_change > np.array(plan.thresholds)
+
+        return fold_change, log2_fold_change, above_cut_off
+
+    @classmethod
+    def _name_values(cls, matrix, plan):
+        """ Method to arrange values of every region into a column per
+        interval name, with a row per sample and interval pair.
+        :param: matrix: Numpy array of values, samples x regions
+        :param: plan: IntervalPlan of the intervals to compare
+        :returns: List of (name, values) with a flat numpy array of values
+        """
+        n_samples, n_pairs = len(matrix), len(plan.pairs)
+        name_values = []
+        for name, columns in plan.name_columns:
+            if None in columns:
+                # intervals missing from some pairs are left empty
+                values = np.full((n_samples, n_pairs), np.nan)
+                for p, column in enumerate(columns):
+                    if column is not None:
+                        values[:, p] = matrix[:, column]
+            else:
+                values = matrix[:, list(columns)]
+            name_values.append((name, values.ravel()))
+
+        return name_values
+
+    @classmethod
+    def _results_table(cls, sample_ids, matrix, plan, baseline=None):
+        """ Method to build the results table of every sample, with a row per
+        sample and interval pair, in the column order of the plan.
+        :param: sample_ids: List of sample ids, one per matrix row
+        :param: matrix: Numpy array of the metric, samples x regions
+        :param: plan: IntervalPlan of the intervals to compare
+        :param: baseline: Baseline from _load_baseline, adds z-score and
+                        p-value columns after those of the plan
+        :returns: Pandas dataframe
+        """
+        n_pairs = len(plan.pairs)
+        fold_change, log2_fold_change, above_cut_off = (
+            cls._compare_metric_matrix(matrix, plan)
+        )
+
+        data = {
+            "sample_id": np.repeat(
+                np.array(sample_ids, dtype=object), n_pairs
+            ),
+            "fold_change": fold_change.ravel(),
+            "log2_fold_change": log2_fold_change.ravel(),
+            "above_cut_off": np.where(
+                above_cut_off.ravel(), "TRUE", "FALSE"
+            ).astype(object),
+        }
+        data.update(cls._name_values(matrix, plan))
+        columns = list(plan.columns)
+
+        if baseline is not None:
+            region_z, z_score, p_value = cls._baseline_scores(
+                matrix, fold_change, baseline
+            )
+            for name, values in cls._name_values(region_z, plan):
+                data["{0}_z_score".format(name)] = values
+                columns.append("{0}_z_score".format(name))
+            data["z_score"] = z_score.ravel()
+            data["p_value"] = p_value.ravel()
+            columns.extend(["z_score", "p_value"])
+
+        return pd.DataFrame(data, columns=columns)
+
+    @classmethod
+    def _metric_matrices(cls, values, plan, metric, dtype=None):
+        """ Method to split the values of result records into a matrix per
+        metric.
+        :param: values: List of the values of each sample, of each metric in
+                        turn, as in result records
+        :param: plan: IntervalPlan of the intervals to compare
+        :param: metric: Column name of the metric, or list of column names
+        :param: dtype: Numpy dtype of the matrices (default is as the values)
+        :returns: List of (metric, plan with the metric's thresholds, numpy
+                    array samples x regions)
+        """
+        n_regions = len(plan.regions)
+        return [
+            (
+                column,
+                plan.metric_plan(column),
+                np.array(
+                    [
+                        sample[m * n_regions:(m + 1) * n_regions]
+                        for sample in values
+                    ],
+                    dtype=dtype,
+                ),
+            )
+            for m, column in enumerate(cls._metric_columns(metric))
+        ]
+
+    @classmethod
+    def _metric_results_table(
+        cls, sample_ids, values, plan, metric, layout="long", baseline=None,
+        dtype=None,
+    ):
+        """ Method to build the results table of every sample for one or
+        several metrics, each compared with its own thresholds.
+        :param: sample_ids: List of sample ids
+        :param: values: List of the values of each sample, of each metric in
+                        turn, as in result records
+        :param: plan: IntervalPlan of the intervals to compare
+        :param: metric: Column name of the metric, or list of column names
+        :param: layout: With several metrics, a row per sample, metric and
+                        pair with a metric column ("long"), or a row per
+                        sample and pair with the columns of each metric
+                        suffixed by its name ("wide")
+        :param: baseline: Baseline from _load_baseline, of a single metric
+        :param: dtype: Numpy dtype of the values (default is as given)
+        :returns: Pandas dataframe with the rows of each sample together
+        """
+        tables = [
+            cls._results_table(
+                sample_ids, matrix, metric_plan, baseline=baseline
+            )
+            for column, metric_plan, matrix in cls._metric_matrices(
+                values, plan, metric, dtype
+            )
+        ]
+        # a single metric is laid out as it always has been
+        if isinstance(metric, str):
+            return tables[0]
+
+        if layout == "wide":
+            return pd.concat(
+                [tables[0][["sample_id"]]] + [
+                    table.drop(columns="sample_id").add_suffix(
+                        "_{0}".format(column)
+                    )
+                    for column, table in zip(metric, tables)
+                ],
+                axis=1,
+            )
+
+        for column, table in zip(metric, tables):
+            table.insert(1, "metric", column)
+        # the rows of each metric in turn, grouped by sample
+        order = np.arange(len(tables) * len(tables[0])).reshape(
+            len(tables), len(sample_ids), -1
+        ).transpose(1, 0, 2).ravel()
+        results_df = pd.concat(tables, ignore_index=True).iloc[order]
+
+        return results_df.reset_index(drop=True)
+
+    def _baseline_digest(self):
+        """ Method to return the sha1 hex digest of the baseline samples are
+        scored against, or None without a baseline. """
+        if not self.baseline:
+            return None
+
+        return self._file_sha1(self.baseline)
+
+    @classmethod
+    def _build_baseline(cls, matrix, plan, metric):
+        """ Method to summarise the metric of a panel of normals at every
+        region, and the fold change of every interval pair.
+        :param: matrix: Numpy array of the metric of the normals, samples x
+                        regions
+        :param: plan: IntervalPlan of the intervals compared
+        :param: metric: Name of the metric
+        :returns: Dictionary of numpy arrays, as stored in the baseline file
+        """
+        matrix = np.asarray(matrix, dtype="float64")
+        fold_change = cls._compare_metric_matrix(matrix, plan)[0]
+        baseline = {
+            "version": np.array(BASELINE_VERSION),
+            "metric": np.array(metric),
+            "n_samples": np.array(len(matrix)),
+            "region_chroms": np.array([key[0] for key in plan.regions]),
+            "region_starts": np.array(
+                [key[1] for key in plan.regions], dtype="int64"
+            ),
+            "region_ends": np.array(
+                [key[2] for key in plan.regions], dtype="int64"
+            ),
+            "pair_region1": np.array(plan.region1_columns, dtype="int64"),
+            "pair_region2": np.array(plan.region2_columns, dtype="int64"),
+            # sorted fold changes of the normals for empirical p-values
+            "pair_normals": np.sort(fold_change, axis=0),
+        }
+        with np.errstate(invalid="ignore"):
+            for prefix, values in [("region", matrix), ("pair", fold_change)]:
+                median = np.nanmedian(values, axis=0)
+                baseline["{0}_median".format(prefix)] = median
+                baseline["{0}_mad".format(prefix)] = np.nanmedian(
+                    np.abs(values - median), axis=0
+                )
+
+        return baseline
+
+    def _write_baseline(self, records, fname):
+        """ Method to write the baseline of the processed normals.
+        :param: records: List of result records from _process_file
+        :param: fname: Path to write the baseline to
+        """
+        records = [record for record in records if record["error"] is None]
+        if not records:
+            sys.stderr.write(
+                "[{0}] Error: No valid coverage files to build the baseline "
+                "from!".format(datetime.now())
+            )
+            return
+
+        # logging
+        print(
+            "[{0}] Building baseline of {1} at {2} interval pair(s) from {3} "
+            "sample(s).".format(
+                datetime.now(), self.metric, len(self.plan.pairs),
+                len(records)
+            )
+        )
+        with self.profiler.stage("write_baseline") as counts:
+            baseline = self._build_baseline(
+                [record["values"] for record in records],
+                plan=self.plan,
+                metric=self.metric,
+            )
+            # written through a file object so .npz isn't appended
+            with open(fname, "wb") as out_file:
+                np.savez_compressed(out_file, **baseline)
+            counts["rows"] = len(records)
+            counts["bytes"] = os.path.getsize(fname)
+        # logging
+        print("[{0}] Baseline written to {1}".format(datetime.now(), fname))
+
+    @classmethod
+    def _load_baseline(cls, fname, plan, metric):
+        """ Method to load a baseline and line it up with the plan, so
+        samples are scored against it without any lookups.
+        :param: fname: Path to baseline from _write_baseline
+        :param: plan: IntervalPlan of the intervals to compare
+        :param: metric: Metric samples are scored on
+        :returns: Dictionary of the median and MAD of each plan region and
+                    pair, and the sorted fold changes of the normals,
+                    normals x pairs
+        """
+        with np.load(fname, allow_pickle=False) as archive:
+            baseline = {key: archive[key] for key in archive.files}
+        if int(baseline["version"]) != BASELINE_VERSION:
+            raise ValueError(
+                "Baseline version {0} is not supported".format(
+                    int(baseline["version"])
+                )
+            )
+        if str(baseline["metric"]) != metric:
+            raise ValueError(
+                "Baseline is of {0}, not {1}".format(
+                    str(baseline["metric"]), metric
+                )
+            )
+
+        region_index = {
+            (str(chrom), int(start), int(end)): i
+            for i, (chrom, start, end) in enumerate(zip(
+                baseline["region_chroms"],
+                baseline["region_starts"],
+                baseline["region_ends"],
+            ))
+        }
+        pair_index = {
+            (int(region1), int(region2)): p
+            for p, (region1, region2) in enumerate(zip(
+                baseline["pair_region1"], baseline["pair_region2"]
+            ))
+        }
+        missing = [key for key in plan.regions if key not in region_index]
+        if missing:
+            raise ValueError(
+                "Regions not in the baseline: {0}".format(
+                    ", ".join("{0}:{1}-{2}".format(*key) for key in missing)
+                )
+            )
+        columns = [region_index[key] for key in plan.regions]
+        pairs = [
+            pair_index.get((columns[region1], columns[region2]))
+            for region1, region2 in zip(
+                plan.region1_columns, plan.region2_columns
+            )
+        ]
+        if None in pairs:
+            raise ValueError(
+                "Interval pairs not in the baseline: {0}".format(
+                    ", ".join(
+                        "{0}/{1}".format(pair.name1, pair.name2)
+                        for pair, p in zip(plan.pairs, pairs) if p is None
+                    )
+                )
+            )
+
+        return {
+            "n_samples": int(baseline["n_samples"]),
+            "region_median": baseline["region_median"][columns],
+            "region_mad": baseline["region_mad"][columns],
+            "pair_median": baseline["pair_median"][pairs],
+            "pair_mad": baseline["pair_mad"][pairs],
+            "pair_normals": baseline["pair_normals"][:, pairs],
+        }
+
+    @classmethod
+    def _baseline_scores(cls, matrix, fold_change, baseline):
+        """ Method to score samples against a panel of normals baseline.
+        :param: matrix: Numpy array of the metric, samples x regions
+        :param: fold_change: Numpy array of fold changes, samples x pairs
+        :param: baseline: Baseline from _load_baseline
+        :returns: Tuple of the z-score of each region (samples x regions),
+                    and the z-score and empirical p-value (the fraction of
+                    normals with at least the same fold change) of each
+                    fold change (samples x pairs)
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            region_z = np.round(
+                (matrix - baseline["region_median"])
+                / (MAD_SCALE * baseline["region_mad"]),
+                9,
+            )
+            z_score = np.round(
+                (fold_change - baseline["pair_median"])
+                / (MAD_SCALE * baseline["pair_mad"]),
+                9,
+            )
+
+        p_value = np.full(fold_change.shape, np.nan)
+        for p in range(fold_change.shape[1]):
+            normals = baseline["pair_normals"][:, p]
+            # sorted with nan last
+            normals = normals[:np.count_nonzero(~np.isnan(normals))]
+            at_least = len(normals) - np.searchsorted(
+                normals, fold_change[:, p], side="left"
+            )
+            p_value[:, p] = (1.0 + at_least) / (1.0 + len(normals))
+        p_value[np.isnan(fold_change)] = np.nan
+
+        return region_z, z_score, np.round(p_value, 9)
+
+    def _result_key(self, record):
+        """ Method to return the key samples are ordered by in the results
+        of all samples: the name of the results file of the sample, as
+        generate_comparison_csv_to_xls.py reads them, or the sample id for
+        exon scans.
+        :param: record: Result record
+        :returns: String
+        """
+        if self.exons:
+            return record["sample_id"]
+
+        return "{0}{1}".format(record["sample_id"], self.out_fname_suffix)
+
+    def _score_results(self, records, plan, out_dir):
+        """ Method to compare the metric at every interval pair for all
+        processed samples at once, from a samples x regions matrix, and write
+        the results file of each sample.
+        :param: records: List of result records from _process_file
+        :param: plan: IntervalPlan of the intervals to compare
+        :param: out_dir: Path to output dir
+        :returns: Pandas dataframe with the results of all samples, in the
+                    order generate_comparison_csv_to_xls.py reads the
+                    per-sample files (sorted by filename)
+        """
+        records = sorted(
+            (record for record in records if record["error"] is None),
+            key=self._result_key,
+        )
+        if not records:
+            return pd.DataFrame()
+
+        # logging
+        print(
+            "[{0}] Comparing {1} at {2} interval pair(s) in {3} sample(s)."
+            .format(
+                datetime.now(), ", ".join(self.metrics), len(plan.pairs),
+                len(records),
+            )
+        )
+        with self.profiler.stage("compare_intervals") as counts:
+            results_df = self._metric_results_table(
+                [record["sample_id"] for record in records],
+                [record["values"] for record in records],
+                plan,
+                self.metric,
+                layout=self.layout,
+                baseline=self.baseline_data,
+            )
+            counts["rows"] = len(results_df)
+
+        n_rows = len(results_df) // len(records)
+        columns = results_df.columns.tolist()
+        for i, record in enumerate(records):
+            out_df = results_df.iloc[i * n_rows:(i + 1) * n_rows]
+            if self.sample_csv:
+                # create filename
+                fname = os.path.join(
+                    out_dir,
+                    "{0}{1}".format(
+                        record["sample_id"], self.out_fname_suffix
+                    ),
+                )
+                self.fname = fname
+                # results of reused files are already written
+                if not (
+                    record["reused"]
+                    and record["fname"] == fname
+                    and os.path.isfile(fname)
+                ):
+                    # write output to file
+                    with self.profiler.stage(
+                        "write_csv", record["stages"]
+                    ) as counts:
+                        out_df.to_csv(fname, index=False)
+                        counts["rows"] = len(out_df)
+                        counts["bytes"] = os.path.getsize(fname)
+                    # logging
+                    print(
+                        "[{0}] Results written to {1}".format(
+                            datetime.now(), fname
+                        )
+                    )
+                record["fname"] = fname
+            record["columns"] = columns
+            record["rows"] = out_df.values.tolist()
+
+        return results_df
+
+    @classmethod
+    def _scan_segments(cls, matrix, lengths, min_exons=2, min_flank=2):
+        """ Method to find the most duplicated run of consecutive exons of a
+        gene in every sample at once. Each segment's length weighted mean is
+        compared to the mean of the exons flanking it on both sides, the
+        rest of the gene, using prefix sums over
+        the exons so every segment of every sample is scored in a few
+        array operations.
+        :param: matrix: Numpy array of the metric, samples x exons in
+                        genomic order, missing values as nan
+        :param: lengths: Numpy array of the length of each exon
+        :param: min_exons: Minimum number of exons in a segment
+        :param: min_flank: Minimum number of exons on each side of a segment
+        :returns: Tuple of first exon, last exon (0-based, inclusive),
+                    segment mean, flank mean and fold change numpy arrays,
+                    one value per sample. Samples without a valid segment
+                    get nan means and fold change
+        """
+        matrix = np.asarray(matrix, dtype="float64")
+        valid = ~np.isnan(matrix)
+        weights = np.where(valid, np.asarray(lengths, dtype="float64"), 0.0)
+        # prefix sums of weights, weighted values and exon counts, with a
+        # leading zero so the sum of exons i..j-1 is sums[j] - sums[i]
+        sums = [
+            np.concatenate(
+                [np.zeros((len(matrix), 1)), np.cumsum(values, axis=1)],
+                axis=1,
+            )
+            for values in [
+                weights, np.where(valid, matrix, 0.0) * weights, valid
+            ]
+        ]
+        # every segment of exons first..last - 1
+        first, last = np.triu_indices(matrix.shape[1] + 1, 1)
+        segment_weight, segment_sum, segment_exons = [
+            total[:, last] - total[:, first] for total in sums
+        ]
+        flank_weight, flank_sum = [
+            total[:, -1:] - segment
+            for total, segment in zip(sums, [segment_weight, segment_sum])
+        ]
+        # exons flanking the segment on either side
+        left_exons = sums[2][:, first]
+        right_exons = sums[2][:, -1:] - sums[2][:, last]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            segment_mean = segment_sum / segment_weight
+            flank_mean = flank_sum / flank_weight
+            fold_change = segment_mean / flank_mean
+        scored = (
+            (segment_exons >= min_exons)
+            & (left_exons >= min_flank)
+            & (right_exons >= min_flank)
+            & np.isfinite(fold_change)
+        )
+        best = np.argmax(np.where(scored, fold_change, -np.inf), axis=1)
+        rows = np.arange(len(matrix))
+        found = scored[rows, best]
+
+        return (
+            first[best],
+            last[best] - 1,
+            np.where(found, segment_mean[rows, best], np.nan),
+            np.where(found, flank_mean[rows, best], np.nan),
+            np.where(found, fold_change[rows, best], np.nan),
+        )
+
+    def _scan_results(self, records, plan, out_dir):
+        """ Method to scan the exons of every gene of the plan for the most
+        duplicated segment of all processed samples at once, and write the
+        results of every sample and gene to a single table.
+        :param: records: List of result records from _process_file
+        :param: plan: IntervalPlan of the exons to scan
+        :param: out_dir: Path to output dir
+        :returns: Pandas dataframe with a row per sample and gene, sorted by
+                    sample id
+        """
+        records = sorted(
+            (record for record in records if record["error"] is None),
+            key=self._result_key,
+        )
+        if not records:
+            return pd.DataFrame()
+
+        # logging
+        print(
+            "[{0}] Scanning {1} at the exons of {2} gene(s) in {3} sample(s)."
+            .format(
+                datetime.now(), self.metric, len(plan.genes), len(records)
+            )
+        )
+        with self.profiler.stage("scan_exon_segments") as counts:
+            matrix = np.array(
+                [record["values"] for record in records], dtype="float64"
+            )
+            sample_ids = np.array(
+                [record["sample_id"] for record in records], dtype=object
+            )
+            tables = []
+            for gene, columns in plan.genes:
+                exons = [plan.regions[column] for column in columns]
+                first, last, segment_mean, flank_mean, fold_change = (
+                    self._scan_segments(
+                        matrix[:, list(columns)],
+                        [end - start + 1 for _, start, end in exons],
+                        min_exons=self.min_exons,
+                        min_flank=self.min_flank,
+                    )
+                )
+                fold_change = np.round(fold_change, 9)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    log2_fold_change = np.round(np.log2(fold_change), 9)
+                tables.append(pd.DataFrame({
+                    "sample_id": sample_ids,
+                    "gene": gene,
+                    "first_exon": first + 1,
+                    "last_exon": last + 1,
+                    "n_exons": last - first + 1,
+                    "chrom": exons[0][0],
+                    "start": [exons[i][1] for i in first],
+                    "end": [exons[i][2] for i in last],
+                    "segment_mean": np.round(segment_mean, 9),
+                    "flank_mean": np.round(flank_mean, 9),
+                    "fold_change": fold_change,
+                    "log2_fold_change": log2_fold_change,
+                    "above_cut_off": np.where(
+                        fold_change > self.dup_threshold, "TRUE", "FALSE"
+                    ).astype(object),
+                }, columns=list(plan.columns)))
+            # a row per sample and gene, grouped by sample
+            order = np.arange(len(tables) * len(records)).reshape(
+                len(tables), len(records)
+            ).T.ravel()
+            results_df = pd.concat(tables, ignore_index=True).iloc[order]
+            results_df = results_df.reset_index(drop=True)
+            counts["rows"] = len(results_df)
+
+        fname = os.path.join(
+            out_dir,
+            "{0}{1}".format(
+                "{0}_".format(self.run) if self.run else "", EXON_SCAN_FNAME
+            ),
+        )
+        with self.profiler.stage("write_csv") as counts:
+            results_df.to_csv(fname, index=False)
+            counts["rows"] = len(results_df)
+            counts["bytes"] = os.path.getsize(fname)
+        # logging
+        print("[{0}] Results written to {1}".format(datetime.now(), fname))
+
+        n_genes = len(plan.genes)
+        columns = results_df.columns.tolist()
+        for i, record in enumerate(records):
+            record["fname"] = fname
+            record["columns"] = columns
+            record["rows"] = results_df.iloc[
+                i * n_genes:(i + 1) * n_genes
+            ].values.tolist()
+
+        return results_df
+
+    def _process_file(self, file, plan, out_dir, data=None):
+        """ Method to read the metric at every interval of the coverage file.
+        The intervals are compared by _score_results once all files are read.
+        :param: file: Path to coverage file
+        :param: plan: IntervalPlan of the intervals to compare
+        :param: out_dir: Path to output fir
+        :param: data: Bytes of the file if already read by a prefetch thread
+        :returns: A result record dictionary with the file, sample_id,
+                metric value of each region of the plan (of each metric in
+                turn with several metrics), error message if
+                the file couldn't be processed, the pid and stages of the
+                process that read it, and whether the values were reused from
+                the manifest. The output fname, result columns and rows are
+                added by _score_results.
+        """
+        print(
+            "[{0}] Processing {1}".format(
+                datetime.now(), os.path.basename(file)
+            )
+        )
+        # get sample
+        if file == STDIN:
+            sample_id = self.stdin_sample_id
+        else:
+            sample_id = self._get_sample_id(
+                file=file, cov_file_pattern=self.cov_file_pattern
+            )
+        # kept in the record, as files are processed concurrently by
+        # workers and serve requests
+        record = {
+            "file": file,
+            "sample_id": sample_id,
+            "values": [],
+            "fname": None,
+            "columns": [],
+            "rows": [],
+            "error": None,
+            "pid": os.getpid(),
+            "stages": {},
+            "reused": False,
+        }
+        try:
+            # read the file once, looking up the regions of every pair
+            with self.profiler.stage(
+                "parse_coverage", record["stages"]
+            ) as counts:
+                region_values = self._read_regions(
+                    file,
+                    plan.region_set,
+                    metric=self.metric,
+                    stats=counts,
+                    data=data,
+                )
+            # every region has to be found to compare the pairs
+            missing = sorted(plan.region_set.difference(region_values))
+            if missing:
+                raise ValueError(
+                    "Regions not found in the coverage file: {0}".format(
+                        ", ".join(
+                            "{0}:{1}-{2}".format(*key) for key in missing
+                        )
+                    )
+                )
+            if isinstance(self.metric, str):
+                record["values"] = [
+                    region_values[key] for key in plan.regions
+                ]
+            else:
+                # the values of each metric in turn
+                record["values"] = [
+                    region_values[key][m]
+                    for m in range(len(self.metrics))
+                    for key in plan.regions
+                ]
+        except Exception as e:
+            sys.stderr.write("[{0}] Error: {1}".format(datetime.now(), str(e)))
+            sys.stderr.write(
+                "[{0}] Error: {1} coverage file is invalid "
+                "(tsv malformed/missing intervals)".format(
+                    datetime.now(), os.path.basename(file)
+                )
+            )
+            record["error"] = str(e)
+
+        return record
+
+    def _plan_mtimes(self):
+        """ Method to return the mtime and size of the intervals and baseline
+        files, to tell when they change while serving.
+        :returns: Tuple of (mtime_ns, size), or None, of each file
+        """
+        mtimes = []
+        for fname in [self.intervals, self.baseline]:
+            if not fname:
+                mtimes.append(None)
+                continue
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                # mid replace, keep serving the loaded plan
+                return getattr(self, "plan_mtimes", None)
+            mtimes.append((stat.st_mtime_ns, stat.st_size))
+
+        return tuple(mtimes)
+
+    def _reload_if_changed(self):
+        """ Method to compile the plan again, and line the baseline up with
+        it, if the intervals or baseline file changed since they were loaded.
+        The loaded plan is kept if the changed files can't be used.
+        :returns: True if reloaded
+        """
+        mtimes = self._plan_mtimes()
+        if mtimes == self.plan_mtimes:
+            return False
+        with self.plan_lock:
+            # another request may have reloaded already
+            if mtimes == self.plan_mtimes:
+                return False
+            self.plan_mtimes = mtimes
+            try:
+                plan = IntervalPlan.from_intervals(
+                    self._import_intervals(
+                        intervals=self.intervals,
+                        dup_threshold=self.dup_threshold,
+                    )
+                )
+                baseline_data = None
+                if self.baseline:
+                    baseline_data = self._load_baseline(
+                        self.baseline, plan=plan, metric=self.metric
+                    )
+            except Exception as e:
+                sys.stderr.write(
+                    "[{0}] Error: {1}, keeping the loaded intervals\n".format(
+                        datetime.now(), str(e).replace("\n", "; ")
+                    )
+                )
+                return False
+            self.plan, self.baseline_data = plan, baseline_data
+        print(
+            "[{0}] Reloaded {1} interval pair(s) from {2}".format(
+                datetime.now(), len(plan.pairs), self.intervals
+            )
+        )
+
+        return True
+
+    def _health(self):
+        """ Method to describe what is being served.
+        :returns: Dictionary
+        """
+        with self.plan_lock:
+            plan = self.plan
+        return {
+            "status": "ok",
+            "intervals": self.intervals,
+            "plan": plan.digest,
+            "pairs": len(plan.pairs),
+            "regions": len(plan.regions),
+            "metric": self.metric,
+            "baseline": self.baseline,
+        }
+
+    def _score_request(self, file=None, data=None, sample_id="sample"):
+        """ Method to score a single coverage file for a serve request, with
+        the plan and baseline loaded when it arrives.
+        :param: file: Path to coverage file OR
+        :param: data: Bytes of the coverage file, plain or gzip compressed
+        :param: sample_id: Sample id of the coverage file given as data
+        :returns: Tuple of HTTP status and result dictionary with the
+                    sample_id, result columns and rows, or error
+        """
+        self._reload_if_changed()
+        with self.plan_lock:
+            plan, baseline_data = self.plan, self.baseline_data
+        if data is not None:
+            file = sample_id
+            if data[:2] == GZIP_MAGIC:
+                try:
+                    data = gzip.decompress(data)
+                except (OSError, EOFError, zlib.error) as e:
+                    return 400, {"sample_id": sample_id, "error": str(e)}
+
+        record = self._process_file(
+            file=file, plan=plan, out_dir=self.out_dir, data=data
+        )
+        if record["error"] is not None:
+            return 422, {
+                "sample_id": record["sample_id"], "error": record["error"]
+            }
+        results_df = self._metric_results_table(
+            [record["sample_id"]],
+            [record["values"]],
+            plan,
+            self.metric,
+            layout=self.layout,
+            baseline=baseline_data,
+            dtype="float64",
+        )
+
+        return 200, {
+            "sample_id": record["sample_id"],
+            "columns": results_df.columns.tolist(),
+            # nan isn't valid json
+            "rows": results_df.astype(object).where(
+                results_df.notna(), None
+            ).values.tolist(),
+        }
+
+    def _serve(self):
+        """ Method to serve scoring requests until interrupted, over HTTP on
+        (host, port) or on a Unix socket, as given by serve.
+        """
+        if isinstance(self.serve, str):
+            # remove the socket left by a previous server
+            if os.path.exists(self.serve) and stat.S_ISSOCK(
+                os.stat(self.serve).st_mode
+            ):
+                os.remove(self.serve)
+            server = TDHunterUnixServer(self.serve, self)
+            address = self.serve
+        else:
+            server = TDHunterHTTPServer(tuple(self.serve), self)
+            address = "http://{0}:{1}".format(*server.server_address[:2])
+        print(
+            "[{0}] Serving {1} interval pair(s) from {2} on {3}".format(
+                datetime.now(), len(self.plan.pairs), self.intervals, address
+            )
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if isinstance(self.serve, str) and os.path.exists(self.serve):
+                os.remove(self.serve)
+
+    def __call__(self, file):
+        return self._process_file(
+            file=file, plan=self.plan, out_dir=self.out_dir
+        )
+
+
+# instance of TDHunter used by each batch worker process, set once by the
+# pool initialiser
+_WORKER_HUNTER = None
+
+
+def _init_worker(hunter):
+    """ Store the TDHunter instance sent to a new batch worker process. """
+    global _WORKER_HUNTER
+    _WORKER_HUNTER = hunter
+    if hunter.cprofile_dir:
+        # dumped when the worker exits after the pool is closed
+        profile = StageProfiler.start_cprofile(hunter.cprofile_dir, "worker")
+        Finalize(
+            None, StageProfiler.stop_cprofile, args=(profile,),
+            exitpriority=10,
+        )
+
+
+def _process_worker(file):
+    """ Process a coverage file in a batch worker process. """
+    hunter = _WORKER_HUNTER
+    return hunter._process_file(
+        file=file, plan=hunter.plan, out_dir=hunter.out_dir
+    )
+
+
+def _process_prefetched_worker(task):
+    """ Process a coverage file already read into memory in a batch worker
+    process. """
+    file, data = task
+    hunter = _WORKER_HUNTER
+    return hunter._process_file(
+        file=file, plan=hunter.plan, out_dir=hunter.out_dir, data=data
+    )
+
+
+class TDHunterRequestHandler(BaseHTTPRequestHandler):
+    """ HTTP request handler of the serve subcommand, scoring coverage files
+        with the TDHunter instance of its server.
+        GET /health describes the loaded intervals
+        POST /score?file=PATH scores a coverage file on disk, or
+        POST /score?sample_id=ID with the coverage file (plain or gzip) as
+        the request body. Results are json, or csv with &format=csv
+    """
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return str(self.client_address[0])
+        return "unix"
+
+    def log_message(self, format, *args):
+        print("[{0}] {1} {2}".format(
+            datetime.now(), self.address_string(), format % args
+        ))
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self._send(404, {"error": "Not found"})
+            return
+        self._send(200, self.server.hunter._health())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/score":
+            self._send(404, {"error": "Not found"})
+            return
+        query = parse_qs(url.query)
+        file = query.get("file", [None])[0]
+        data = self._read_body()
+        if (file is None) == (data is None):
+            self._send(
+                400, {"error": "Give a coverage file path or its content"}
+            )
+            return
+        status, result = self.server.hunter._score_request(
+            file=file,
+            data=data,
+            sample_id=query.get("sample_id", ["sample"])[0],
+        )
+        self._send(status, result, query.get("format", ["json"])[0])
+
+    def _read_body(self):
+        """ Read the request body, sent whole or in chunks.
+        :returns: Bytes, or None without a body
+        """
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks) or None
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else None
+
+    def _send(self, status, result, response_format="json"):
+        """ Send a result as json, or as csv if it has rows. """
+        if response_format == "csv" and "rows" in result:
+            body = pd.DataFrame(
+                result["rows"], columns=result["columns"]
+            ).to_csv(index=False).encode()
+            content_type = "text/csv"
+        else:
+            body = json.dumps(result).encode()
+            content_type = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TDHunterHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ Threaded HTTP server answering requests with a TDHunter instance. """
+    daemon_threads = True
+
+    def __init__(self, address, hunter):
+        self.hunter = hunter
+        HTTPServer.__init__(self, address, TDHunterRequestHandler)
+
+
+class TDHunterUnixServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    """ Threaded HTTP server on a Unix socket answering requests with a
+        TDHunter instance. """
+    daemon_threads = True
+
+    def __init__(self, address, hunter):
+        self.hunter = hunter
+        socketserver.UnixStreamServer.__init__(
+            self, address, TDHunterRequestHandler
+        )
+
+
+def tdh_index(args):
+    """ Build byte offset indexes for the given coverage file(s). """
+    args = tdh_index_argument_parser(args)
+    if args.file:
+        files = [args.file]
+    else:
+        files = TDHunter._find_coverage_files(
+            batch_dir=args.batch, cov_file_pattern=args.cov_file_pattern
+        )
+    for file in files:
+        TDHunter.index_coverage_file(file, index_dir=args.index_dir)
+
+
+def tdh_baseline(args):
+    """ Build a panel of normals baseline from a batch of coverage files. """
+    args = tdh_baseline_argument_parser(args)
+    TDHunter(
+        batch=args.batch,
+        intervals=args.intervals,
+        baseline_out=args.output,
+        processes=args.processes,
+        cov_file_pattern=args.cov_file_pattern,
+        metric=args.metric,
+        engine=args.engine,
+        match=args.match,
+        index=args.index,
+        index_dir=args.index_dir,
+        cache_dir=args.cache_dir,
+    )
+
+
+def tdh_query(args):
+    """ Export filtered results from a results database. """
+    args = tdh_query_argument_parser(args)
+    results_df = TDHunter.query_db(
+        args.db,
+        runs=args.run,
+        last_runs=args.last_runs,
+        samples=args.sample,
+        pair=args.pair,
+        metric=args.metric,
+        plan=args.plan,
+        calls_only=args.calls_only,
+    )
+    output_format = args.format or (
+        "xlsx" if args.output.lower().endswith(".xlsx") else "csv"
+    )
+    if output_format == "xlsx":
+        results_df.to_excel(args.output, index=False, header=True)
+    else:
+        results_df.to_csv(args.output, index=False)
+    print(
+        "[{0}] {1} result(s) written to {2}".format(
+            datetime.now(), len(results_df), args.output
+        )
+    )
+
+
+def tdh_merge(args):
+    """ Merge the results of the shards of a batch into cohort tables. """
+    args = tdh_merge_argument_parser(args)
+    partials = []
+    for path in args.shards:
+        if os.path.isdir(path):
+            partials.extend(sorted(
+                os.path.join(path, fname) for fname in os.listdir(path)
+                # with or without a run prefix
+                if fnmatch.fnmatch(fname, "*" + SHARD_FNAME.format("*", "*"))
+            ))
+        else:
+            partials.append(path)
+    try:
+        results_df, run, failed, sample_ids = TDHunter.merge_shards(
+            partials
+        )
+    except (IOError, OSError, ValueError, KeyError) as e:
+        sys.stderr.write("{0}\n".format(str(e)))
+        sys.stderr.write(
+            "[{0}] Error: Shards can't be merged! Exiting...!\n".format(
+                datetime.now()
+            )
+        )
+        sys.exit(1)
+    for file in failed:
+        sys.stderr.write(
+            "[{0}] Error: {1} coverage file is invalid\n".format(
+                datetime.now(), file
+            )
+        )
+    print(
+        "[{0}] Merged {1} shard(s), {2} result row(s)".format(
+            datetime.now(), len(partials), len(results_df)
+        )
+    )
+    try:
+        TDHunter._write_cohort(
+            results_df,
+            cohort_dir=args.cohort_dir,
+            cohort_formats=args.cohort_formats,
+            run=args.run or run,
+            sample_ids=sample_ids,
+        )
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write("{0}\n".format(str(e)))
+        sys.stderr.write(
+            "[{0}] Error: Cohort tables can't be written! Exiting...!\n"
+            .format(datetime.now())
+        )
+        sys.exit(1)
+
+
+def tdh_serve(args):
+    """ Serve scoring requests until interrupted. """
+    args = tdh_serve_argument_parser(args)
+    TDHunter(
+        intervals=args.intervals,
+        baseline=args.baseline,
+        serve=args.socket or (args.host, args.port),
+        dup_threshold=args.dup_threshold,
+        cov_file_pattern=args.cov_file_pattern,
+        metric=args.metric,
+        engine=args.engine,
+        match=args.match,
+        index=args.index,
+        index_dir=args.index_dir,
+    )
+
+
+def tdh_scan(args):
+    """ Scan the exons of whole genes for duplicated segments. """
+    args = tdh_scan_argument_parser(args)
+    TDHunter(
+        file=args.file,
+        batch=args.batch,
+        exons=args.bed,
+        min_exons=args.min_exons,
+        min_flank=args.min_flank,
+        dup_threshold=args.dup_threshold,
+        out_dir=args.out_dir,
+        run=args.run,
+        processes=args.processes,
+        cov_file_pattern=args.cov_file_pattern,
+        metric=args.metric,
+        engine=args.engine,
+        match=args.match,
+        index=args.index,
+        index_dir=args.index_dir,
+        cache_dir=args.cache_dir,
+        profile=args.profile,
+    )
+
+
+# subcommands run as TandemHunter.py <subcommand> [args]
+SUBCOMMANDS = {
+    "index": tdh_index,
+    "scan": tdh_scan,
+    "baseline": tdh_baseline,
+    "serve": tdh_serve,
+    "query": tdh_query,
+    "merge": tdh_merge,
+}
+
+
+if __name__ == "__main__":
+    # run subcommands
+    if sys.argv[1:2] and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        sys.exit()
+    # parse the command line arguments
+    args = tdh_argument_parser(sys.argv[1:])
+    # process the coverage file(s)
+    TDHunter(
+        file=args.file,
+        batch=args.batch,
+        intervals=args.intervals,
+        dup_threshold=args.dup_threshold,
+        out_dir=args.out_dir,
+        out_fname_suffix=args.out_fname_suffix,
+        processes=args.processes,
+        memory_budget=args.memory_budget,
+        schedule=args.schedule,
+        shard=args.shard,
+        cov_file_pattern=args.cov_file_pattern,
+        include=args.include,
+        exclude=args.exclude,
+        symlinks=args.symlinks,
+        metric=args.metric,
+        layout=args.layout,
+        engine=args.engine,
+        match=args.match,
+        full_scan=args.full_scan,
+        index=args.index,
+        index_dir=args.index_dir,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        cohort_dir=args.cohort_dir,
+        cohort_formats=args.cohort_formats,
+        run=args.run,
+        sample_csv=not args.no_sample_csv,
+        profile=args.profile,
+        cprofile_dir=args.cprofile_dir,
+        prefetch_threads=args.prefetch_threads,
+        prefetch_budget=args.prefetch_budget,
+        incremental=args.incremental,
+        baseline=args.baseline,
+        stdin_sample_id=args.sample_id,
+        stdout_format=args.stdout,
+        db=args.db,
+    )
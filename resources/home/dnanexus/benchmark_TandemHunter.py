@@ -0,0 +1,329 @@
+"""
+script to benchmark TandemHunter on synthetic coverage files
+
+Generates (or reuses) batches of synthetic PER_TARGET_COVERAGE files with
+generate_test_coverage.py and times TandemHunter on them, each run in a
+fresh process so timings and peak memory are not shared between runs:
+
+- single: latency of one coverage file, per reading engine
+- batch: throughput of a batch directory
+- collate_xlsx: collating the per-sample csvs of a batch into the run .xlsx
+  with generate_comparison_csv_to_xls.py
+- cohort_xlsx: a batch written straight to the run .xlsx (--cohort-dir)
+
+Results are written as json, so runs can be compared across commits.
+"""
+
+import argparse
+from datetime import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from generate_test_coverage import PROFILES, generate_batch
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TANDEM_HUNTER = os.path.join(SCRIPT_DIR, "TandemHunter.py")
+COLLATE_XLSX = os.path.join(SCRIPT_DIR, "generate_comparison_csv_to_xls.py")
+COV_SUFFIX = ".pertarget_coverage.tsv"
+CASES = ["single", "batch", "collate_xlsx", "cohort_xlsx"]
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--work-dir', default="tdh_benchmark",
+        help=(
+            'directory to generate coverage files in and write run outputs '
+            'to, generated files are reused between runs'
+        )
+    )
+    parser.add_argument(
+        '--profiles', nargs="+", choices=sorted(PROFILES),
+        default=["kmt2a", "panel"],
+        help='target layouts of the synthetic coverage files'
+    )
+    parser.add_argument(
+        '--batch-sizes', nargs="+", type=int, default=[10, 100],
+        help='number of samples of each batch, e.g. 10 100 1000'
+    )
+    parser.add_argument(
+        '--engines', nargs="+", default=["auto", "pandas", "scan"],
+        help='reading engines to time single file latency of'
+    )
+    parser.add_argument(
+        '--cases', nargs="+", choices=CASES, default=CASES,
+        help='benchmarks to run'
+    )
+    parser.add_argument(
+        '--repeats', type=int, default=3,
+        help='number of times each benchmark is run'
+    )
+    parser.add_argument(
+        '--intervals',
+        default=os.path.join(SCRIPT_DIR, "inputs", "intervals_b38.json"),
+        help='intervals json to run TandemHunter with'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=1,
+        help='random seed of the synthetic coverage files'
+    )
+    parser.add_argument(
+        '--out', help='json file to write results to, default stdout'
+    )
+
+    return parser.parse_args()
+
+
+def git_commit():
+    """Returns the commit TandemHunter is checked out at, if known"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=SCRIPT_DIR,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_datasets(work_dir, profiles, batch_sizes, intervals, seed):
+    """Generates the largest batch of each profile once, smaller batches
+    link to its first files
+
+    Returns:
+    -datasets(dict): (profile, samples) -> batch directory
+    """
+    datasets = {}
+    samples = max(batch_sizes)
+    for profile in profiles:
+        source = os.path.join(
+            work_dir, "data", "{0}_seed{1}".format(profile, seed)
+        )
+        files = sorted(glob.glob(os.path.join(source, "*" + COV_SUFFIX)))
+        if len(files) < samples:
+            print("[{0}] Generating {1} {2} coverage files".format(
+                datetime.now(), samples, profile
+            ))
+            files = generate_batch(
+                profile, samples, source, intervals, suffix=COV_SUFFIX,
+                seed=seed
+            )
+
+        for size in batch_sizes:
+            batch_dir = os.path.join(
+                work_dir, "data", "{0}_{1}".format(profile, size)
+            )
+            if os.path.isdir(batch_dir):
+                shutil.rmtree(batch_dir)
+            os.makedirs(batch_dir)
+            for file in files[:size]:
+                os.symlink(
+                    os.path.abspath(file),
+                    os.path.join(batch_dir, os.path.basename(file))
+                )
+            datasets[(profile, size)] = batch_dir
+
+    return datasets
+
+
+def run_command(cmd, cwd=None):
+    """Runs a command to completion in a new process
+
+    Returns:
+    -usage(dict): wall and cpu seconds and peak rss (kb) of the process
+    """
+    with open(os.devnull, "w") as devnull:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            cmd, cwd=cwd, stdout=devnull, stderr=subprocess.PIPE
+        )
+        stderr = proc.stderr.read()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.stderr.close()
+        # the process was reaped by wait4, so Popen must not wait on it
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if proc.returncode != 0:
+        raise RuntimeError("{0} failed:\n{1}".format(
+            " ".join(cmd), stderr.decode(errors="replace")
+        ))
+
+    return {
+        "wall_s": wall,
+        "cpu_s": rusage.ru_utime + rusage.ru_stime,
+        "max_rss_kb": rusage.ru_maxrss,
+    }
+
+
+def summarise(runs, files=1):
+    """Summarises repeated runs of a benchmark"""
+    wall = [run["wall_s"] for run in runs]
+    summary = {
+        "repeats": len(runs),
+        "wall_s": {
+            "median": round(float(np.median(wall)), 6),
+            "min": round(min(wall), 6),
+            "max": round(max(wall), 6),
+        },
+        "cpu_s": round(float(np.median([run["cpu_s"] for run in runs])), 6),
+        "max_rss_kb": max(run["max_rss_kb"] for run in runs),
+    }
+    summary["files_per_s"] = round(files / summary["wall_s"]["median"], 3)
+
+    return summary
+
+
+def tandem_hunter_cmd(args, out_dir, *options):
+    """Returns the command to run TandemHunter with"""
+    return [
+        sys.executable, TANDEM_HUNTER,
+        "--intervals", args.intervals,
+        "--cov-file-pattern", COV_SUFFIX,
+        "-O", out_dir,
+    ] + list(options)
+
+
+def fresh_dir(path):
+    """Returns an empty directory at path"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    return path
+
+
+def run_benchmarks(args, datasets):
+    """Runs the requested benchmarks
+
+    Returns:
+    -results(list): summary of each benchmark
+    """
+    results = []
+    out_root = os.path.join(args.work_dir, "out")
+
+    for (profile, size), batch_dir in sorted(datasets.items()):
+        files = sorted(glob.glob(os.path.join(batch_dir, "*" + COV_SUFFIX)))
+        out_dir = os.path.join(out_root, "{0}_{1}".format(profile, size))
+        with open(files[0]) as cov_file:
+            rows = sum(1 for _ in cov_file) - 1
+        case = {
+            "profile": profile,
+            "samples": size,
+            "rows_per_file": rows,
+            "bytes_per_file": os.path.getsize(files[0]),
+        }
+
+        if "single" in args.cases and size == min(args.batch_sizes):
+            for engine in args.engines:
+                print("[{0}] Timing single {1} file, {2} engine".format(
+                    datetime.now(), profile, engine
+                ))
+                runs = [
+                    run_command(tandem_hunter_cmd(
+                        args, fresh_dir(out_dir), "-F", files[0],
+                        "--engine", engine
+                    ))
+                    for _ in range(args.repeats)
+                ]
+                results.append(dict(
+                    case, case="single", engine=engine, samples=1,
+                    **summarise(runs)
+                ))
+
+        if "batch" in args.cases or "collate_xlsx" in args.cases:
+            print("[{0}] Timing batch of {1} {2} files".format(
+                datetime.now(), size, profile
+            ))
+            runs = [
+                run_command(tandem_hunter_cmd(
+                    args, fresh_dir(out_dir), "-B", batch_dir
+                ))
+                for _ in range(args.repeats)
+            ]
+            if "batch" in args.cases:
+                results.append(dict(
+                    case, case="batch", **summarise(runs, files=size)
+                ))
+
+        if "collate_xlsx" in args.cases:
+            print("[{0}] Timing xlsx collation of {1} {2} csvs".format(
+                datetime.now(), size, profile
+            ))
+            csvs = sorted(
+                os.path.abspath(csv) for csv in
+                glob.glob(os.path.join(out_dir, "*.cvg_comparison.csv"))
+            )
+            runs = [
+                run_command(
+                    [sys.executable, COLLATE_XLSX, "--comparison_csv"]
+                    + csvs, cwd=out_dir
+                )
+                for _ in range(args.repeats)
+            ]
+            results.append(dict(
+                case, case="collate_xlsx", **summarise(runs, files=size)
+            ))
+
+        if "cohort_xlsx" in args.cases:
+            print("[{0}] Timing cohort xlsx of {1} {2} files".format(
+                datetime.now(), size, profile
+            ))
+            runs = [
+                run_command(tandem_hunter_cmd(
+                    args, fresh_dir(out_dir), "-B", batch_dir,
+                    "--cohort-dir", out_dir, "--cohort-formats", "xlsx",
+                    "--no-sample-csv"
+                ))
+                for _ in range(args.repeats)
+            ]
+            results.append(dict(
+                case, case="cohort_xlsx", **summarise(runs, files=size)
+            ))
+
+    return results
+
+
+def main():
+    args = parse_args()
+    datasets = prepare_datasets(
+        args.work_dir, args.profiles, args.batch_sizes, args.intervals,
+        args.seed
+    )
+    results = run_benchmarks(args, datasets)
+
+    report = {
+        "date": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": vars(args),
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+        print("[{0}] Results written to {1}".format(
+            datetime.now(), args.out
+        ))
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+script to generate synthetic PER_TARGET_COVERAGE files (as from Picard
+CollectHsMetrics) for testing and benchmarking TandemHunter
+
+Targets are laid out across GRCh38 and always include the regions of the
+given intervals json, so the generated files can be run through TandemHunter
+with the same intervals. A fraction of samples are generated with a
+duplication of the first region of each pair.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+# GRCh38 chromosome lengths
+CHROM_LENGTHS = {
+    "chr1": 248956422,
+    "chr2": 242193529,
+    "chr3": 198295559,
+    "chr4": 190214555,
+    "chr5": 181538259,
+    "chr6": 170805979,
+    "chr7": 159345973,
+    "chr8": 145138636,
+    "chr9": 138394717,
+    "chr10": 133797422,
+    "chr11": 135086622,
+    "chr12": 133275309,
+    "chr13": 114364328,
+    "chr14": 107043718,
+    "chr15": 101991189,
+    "chr16": 90338345,
+    "chr17": 83257441,
+    "chr18": 80373285,
+    "chr19": 58617616,
+    "chr20": 64444167,
+    "chr21": 46709983,
+    "chr22": 50818468,
+    "chrX": 156040895,
+    "chrY": 57227415,
+}
+
+# KMT2A gene span on GRCh38, used for the KMT2A only profile
+KMT2A_SPAN = ("chr11", 118436456, 118526832)
+
+# number of targets (or bin size for genome) of each profile
+PROFILES = {
+    "kmt2a": 36,
+    "panel": 50000,
+    "exome": 200000,
+    "genome": 10000,
+}
+
+# largest amount of data in one BGZF block, as used by bgzip
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+COLUMNS = [
+    "chrom",
+    "start",
+    "end",
+    "length",
+    "name",
+    "%gc",
+    "mean_coverage",
+    "normalized_coverage",
+    "min_normalized_coverage",
+    "max_normalized_coverage",
+    "min_coverage",
+    "max_coverage",
+    "pct_0x",
+    "read_count",
+]
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--profile', choices=sorted(PROFILES), default="kmt2a",
+        help=(
+            'target layout: KMT2A exons only, a 50k target panel, a 200k '
+            'target exome or genome wide 10kb bins'
+        )
+    )
+    parser.add_argument(
+        '--samples', type=int, default=1,
+        help='number of coverage files to generate'
+    )
+    parser.add_argument(
+        '--out-dir', required=True,
+        help='directory to write coverage files to'
+    )
+    parser.add_argument(
+        '--intervals',
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "inputs", "intervals_b38.json"
+        ),
+        help='intervals json whose regions are included as targets'
+    )
+    parser.add_argument(
+        '--positive-fraction', type=float, default=0.1,
+        help='fraction of samples generated with a duplication'
+    )
+    parser.add_argument(
+        '--suffix', default=".pertarget_coverage.tsv",
+        help='filename suffix of the coverage files'
+    )
+    parser.add_argument(
+        '--compress', choices=["gzip", "bgzf"], default=None,
+        help='compress the coverage files, adding .gz to the suffix'
+    )
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+
+    return parser.parse_args()
+
+
+def interval_regions(intervals):
+    """Returns the (chrom, start, end) of every region in an intervals json,
+    and the regions duplicated in positive samples (region1 of each pair)
+    """
+    with open(intervals) as json_file:
+        pairs = json.load(json_file)
+    regions = set()
+    duplicated = set()
+    for pair in pairs:
+        for region in ["region1", "region2"]:
+            regions.add(tuple(
+                pair[region][key] for key in ["chrom", "start", "end"]
+            ))
+        duplicated.add(tuple(
+            pair["region1"][key] for key in ["chrom", "start", "end"]
+        ))
+
+    return regions, duplicated
+
+
+def generate_targets(profile, regions, rng):
+    """Generates the sorted, non-overlapping targets of a profile
+
+    Returns:
+    -targets(df): chrom, start, end, length and name of each target, which
+    includes all the given regions
+    """
+    if profile == "genome":
+        chroms, starts, ends = [], [], []
+        for chrom, length in CHROM_LENGTHS.items():
+            chrom_starts = np.arange(1, length, PROFILES[profile])
+            chroms.append(np.repeat(chrom, len(chrom_starts)))
+            starts.append(chrom_starts)
+            ends.append(np.minimum(
+                chrom_starts + PROFILES[profile] - 1, length
+            ))
+        targets = pd.DataFrame({
+            "chrom": np.concatenate(chroms),
+            "start": np.concatenate(starts),
+            "end": np.concatenate(ends),
+        })
+    else:
+        if profile == "kmt2a":
+            spans = {KMT2A_SPAN[0]: KMT2A_SPAN[1:]}
+        else:
+            spans = {chrom: (1, length)
+                     for chrom, length in CHROM_LENGTHS.items()}
+        total = sum(end - start for start, end in spans.values())
+        frames = []
+        for chrom, (span_start, span_end) in spans.items():
+            n = max(1, int(round(
+                PROFILES[profile] * (span_end - span_start) / float(total)
+            )))
+            # spread targets evenly with jitter, so they never overlap
+            step = (span_end - span_start) // n
+            starts = (
+                span_start + np.arange(n) * step
+                + rng.integers(0, max(1, step // 2), n)
+            )
+            lengths = rng.integers(100, min(400, max(101, step // 2)), n)
+            frames.append(pd.DataFrame({
+                "chrom": chrom, "start": starts, "end": starts + lengths - 1
+            }))
+        targets = pd.concat(frames, ignore_index=True)
+
+    # swap in the regions of the intervals, dropping targets they overlap
+    for chrom, start, end in regions:
+        overlap = (
+            (targets["chrom"] == chrom)
+            & (targets["start"] <= end) & (targets["end"] >= start)
+        )
+        targets = targets[~overlap]
+    targets = pd.concat(
+        [targets, pd.DataFrame(sorted(regions),
+                               columns=["chrom", "start", "end"])],
+        ignore_index=True,
+    )
+
+    # sort in reference order, as Picard does
+    order = {chrom: i for i, chrom in enumerate(CHROM_LENGTHS)}
+    targets["order"] = targets["chrom"].map(order)
+    targets = targets.sort_values(["order", "start"]).drop(columns="order")
+    targets = targets.reset_index(drop=True)
+    targets["length"] = targets["end"] - targets["start"] + 1
+    targets["name"] = ["target_{0}".format(i) for i in range(len(targets))]
+
+    return targets
+
+
+def generate_coverage(targets, duplicated, positive, rng):
+    """Generates the coverage of a sample at every target
+
+    Returns:
+    -coverage(df): PER_TARGET_COVERAGE table of the sample
+    """
+    n = len(targets)
+    normalized = rng.gamma(shape=20.0, scale=0.05, size=n)
+    if positive:
+        dup = np.zeros(n, dtype=bool)
+        for chrom, start, end in duplicated:
+            dup |= (
+                (targets["chrom"] == chrom).values
+                & (targets["start"] == start).values
+                & (targets["end"] == end).values
+            )
+        normalized[dup] *= 1.8
+    depth = 300.0
+    coverage = targets.copy()
+    coverage["%gc"] = np.round(rng.uniform(0.3, 0.7, n), 6)
+    coverage["mean_coverage"] = np.round(normalized * depth, 6)
+    coverage["normalized_coverage"] = np.round(normalized, 6)
+    coverage["min_normalized_coverage"] = np.round(normalized * 0.6, 6)
+    coverage["max_normalized_coverage"] = np.round(normalized * 1.3, 6)
+    coverage["min_coverage"] = (normalized * depth * 0.6).astype(int)
+    coverage["max_coverage"] = (normalized * depth * 1.3).astype(int)
+    coverage["pct_0x"] = 0
+    coverage["read_count"] = (
+        normalized * depth * targets["length"].values / 150.0
+    ).astype(int)
+
+    return coverage[COLUMNS]
+
+
+def write_bgzf(data, file):
+    """Writes bytes to a BGZF file, as bgzip does"""
+    with open(file, "wb") as out_file:
+        for start in range(0, len(data), BGZF_BLOCK_SIZE):
+            block = data[start:start + BGZF_BLOCK_SIZE]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+            # gzip header with a BC extra subfield holding the block size - 1
+            out_file.write(
+                b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+            )
+            out_file.write(struct.pack("<H", len(cdata) + 25))
+            out_file.write(cdata)
+            out_file.write(struct.pack("<II", zlib.crc32(block), len(block)))
+        out_file.write(BGZF_EOF)
+
+
+def write_coverage(coverage, file, compress=None):
+    """Writes a coverage table, compressed with gzip or bgzf if given"""
+    data = coverage.to_csv(sep="\t", index=False).encode()
+    if compress == "bgzf":
+        write_bgzf(data, file)
+    elif compress == "gzip":
+        with gzip.open(file, "wb") as out_file:
+            out_file.write(data)
+    else:
+        with open(file, "wb") as out_file:
+            out_file.write(data)
+
+
+def generate_batch(profile, samples, out_dir, intervals,
+                   positive_fraction=0.1, suffix=".pertarget_coverage.tsv",
+                   seed=1, compress=None):
+    """Writes a batch of synthetic coverage files
+
+    Returns:
+    -files(list): paths of the coverage files written
+    """
+    rng = np.random.default_rng(seed)
+    regions, duplicated = interval_regions(intervals)
+    targets = generate_targets(profile, regions, rng)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    files = []
+    n_positive = int(round(samples * positive_fraction))
+    for i in range(samples):
+        coverage = generate_coverage(
+            targets, duplicated, positive=i < n_positive, rng=rng
+        )
+        file = os.path.join(
+            out_dir, "{0}_sample_{1:04d}{2}{3}".format(
+                profile, i + 1, suffix, ".gz" if compress else ""
+            )
+        )
+        write_coverage(coverage, file, compress)
+        files.append(file)
+
+    return files
+
+
+def main():
+    args = parse_args()
+    files = generate_batch(
+        profile=args.profile,
+        samples=args.samples,
+        out_dir=args.out_dir,
+        intervals=args.intervals,
+        positive_fraction=args.positive_fraction,
+        suffix=args.suffix,
+        seed=args.seed,
+        compress=args.compress,
+    )
+    print("{0} coverage files written to {1}".format(len(files), args.out_dir))
+
+
+if __name__ == "__main__":
+    main()
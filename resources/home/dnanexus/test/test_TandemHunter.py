@@ -3,11 +3,35 @@
 # Date created: 2021-04-07
 # Date modified:
 
-from ..TandemHunter import TDHunter, tdh_argument_parser
+from ..TandemHunter import (
+    TDHunter,
+    tdh_argument_parser,
+    tdh_query,
+    tdh_merge,
+    COV_COLUMN_DTYPES,
+    SortedScanTracker,
+    IntervalPlan,
+    PrefetchBudget,
+    TDHunterUnixServer,
+)
+from ..generate_test_coverage import generate_batch, write_bgzf
+from concurrent.futures.process import BrokenProcessPool
 import pytest
 import os
 import csv
 import glob
+import gzip
+import hashlib
+import http.client
+import json
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
 
 
 class BaseTest(object):
@@ -143,6 +167,48 @@ class TestTDHunterAll(BaseTest):
             ],
         )
 
+    def test_with_multiple_pairs(self):
+        """ All pairs resolved from a single pass over the coverage file """
+        file = "./test/PositiveSample.qc.coverage.txt"
+        intervals = "./test/test_intervals_multi_pair.json"
+        # initiate class
+        td = TDHunter(file=file, intervals=intervals, out_dir=self.out_dir)
+        assert td
+
+        # check and contents
+        self.check_file(
+            output_file=td.fname,
+            output_contents=[
+                [
+                    "sample_id",
+                    "MLL_EXON3",
+                    "MLL_EXON27",
+                    "fold_change",
+                    "log2_fold_change",
+                    "above_cut_off",
+                    "MLL_EXON4",
+                ],
+                [
+                    "PositiveSample",
+                    "2.284132",
+                    "1.250261",
+                    "1.826924138",
+                    "0.869416728",
+                    "TRUE",
+                    "",
+                ],
+                [
+                    "PositiveSample",
+                    "",
+                    "1.250261",
+                    "1.689007335",
+                    "0.756175593",
+                    "TRUE",
+                    "2.1117",
+                ],
+            ],
+        )
+
     def test_initiation_with_batch(self):
         """ No error if batch argument given """
         td = TDHunter(
@@ -155,6 +221,17 @@ class TestTDHunterAll(BaseTest):
             os.path.join(self.out_dir, self.out_fname_suffix), recursive=True
         )
         assert len(results_files) == 2
+        # workers return a result record for each file
+        assert sorted(r["sample_id"] for r in td.results) == [
+            "NegativeSample", "PositiveSample"
+        ]
+        for record in td.results:
+            assert record["error"] is None
+            assert record["fname"] in [
+                os.path.abspath(f) for f in results_files
+            ]
+            assert record["columns"][0] == "sample_id"
+            assert record["rows"][0][0] == record["sample_id"]
 
     def test_system_exit_no_file_batch(self):
         """ Initiation with no file or batch argument causing system exit """
@@ -180,6 +257,7 @@ class TestTDHunterAll(BaseTest):
             td.fname
         except AttributeError:
             assert True
+        assert td.results[0]["error"]
 
     def test_with_bad_header_file(self, capsys):
         """ Error if coverage file has bad header """
@@ -200,7 +278,8 @@ class TestTDHunterAll(BaseTest):
             capsys=capsys,
             file=file,
             expected_stderr=[
-                "No objects to concat",
+                "Regions not found in the coverage file: "
+                "chr11:118342351-118345055, chr11:118373087-118377386",
                 "coverage file is invalid",
             ],
         )
@@ -213,6 +292,221 @@ class TestTDHunterAll(BaseTest):
             TDHunter(file=file, intervals=intervals)
 
 
+class TestCohortOutput(BaseTest):
+    def test_cohort_csv(self, tmp_path):
+        """ Combined table written in filename order without per-sample
+        files """
+        td = TDHunter(
+            batch="./test/Batch",
+            out_dir=self.out_dir,
+            intervals=self.intervals,
+            cohort_dir=str(tmp_path),
+            cohort_formats=["csv"],
+            run="RUN1",
+            sample_csv=False,
+        )
+        assert td
+        # no per-sample results files written
+        assert not glob.glob(os.path.join(self.out_dir, self.out_fname_suffix))
+        assert os.listdir(str(tmp_path)) == ["RUN1_comparison.csv"]
+        with open(str(tmp_path / "RUN1_comparison.csv")) as cohort:
+            assert list(csv.reader(cohort)) == [
+                [
+                    "sample_id",
+                    "MLL_EXON3",
+                    "MLL_EXON27",
+                    "fold_change",
+                    "log2_fold_change",
+                    "above_cut_off",
+                ],
+                [
+                    "NegativeSample",
+                    "1.237117",
+                    "1.187973",
+                    "1.041367944",
+                    "0.058479903",
+                    "FALSE",
+                ],
+                [
+                    "PositiveSample",
+                    "2.284132",
+                    "1.250261",
+                    "1.826924138",
+                    "0.869416728",
+                    "TRUE",
+                ],
+            ]
+
+    def test_cohort_xlsx(self, tmp_path):
+        """ Combined xlsx has calls as True/False like
+        generate_comparison_csv_to_xls.py """
+        pytest.importorskip("openpyxl")
+        TDHunter(
+            batch="./test/Batch",
+            out_dir=self.out_dir,
+            intervals=self.intervals,
+            cohort_dir=str(tmp_path),
+            cohort_formats=["xlsx"],
+        )
+        cohort = pd.read_excel(
+            str(tmp_path / "comparison_csv.xlsx"), dtype={"above_cut_off": str}
+        )
+        assert cohort["sample_id"].tolist() == [
+            "NegativeSample", "PositiveSample"
+        ]
+        assert cohort["above_cut_off"].tolist() == ["False", "True"]
+
+    def test_cohort_duplicates(self, tmp_path, capsys):
+        """ Cohort isn't written with a sample from two coverage files, like
+        generate_comparison_csv_to_xls.py """
+        for run in ["RUN1", "RUN2"]:
+            os.makedirs(str(tmp_path / "batch" / run))
+            shutil.copy(
+                "./test/PositiveSample.qc.coverage.txt",
+                str(tmp_path / "batch" / run),
+            )
+        with pytest.raises(SystemExit):
+            TDHunter(
+                batch=str(tmp_path / "batch"),
+                out_dir=str(tmp_path),
+                intervals=self.intervals,
+                cohort_dir=str(tmp_path / "cohort"),
+                cohort_formats=["csv"],
+                sample_csv=False,
+            )
+        stderr = capsys.readouterr().err.splitlines()
+        assert stderr[0] == (
+            "Cohort table has duplicate sample ids: PositiveSample"
+        )
+        assert stderr[1].endswith(
+            "Error: Cohort tables can't be written! Exiting...!"
+        )
+        assert not os.path.exists(str(tmp_path / "cohort"))
+
+    def test_cohort_rows_per_sample(self, tmp_path):
+        """ Samples with a row per interval pair aren't duplicates """
+        cohort_df = pd.DataFrame({"sample_id": ["S1", "S1", "S2", "S2"]})
+        TDHunter._write_cohort(
+            cohort_df, str(tmp_path), ["csv"], sample_ids=["S1", "S2"]
+        )
+        with pytest.raises(
+            ValueError, match="^Cohort table has duplicate sample ids: S1, S2$"
+        ):
+            TDHunter._write_cohort(cohort_df, str(tmp_path), ["csv"])
+
+
+class TestResultsTable(BaseTest):
+    def plan(self, intervals):
+        return IntervalPlan.from_intervals(
+            TDHunter._import_intervals(
+                intervals=intervals, dup_threshold=1.122995
+            )
+        )
+
+    def test_results_table(self):
+        """ Fold change and calls computed for all samples and pairs at once,
+        with intervals missing from a pair left empty """
+        plan = self.plan("./test/test_intervals_multi_pair.json")
+        # regions sorted as exon 3, exon 4, exon 27
+        matrix = np.array([[2.0, 1.0, 1.0], [1.0, 4.0, 2.0]])
+        results = TDHunter._results_table(["S1", "S2"], matrix, plan)
+        assert results.columns.tolist() == [
+            "sample_id",
+            "MLL_EXON3",
+            "MLL_EXON27",
+            "fold_change",
+            "log2_fold_change",
+            "above_cut_off",
+            "MLL_EXON4",
+        ]
+        assert results["sample_id"].tolist() == ["S1", "S1", "S2", "S2"]
+        assert results["fold_change"].tolist() == [2.0, 1.0, 0.5, 2.0]
+        assert results["log2_fold_change"].tolist() == [1.0, 0.0, -1.0, 1.0]
+        assert results["above_cut_off"].tolist() == [
+            "TRUE", "FALSE", "FALSE", "TRUE"
+        ]
+        assert np.isnan(results["MLL_EXON3"].values[[1, 3]]).all()
+        assert results["MLL_EXON27"].tolist() == [1.0, 1.0, 2.0, 2.0]
+
+    def test_compare_metric_matrix_rounding(self):
+        """ Fold changes are rounded to 9 decimal places """
+        fold_change, log2_fold_change, above_cut_off = (
+            TDHunter._compare_metric_matrix(
+                np.array([[2.284132, 1.250261]]), self.plan(self.intervals)
+            )
+        )
+        assert fold_change.tolist() == [[1.826924138]]
+        assert log2_fold_change.tolist() == [[0.869416728]]
+        assert above_cut_off.tolist() == [[True]]
+
+
+class TestIntervalPlan(BaseTest):
+    def test_plan(self):
+        """ Plan holds normalised region keys, thresholds and columns """
+        plan = IntervalPlan.from_intervals(
+            TDHunter._import_intervals(
+                intervals="./test/test_intervals_no_dup_threshold.json",
+                dup_threshold=1.5,
+            )
+        )
+        assert plan.regions == (
+            ("chr11", 118342351, 118345055),
+            ("chr11", 118373087, 118377386),
+        )
+        assert plan.region1_columns == (0,)
+        assert plan.region2_columns == (1,)
+        assert plan.thresholds == (1.5,)
+        assert plan.columns[:3] == ("sample_id", "MLL_EXON3", "MLL_EXON27")
+        with pytest.raises(AttributeError):
+            plan.thresholds = (1.0,)
+
+    def test_plan_digest(self):
+        """ Plans of the same intervals share a digest, which changes with
+        the thresholds """
+        def plan(dup_threshold):
+            return IntervalPlan.from_intervals(
+                TDHunter._import_intervals(
+                    intervals="./test/test_intervals_no_dup_threshold.json",
+                    dup_threshold=dup_threshold,
+                )
+            )
+        assert plan(1.5).digest == plan(1.5).digest
+        assert plan(1.5).digest != plan(2.0).digest
+
+    def test_all_errors_reported(self, tmp_path):
+        """ Every problem with the intervals is reported at once """
+        intervals = tmp_path / "intervals.json"
+        intervals.write_text(
+            json.dumps(
+                [
+                    {"region1": {"chrom": "chr1", "start": 1, "end": 2}},
+                    {
+                        "region1": {
+                            "chrom": "chr1", "start": "a", "end": 2,
+                            "name": "A",
+                        },
+                        "region2": {
+                            "chrom": "chr1", "start": 5, "end": 2,
+                            "name": "B",
+                        },
+                        "dup_threshold": "high",
+                    },
+                ]
+            )
+        )
+        with pytest.raises(ValueError) as error:
+            TDHunter._import_intervals(
+                intervals=str(intervals), dup_threshold=1.122995
+            )
+        assert str(error.value).splitlines() == [
+            "Pair 1 region1 has no name",
+            "Pair 1 has no region2",
+            "Pair 2 region1 start and end must be integers",
+            "Pair 2 region2 starts after it ends",
+            "Pair 2 dup_threshold must be a number",
+        ]
+
+
 class TestFindCoverageFiles(BaseTest):
     def test_coverage_file_present(self):
         """ Returns a list of paths to coverage file if given correct
@@ -234,6 +528,1362 @@ class TestFindCoverageFiles(BaseTest):
         assert len(coverage_files) == 0
 
 
+class TestDiscovery(BaseTest):
+    def tree(self, tmp_path):
+        """ Build a batch folder with nested, excluded and symlinked files. """
+        for path in [
+            "a/S1.qc.coverage.txt",
+            "a/b/S2.qc.coverage.txt.gz",
+            "a/tmp/S3.qc.coverage.txt",
+            "c/S4.per_target.tsv",
+            "c/.hidden.qc.coverage.txt",
+            "c/notes.txt",
+        ]:
+            path = tmp_path / "batch" / path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("")
+        os.symlink(
+            str(tmp_path / "batch" / "a" / "S1.qc.coverage.txt"),
+            str(tmp_path / "batch" / "S5.qc.coverage.txt"),
+        )
+        batch_dir = tmp_path / "batch"
+        os.symlink(str(batch_dir / "c"), str(batch_dir / "d"))
+        # symlink loop
+        os.symlink(str(batch_dir), str(batch_dir / "a" / "e"))
+        return str(tmp_path / "batch")
+
+    def find(self, batch_dir, **kwargs):
+        stats = {}
+        files = list(TDHunter._iter_coverage_files(
+            batch_dir, [".qc.coverage.txt", ".per_target.tsv"], stats=stats,
+            **kwargs
+        ))
+        return [os.path.relpath(file, batch_dir) for file in files], stats
+
+    def test_patterns_and_symlinks(self, tmp_path):
+        """ Every pattern is found, each folder walked once """
+        files, stats = self.find(self.tree(tmp_path))
+        assert files == [
+            "S5.qc.coverage.txt",
+            "a/S1.qc.coverage.txt",
+            "a/b/S2.qc.coverage.txt.gz",
+            "a/tmp/S3.qc.coverage.txt",
+            "c/S4.per_target.tsv",
+        ]
+        assert stats["files"] == 5
+        assert stats["errors"] == []
+
+    @pytest.mark.parametrize(
+        "symlinks,n_files,skipped",
+        [("files", 5, 2), ("skip", 4, 3)],
+    )
+    def test_symlink_policy(self, tmp_path, symlinks, n_files, skipped):
+        """ Symlinked folders, or all symlinks, can be skipped """
+        files, stats = self.find(self.tree(tmp_path), symlinks=symlinks)
+        assert (len(files), stats["symlinks_skipped"]) == (n_files, skipped)
+        assert ("S5.qc.coverage.txt" in files) == (symlinks == "files")
+
+    def test_include_exclude(self, tmp_path):
+        """ Files are kept or skipped by globs of their relative path """
+        files, stats = self.find(
+            self.tree(tmp_path), include=["a/*"], exclude=["*/tmp/*"]
+        )
+        assert files == ["a/S1.qc.coverage.txt", "a/b/S2.qc.coverage.txt.gz"]
+        assert stats["excluded"] == 3
+
+    def test_streamed(self, tmp_path):
+        """ Files are yielded before the rest of the tree is walked, and
+        unreadable folders are reported """
+        stats = {}
+        files = TDHunter._iter_coverage_files(
+            self.tree(tmp_path), ".qc.coverage.txt", stats=stats
+        )
+        next(files)
+        assert stats["dirs"] == 1
+        files = TDHunter._iter_coverage_files(
+            str(tmp_path / "missing"), ".qc.coverage.txt", stats=stats
+        )
+        assert list(files) == []
+        assert len(stats["errors"]) == 1
+
+    def test_sample_id_patterns(self):
+        """ Sample ids drop whichever coverage file suffix they have """
+        assert TDHunter._get_sample_id(
+            "dir/S-1.per_target.tsv", [".qc.coverage.txt", ".per_target.tsv"]
+        ) == "S_1"
+
+
+class TestPrefetch(BaseTest):
+    @pytest.mark.parametrize("budget", [0, 512])
+    def test_prefetch_batch(self, budget):
+        """ Prefetched batches give the same results, also when the budget
+        only lets one file through at a time
+        """
+        td = TDHunter(
+            batch="./test/Batch",
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            full_scan=True,
+            prefetch_threads=2,
+            prefetch_budget=budget,
+        )
+        rows = sorted(record["rows"][0] for record in td.results)
+        assert [row[0] for row in rows] == ["NegativeSample", "PositiveSample"]
+        assert rows[1][-1] == "TRUE"
+        assert all(record["error"] is None for record in td.results)
+
+    def test_prefetch_early_exit(self, tmp_path, capsys):
+        """ Files are only read ahead as far as the workers read them: the
+        indexed chroms, and prefetching is refused if they stop reading
+        early """
+        index_dir = str(tmp_path / "index")
+        td = TDHunter(
+            batch="./test/Batch",
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            index=True,
+            index_dir=index_dir,
+            prefetch_threads=2,
+        )
+        file = "./test/Batch/NegativeSample.qc.coverage.txt"
+        assert td._read_coverage_bytes(file) == td._indexed_source(
+            file, td.plan.region_set, index_dir
+        )
+        assert len(td._read_coverage_bytes(file)) < os.path.getsize(file)
+        with pytest.raises(SystemExit):
+            TDHunter(
+                batch="./test/Batch",
+                intervals=self.intervals,
+                out_dir=self.out_dir,
+                prefetch_threads=2,
+            )
+        assert capsys.readouterr().err.endswith(
+            "Error: Prefetching needs the index or a full scan! Exiting...!"
+        )
+        with pytest.raises(SystemExit):
+            tdh_argument_parser(
+                ["-B", "./test/Batch", "--intervals", self.intervals,
+                 "--prefetch-threads", "2"]
+            )
+        assert "--prefetch-threads needs --index or --full-scan" in (
+            capsys.readouterr().err
+        )
+        for option in ["--index", "--full-scan"]:
+            assert tdh_argument_parser(
+                ["-B", "./test/Batch", "--intervals", self.intervals,
+                 "--prefetch-threads", "2", option]
+            ).prefetch_threads == 2
+
+    def test_prefetch_order_and_missing(self):
+        """ Files are handed out in order, unreadable files without data
+        so the worker reports the error
+        """
+        td = TDHunter(
+            file="./test/PositiveSample.qc.coverage.txt",
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            full_scan=True,
+            prefetch_threads=2,
+        )
+        files = [
+            "./test/PositiveSample.qc.coverage.txt",
+            "./test/Missing.qc.coverage.txt",
+            "./test/NegativeSample.qc.coverage.txt",
+        ]
+        prefetched = list(td._prefetch_files(
+            ((file, n) for n, file in enumerate(files)),
+            PrefetchBudget(1 << 30),
+        ))
+        assert [task[:2] for task in prefetched] == [
+            (file, n) for n, file in enumerate(files)
+        ]
+        assert prefetched[1][2] is None
+        with open(files[2], "rb") as cov_file:
+            assert prefetched[2][2] == cov_file.read()
+
+    def test_budget(self):
+        """ Files are let through within the budget, or alone """
+        budget = PrefetchBudget(10)
+        assert budget.try_acquire("a", 6)
+        assert not budget.try_acquire("b", 6)
+        budget.release("a")
+        assert budget.try_acquire("b", 20)
+        assert budget.peak == 20
+
+
+class TestIncremental(BaseTest):
+    def run(self, batch, out_dir, incremental=True):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        return TDHunter(
+            batch=batch,
+            intervals=self.intervals,
+            out_dir=out_dir,
+            cohort_dir=out_dir,
+            cohort_formats=["csv"],
+            incremental=incremental,
+        )
+
+    def test_incremental_batch(self, tmp_path):
+        """ Only new files are processed, with the same outputs as a full
+        run """
+        batch = tmp_path / "batch"
+        shutil.copytree("./test/Batch", str(batch))
+        out_dir = tmp_path / "out"
+        self.run(str(batch), str(out_dir))
+        assert os.path.isfile(str(out_dir / ".tdh_manifest.json"))
+
+        shutil.copy2(
+            "./test/PositiveSample.qc.coverage.txt",
+            str(batch / "NewSample.qc.coverage.txt"),
+        )
+        td = self.run(str(batch), str(out_dir))
+        assert sorted(
+            (record["sample_id"], record["reused"]) for record in td.results
+        ) == [
+            ("NegativeSample", True),
+            ("NewSample", False),
+            ("PositiveSample", True),
+        ]
+
+        full_dir = tmp_path / "full"
+        self.run(str(batch), str(full_dir), incremental=False)
+        for fname in sorted(os.listdir(str(full_dir))):
+            with open(str(full_dir / fname)) as full, \
+                    open(str(out_dir / fname)) as incremental:
+                assert full.read() == incremental.read()
+
+    def test_metric_change_reprocesses(self, tmp_path):
+        """ Files are processed again when the metric changes """
+        self.run("./test/Batch", str(tmp_path))
+        td = TDHunter(
+            batch="./test/Batch",
+            intervals=self.intervals,
+            out_dir=str(tmp_path),
+            metric="read_count",
+            incremental=True,
+        )
+        assert not any(record["reused"] for record in td.results)
+
+
+class TestScheduler(BaseTest):
+    def batch(self, tmp_path):
+        """ Build a batch of small synthetic files and the two test samples,
+        which are much larger """
+        batch_dir = str(tmp_path / "batch")
+        generate_batch(
+            "kmt2a", 4, batch_dir, "./test/test_intervals.json",
+            suffix=self.cov_file_pattern,
+        )
+        for file in glob.glob(
+            "./test/Batch/**/*" + self.cov_file_pattern, recursive=True
+        ):
+            shutil.copy(file, batch_dir)
+        return batch_dir
+
+    def test_largest_first(self, tmp_path):
+        """ Files are processed largest first, whatever the listing order """
+        td = TDHunter(
+            batch=self.batch(tmp_path),
+            intervals=self.intervals,
+            out_dir=str(tmp_path),
+            cov_file_pattern=self.cov_file_pattern,
+            schedule="size",
+            processes=1,
+        )
+        sizes = [os.path.getsize(record["file"]) for record in td.results]
+        assert sizes == sorted(sizes, reverse=True)
+        assert td.schedule_stats["files"] == 6
+        assert td.schedule_stats["workers"] == 1
+
+    def test_memory_budget(self, tmp_path):
+        """ Workers are limited to as many typical files as fit the budget,
+        and files in flight to the budget """
+        batch_dir = self.batch(tmp_path)
+        td = TDHunter(
+            batch=batch_dir,
+            intervals=self.intervals,
+            out_dir=str(tmp_path),
+            cov_file_pattern=self.cov_file_pattern,
+            schedule="size",
+            processes=8,
+            memory_budget=1,
+        )
+        stats = td.schedule_stats
+        # the median file is tiny, so every file gets a worker
+        assert stats["workers"] == 6
+        # the two large files don't fit the budget together
+        assert stats["peak_mb"] < 1
+        assert stats["budget_waits"] >= 1
+        assert all(record["error"] is None for record in td.results)
+
+    def test_prefetch_schedule(self, tmp_path):
+        """ Prefetched files are handed out largest first within the memory
+        budget too """
+        td = TDHunter(
+            batch=self.batch(tmp_path),
+            intervals=self.intervals,
+            out_dir=str(tmp_path),
+            cov_file_pattern=self.cov_file_pattern,
+            schedule="size",
+            processes=1,
+            memory_budget=1,
+            full_scan=True,
+            prefetch_threads=2,
+        )
+        sizes = [os.path.getsize(record["file"]) for record in td.results]
+        assert sizes == sorted(sizes, reverse=True)
+        assert td.schedule_stats["files"] == 6
+        assert td.schedule_stats["peak_mb"] < 1
+
+    def test_worker_dies(self, tmp_path, monkeypatch):
+        """ The batch fails instead of waiting forever for a dead worker """
+        process_file = TDHunter._process_file
+
+        def die(hunter, file, *args, **kwargs):
+            if "PositiveSample" in file:
+                os._exit(1)
+            return process_file(hunter, file, *args, **kwargs)
+
+        monkeypatch.setattr(TDHunter, "_process_file", die)
+        errors = []
+
+        def run():
+            try:
+                TDHunter(
+                    batch=self.batch(tmp_path),
+                    intervals=self.intervals,
+                    out_dir=str(tmp_path),
+                    cov_file_pattern=self.cov_file_pattern,
+                    processes=2,
+                )
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(60)
+        assert not thread.is_alive()
+        assert [type(e) for e in errors] == [BrokenProcessPool]
+
+    def test_discovery_schedule(self, tmp_path):
+        """ Files found as the batch is walked give the same results """
+        for schedule in ["size", "discovery"]:
+            out_dir = tmp_path / schedule
+            out_dir.mkdir()
+            TDHunter(
+                batch="./test/Batch",
+                intervals=self.intervals,
+                out_dir=str(out_dir),
+                cov_file_pattern=self.cov_file_pattern,
+                schedule=schedule,
+                cohort_dir=str(out_dir),
+                cohort_formats=["csv"],
+            )
+        with open(str(tmp_path / "size" / "comparison.csv")) as size, \
+                open(str(tmp_path / "discovery" / "comparison.csv")) as found:
+            assert size.read() == found.read()
+
+
+class TestShards(BaseTest):
+    def batch(self, tmp_path):
+        """ Build a batch of synthetic files with the test intervals """
+        batch_dir = str(tmp_path / "batch")
+        generate_batch(
+            "kmt2a", 6, batch_dir, self.intervals, positive_fraction=0.5,
+            suffix=self.cov_file_pattern,
+        )
+        return batch_dir
+
+    def run(self, batch_dir, out_dir, intervals=None, **kwargs):
+        os.makedirs(out_dir)
+        return TDHunter(
+            batch=batch_dir,
+            intervals=intervals or self.intervals,
+            out_dir=out_dir,
+            cov_file_pattern=self.cov_file_pattern,
+            run="RUN1",
+            **kwargs
+        )
+
+    def test_shard_files(self, tmp_path):
+        """ Every file is in exactly one shard """
+        batch_dir = self.batch(tmp_path)
+        files = TDHunter._find_coverage_files(
+            batch_dir, self.cov_file_pattern
+        )
+        shards = [
+            list(TDHunter._shard_files(files, batch_dir, (index, 3)))
+            for index in [1, 2, 3]
+        ]
+        assert sorted(sum(shards, [])) == sorted(files)
+        assert TDHunter._shard_of("a/S1.tsv", 3) == TDHunter._shard_of(
+            "a/S1.tsv", 3
+        )
+
+    def test_merge_matches_whole_batch(self, tmp_path):
+        """ Merged shards give the same cohort table as the whole batch """
+        batch_dir = self.batch(tmp_path)
+        whole = str(tmp_path / "whole")
+        self.run(
+            batch_dir, whole, cohort_dir=whole, cohort_formats=["csv"]
+        )
+        for index in [1, 2, 3]:
+            shard_dir = str(tmp_path / "shard{0}".format(index))
+            self.run(
+                batch_dir, shard_dir, shard=(index, 3), cohort_dir=shard_dir
+            )
+            assert os.path.isfile(os.path.join(
+                shard_dir, "RUN1_shard_{0}_of_3.json".format(index)
+            ))
+            assert not os.path.isfile(
+                os.path.join(shard_dir, "RUN1_comparison.csv")
+            )
+        tdh_merge(
+            [str(tmp_path / "shard{0}".format(index)) for index in [1, 2, 3]]
+            + ["-O", str(tmp_path / "merged"), "--cohort-formats", "csv"]
+        )
+        with open(os.path.join(whole, "RUN1_comparison.csv")) as whole_csv, \
+                open(str(tmp_path / "merged" / "RUN1_comparison.csv")) \
+                as merged_csv:
+            assert merged_csv.read() == whole_csv.read()
+
+    def test_merge_checks(self, tmp_path):
+        """ Shards are only merged if all are given, with the same plan """
+        batch_dir = self.batch(tmp_path)
+        partials = []
+        for index, intervals in [
+            (1, self.intervals), (2, "./test/test_intervals_multi_pair.json")
+        ]:
+            shard_dir = str(tmp_path / "shard{0}".format(index))
+            self.run(batch_dir, shard_dir, intervals, shard=(index, 3))
+            partials.append(os.path.join(
+                shard_dir, "RUN1_shard_{0}_of_3.json".format(index)
+            ))
+        with pytest.raises(ValueError) as error:
+            TDHunter.merge_shards(partials)
+        assert "Shards have different plan" in str(error.value)
+        assert "Missing shard(s) 3 of 3" in str(error.value)
+        with pytest.raises(SystemExit):
+            tdh_merge(partials[:1] + ["-O", str(tmp_path / "merged")])
+        assert not os.path.exists(str(tmp_path / "merged"))
+
+
+class TestRegionIndex(BaseTest):
+    def test_index_df(self):
+        """ Only requested regions matching on chrom, start and end are
+        indexed """
+        df = next(
+            TDHunter._import_coverage(
+                file="./test/PositiveSample.qc.coverage.txt",
+                column_dtypes=COV_COLUMN_DTYPES,
+            )
+        )
+        regions = TDHunter._compile_regions(
+            TDHunter._import_intervals(
+                intervals=self.intervals, dup_threshold=1.122995
+            )
+        )
+        # a region with a matching start but different end is not indexed
+        regions.add(("chr11", 118342351, 118345056))
+        index = TDHunter._index_df(df, regions)
+        assert sorted(index) == [
+            ("chr11", 118342351, 118345055),
+            ("chr11", 118373087, 118377386),
+        ]
+        assert df.iloc[index[("chr11", 118342351, 118345055)]][
+            "normalized_coverage"
+        ].tolist() == [2.284132]
+
+    def test_region_key_string_coordinates(self):
+        """ Region keys use integer coordinates whatever the json type """
+        key = TDHunter._region_key(
+            {"chrom": "chr11", "start": "118342351", "end": 118345055}
+        )
+        assert key == ("chr11", 118342351, 118345055)
+
+
+class TestScanEngine(BaseTest):
+    def regions(self, intervals):
+        return TDHunter._compile_regions(
+            TDHunter._import_intervals(
+                intervals=intervals, dup_threshold=1.122995
+            )
+        )
+
+    @pytest.mark.parametrize(
+        "metric", ["normalized_coverage", "read_count", "mean_coverage"]
+    )
+    def test_scan_matches_pandas(self, metric):
+        """ Line scanner returns the same values as the pandas reader """
+        file = "./test/PositiveSample.qc.coverage.txt"
+        regions = self.regions("./test/test_intervals_multi_pair.json")
+        scanned = TDHunter._scan_regions(
+            file, regions, metric, COV_COLUMN_DTYPES
+        )
+        parsed = TDHunter._extract_regions(
+            TDHunter._import_coverage(
+                file=file, column_dtypes=COV_COLUMN_DTYPES
+            ),
+            regions,
+            metric,
+        )
+        assert len(scanned) == 3
+        assert scanned == parsed
+        assert [type(v) for v in scanned.values()] == [
+            type(v) for v in parsed.values()
+        ]
+
+    def test_scan_bad_header(self):
+        """ Line scanner leaves files with unexpected headers to pandas """
+        scanned = TDHunter._scan_regions(
+            "./test/BadHeader.qc.coverage.txt",
+            self.regions(self.intervals),
+            "normalized_coverage",
+            COV_COLUMN_DTYPES,
+        )
+        assert scanned is None
+
+
+class TestEarlyExit(BaseTest):
+    def test_tracker_sorted(self):
+        """ Tracker stops once past the last region of every chrom """
+        tracker = SortedScanTracker({"chr2": 200, "chr11": 500})
+        assert not tracker.update("chr1", None)
+        assert not tracker.update("chr2", 100)
+        assert not tracker.update("chr2", 200)
+        # leaving chr2 means all its regions have been passed
+        assert not tracker.update("chr3", None)
+        assert not tracker.update("chr11", 500)
+        assert tracker.update("chr11", 501)
+
+    def test_tracker_unsorted(self):
+        """ Tracker never stops once the file is seen to be unsorted """
+        tracker = SortedScanTracker({"chr2": 200, "chr3": 50})
+        assert not tracker.update("chr2", 150)
+        assert not tracker.update("chr2", 100)
+        assert not tracker.update("chr2", 300)
+        assert not tracker.update("chr3", 60)
+        tracker = SortedScanTracker({"chr2": 200, "chr4": 10})
+        assert not tracker.update("chr2", 100)
+        assert not tracker.update("chr3", None)
+        assert not tracker.update("chr2", 300)
+        assert not tracker.update("chr4", 20)
+
+    def chunks(self, full_scan):
+        """ Yield two chunks of the positive sample, where all regions are in
+        the first one """
+        df = next(
+            TDHunter._import_coverage(
+                file="./test/PositiveSample.qc.coverage.txt",
+                column_dtypes=COV_COLUMN_DTYPES,
+            )
+        )
+        yield df.iloc[:6000]
+        assert full_scan, "read past the last region"
+        yield df.iloc[6000:]
+
+    @pytest.mark.parametrize("full_scan", [True, False])
+    def test_extract_regions_stops_early(self, full_scan):
+        """ Pandas reader stops after the chunk with the last region """
+        regions = TDHunter._compile_regions(
+            TDHunter._import_intervals(
+                intervals=self.intervals, dup_threshold=1.122995
+            )
+        )
+        region_values = TDHunter._extract_regions(
+            self.chunks(full_scan), regions, "normalized_coverage", full_scan
+        )
+        assert sorted(region_values.values()) == [1.250261, 2.284132]
+
+
+class TestCoverageIndex(BaseTest):
+    def regions(self):
+        return TDHunter._compile_regions(
+            TDHunter._import_intervals(
+                intervals=self.intervals, dup_threshold=1.122995
+            )
+        )
+
+    def test_indexed_source(self, tmp_path):
+        """ Indexed source only holds the header and requested chroms """
+        file = "./test/PositiveSample.qc.coverage.txt"
+        source = TDHunter._indexed_source(
+            file, self.regions(), index_dir=str(tmp_path)
+        )
+        lines = source.splitlines()
+        assert lines[0].startswith(b"chrom\tstart\tend")
+        assert {line.split(b"\t")[0] for line in lines[1:]} == {b"chr11"}
+        # index written to the index dir, not next to the coverage file
+        assert not os.path.exists(file + ".tdhidx")
+        assert len(os.listdir(str(tmp_path))) == 1
+
+    def test_index_rebuilt_when_file_changes(self, tmp_path):
+        """ Index is rebuilt if the file changes, but not if only the mtime
+        changes """
+        file = str(tmp_path / "Sample.qc.coverage.txt")
+        shutil.copy("./test/NegativeSample.qc.coverage.txt", file)
+        index = TDHunter._load_coverage_index(file)
+        assert os.path.isfile(file + ".tdhidx")
+
+        # same contents with a new mtime keeps the index
+        os.utime(file, (0, 0))
+        reloaded = TDHunter._load_coverage_index(file)
+        assert reloaded["chroms"] == index["chroms"]
+        assert reloaded["mtime"] == 0
+
+        # different contents rebuilds the index
+        with open(file, "a") as cov_file:
+            cov_file.write("chrZ\t1\t10\t10\t.\t0\t0\t0\t0\t0\t0\t0\t0\t0\n")
+        rebuilt = TDHunter._load_coverage_index(file)
+        assert "chrZ" in rebuilt["chroms"]
+        assert rebuilt["sha1"] != index["sha1"]
+
+    @pytest.mark.parametrize("engine", ["scan", "pandas"])
+    def test_with_index(self, tmp_path, engine):
+        """ Results are the same when read through the index """
+        file = "./test/PositiveSample.qc.coverage.txt"
+        td = TDHunter(
+            file=file,
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            engine=engine,
+            index=True,
+            index_dir=str(tmp_path),
+        )
+        with open(td.fname) as results:
+            assert results.read().splitlines()[1] == (
+                "PositiveSample,2.284132,1.250261,1.826924138,0.869416728,TRUE"
+            )
+
+
+class TestCoverageCache(BaseTest):
+    def test_cache_reused(self, tmp_path, monkeypatch):
+        """ Coverage file is parsed once and read from the cache after """
+        file = "./test/PositiveSample.qc.coverage.txt"
+        expected = (
+            "PositiveSample,2.284132,1.250261,1.826924138,0.869416728,TRUE"
+        )
+        for n in range(2):
+            td = TDHunter(
+                file=file,
+                intervals=self.intervals,
+                out_dir=self.out_dir,
+                cache_dir=str(tmp_path),
+            )
+            with open(td.fname) as results:
+                assert results.read().splitlines()[1] == expected
+            # the second run must not parse the file again
+            monkeypatch.setattr(
+                "pandas.read_csv", pytest.fail, raising=True
+            )
+        assert len(os.listdir(str(tmp_path))) == 1
+
+    def test_cache_first(self, tmp_path, monkeypatch):
+        """ A cached file isn't read through the index or the scanner """
+        file = "./test/PositiveSample.qc.coverage.txt"
+        cache_dir = str(tmp_path / "cache")
+        TDHunter(
+            file=file,
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            cache_dir=cache_dir,
+        )
+        for method in ["_indexed_source", "_scan_regions"]:
+            monkeypatch.setattr(TDHunter, method, pytest.fail)
+        monkeypatch.setattr("pandas.read_csv", pytest.fail)
+        td = TDHunter(
+            file=file,
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            engine="scan",
+            index=True,
+            index_dir=str(tmp_path / "index"),
+            cache_dir=cache_dir,
+        )
+        with open(td.fname) as results:
+            assert results.read().splitlines()[1].startswith(
+                "PositiveSample,2.284132,1.250261"
+            )
+
+    def test_cache_opt_in(self, tmp_path, monkeypatch):
+        """ A run without --cache-dir doesn't read or write a cache """
+        assert tdh_argument_parser(
+            [
+                "-F", "./test/PositiveSample.qc.coverage.txt",
+                "--intervals", self.intervals,
+            ]
+        ).cache_dir is None
+        monkeypatch.setenv("HOME", str(tmp_path))
+        monkeypatch.setattr(
+            TDHunter, "_load_cached_coverage", pytest.fail
+        )
+        TDHunter(
+            file="./test/PositiveSample.qc.coverage.txt",
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+        )
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_cache_key(self, tmp_path):
+        """ Cache entries are keyed without reading the file, and change
+        with the file """
+        file = tmp_path / "Sample.qc.coverage.txt"
+        shutil.copy("./test/PositiveSample.qc.coverage.txt", str(file))
+        key = TDHunter._cache_key(str(file))
+        assert TDHunter._cache_key(str(file)) == key
+        os.utime(str(file), ns=(0, 0))
+        assert TDHunter._cache_key(str(file)) != key
+
+    def test_load_columns(self, tmp_path):
+        """ Only requested columns are loaded from the cache """
+        df = next(
+            TDHunter._import_coverage(
+                file="./test/NegativeSample.qc.coverage.txt",
+                column_dtypes=COV_COLUMN_DTYPES,
+            )
+        )
+        entry = str(tmp_path / "entry")
+        TDHunter._store_cached_coverage(entry, df)
+        cached = TDHunter._load_cached_coverage(entry, ["chrom", "read_count"])
+        assert list(cached.columns) == ["chrom", "read_count"]
+        assert cached["chrom"].tolist() == df["chrom"].tolist()
+        assert cached["read_count"].tolist() == df["read_count"].tolist()
+        assert TDHunter._load_cached_coverage(
+            str(tmp_path / "missing"), ["chrom"]
+        ) is None
+
+    def test_evict_cache(self, tmp_path):
+        """ Least recently used entries are evicted first """
+        for n, name in enumerate(["old", "new"]):
+            entry = tmp_path / name
+            entry.mkdir()
+            (entry / "col_0.npy").write_bytes(b"0" * 600 * 1024)
+            (entry / "meta.json").write_text("{}")
+            os.utime(str(entry / "meta.json"), (n, n))
+        TDHunter._evict_cache(str(tmp_path), cache_size=1)
+        assert os.listdir(str(tmp_path)) == ["new"]
+
+
+class TestCompressedCoverage(BaseTest):
+    positive = "./test/PositiveSample.qc.coverage.txt"
+    expected = "PositiveSample,2.284132,1.250261,1.826924138,0.869416728,TRUE"
+
+    def compress(self, tmp_path, compression):
+        """ Compress the positive sample into tmp_path. """
+        file = str(tmp_path / "PositiveSample.qc.coverage.txt.gz")
+        with open(self.positive, "rb") as cov_file:
+            data = cov_file.read()
+        if compression == "bgzf":
+            write_bgzf(data, file)
+        else:
+            with gzip.open(file, "wb") as gz_file:
+                gz_file.write(data)
+        return file
+
+    @pytest.mark.parametrize("compression", ["gzip", "bgzf"])
+    @pytest.mark.parametrize("engine", ["scan", "pandas"])
+    @pytest.mark.parametrize("index", [False, True])
+    def test_compressed_file(self, tmp_path, compression, engine, index):
+        """ Compressed files give the same results as plain ones """
+        file = self.compress(tmp_path, compression)
+        assert TDHunter._compression(file) == compression
+        td = TDHunter(
+            file=file,
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            engine=engine,
+            index=index,
+            index_dir=str(tmp_path / "index"),
+        )
+        assert td.results[0]["sample_id"] == "PositiveSample"
+        with open(td.fname) as results:
+            assert results.read().splitlines()[1] == self.expected
+
+    @pytest.mark.parametrize("compression", ["gzip", "bgzf"])
+    def test_indexed_source(self, tmp_path, compression):
+        """ The indexed chroms read from a compressed file are the same as
+        from the plain file, seeking straight to them in BGZF files
+        """
+        file = self.compress(tmp_path, compression)
+        regions = TDHunter._compile_regions(
+            TDHunter._import_intervals(
+                intervals=self.intervals, dup_threshold=1.122995
+            )
+        )
+        index = TDHunter.index_coverage_file(file, str(tmp_path))
+        assert index["compression"] == compression
+        assert bool(index["blocks"]) == (compression == "bgzf")
+        assert TDHunter._indexed_source(
+            file, regions, str(tmp_path)
+        ) == TDHunter._indexed_source(self.positive, regions, str(tmp_path))
+
+    def test_find_compressed(self, tmp_path):
+        """ Compressed coverage files are found in batch mode """
+        file = self.compress(tmp_path, "gzip")
+        assert TDHunter._find_coverage_files(
+            batch_dir=str(tmp_path), cov_file_pattern=self.cov_file_pattern
+        ) == [file]
+
+
+class TestMatchRegions(BaseTest):
+    targets = pd.DataFrame({
+        "chrom": ["chr1", "chr1", "chr1", "chr1", "chr2"],
+        "start": [100, 200, 250, 600, 100],
+        "end": [199, 299, 449, 699, 199],
+        "normalized_coverage": [1.0, 3.0, 5.0, 7.0, 2.0],
+    })
+
+    @pytest.mark.parametrize(
+        "match,region,expected",
+        [
+            ("overlap", ("chr1", 99, 199), 1.0),
+            ("overlap", ("chr1", 150, 260), 3.5),
+            ("overlap", ("chr1", 500, 520), None),
+            ("contain", ("chr1", 99, 199), 1.0),
+            ("contain", ("chr1", 150, 260), None),
+            ("contain", ("chr1", 190, 460), 13.0 / 3),
+            ("nearest", ("chr1", 150, 260), 3.5),
+            ("nearest", ("chr1", 500, 520), 5.0),
+            ("nearest", ("chr1", 560, 590), 7.0),
+            ("nearest", ("chr1", 10, 20), 1.0),
+            ("nearest", ("chr3", 10, 20), None),
+        ],
+    )
+    def test_match_regions(self, match, region, expected):
+        """ Regions resolve to the targets they overlap, contain or are
+        nearest to, with the length weighted mean of several targets """
+        values = TDHunter._match_regions(
+            self.targets, {region}, "normalized_coverage", match
+        )
+        if expected is None:
+            assert values == {}
+        else:
+            assert values[region] == pytest.approx(expected)
+
+    @pytest.mark.parametrize("engine", ["scan", "pandas"])
+    def test_zero_based_intervals(self, tmp_path, engine):
+        """ Intervals with 0-based starts, as in BED files, are found by
+        overlap """
+        with open(self.intervals) as json_file:
+            intervals = json.load(json_file)
+        for pair in intervals:
+            for region in ["region1", "region2"]:
+                pair[region]["start"] -= 1
+        intervals_file = str(tmp_path / "intervals.json")
+        with open(intervals_file, "w") as json_file:
+            json.dump(intervals, json_file)
+        td = TDHunter(
+            file="./test/PositiveSample.qc.coverage.txt",
+            intervals=intervals_file,
+            out_dir=self.out_dir,
+            engine=engine,
+            match="overlap",
+        )
+        with open(td.fname) as results:
+            assert results.read().splitlines()[1] == (
+                "PositiveSample,2.284132,1.250261,1.826924138,0.869416728,TRUE"
+            )
+
+
+class TestMultiMetric(BaseTest):
+    intervals = "./test/test_intervals_multi_pair.json"
+    metrics = ["normalized_coverage", "read_count"]
+
+    def run(self, metric, intervals=None, **kwargs):
+        td = TDHunter(
+            batch="./test/Batch",
+            intervals=intervals or self.intervals,
+            out_dir=self.out_dir,
+            cov_file_pattern=self.cov_file_pattern,
+            metric=metric,
+            **kwargs
+        )
+        return td.results
+
+    def table(self, results):
+        """ Results of all samples as a table sorted by sample """
+        results = sorted(results, key=lambda record: record["sample_id"])
+        return pd.DataFrame(
+            [row for record in results for row in record["rows"]],
+            columns=results[0]["columns"],
+        )
+
+    @pytest.mark.parametrize("engine", ["scan", "pandas"])
+    def test_long_matches_single_metrics(self, engine):
+        """ Each metric of a long table is as when compared on its own """
+        multi = self.table(self.run(self.metrics, engine=engine))
+        assert multi["metric"].tolist() == [
+            metric for sample in range(2) for metric in self.metrics
+            for pair in range(2)
+        ]
+        for metric in self.metrics:
+            pd.testing.assert_frame_equal(
+                multi[multi["metric"] == metric].drop(columns="metric")
+                .reset_index(drop=True),
+                self.table(self.run(metric, engine=engine)),
+                check_dtype=False,
+            )
+
+    def test_wide_layout(self):
+        """ Wide tables have a row per sample and pair with the columns of
+        each metric """
+        record = next(
+            record for record in self.run(self.metrics, layout="wide")
+            if record["sample_id"] == "PositiveSample"
+        )
+        assert record["columns"][:3] == [
+            "sample_id",
+            "MLL_EXON3_normalized_coverage",
+            "MLL_EXON27_normalized_coverage",
+        ]
+        assert "fold_change_read_count" in record["columns"]
+        assert len(record["rows"]) == 2
+
+    def test_metric_thresholds(self, tmp_path):
+        """ Thresholds given per metric in the intervals json are used for
+        that metric only """
+        with open(self.intervals) as json_file:
+            intervals = json.load(json_file)
+        intervals[0]["metric_thresholds"] = {"read_count": 1.2}
+        intervals_file = str(tmp_path / "intervals.json")
+        with open(intervals_file, "w") as json_file:
+            json.dump(intervals, json_file)
+        record = next(
+            record for record in self.run(self.metrics, intervals_file)
+            if record["sample_id"] == "PositiveSample"
+        )
+        calls = {
+            row[1]: row[6] for row in record["rows"] if row[2] == 2.284132
+            or row[2] == 27824
+        }
+        assert calls == {"normalized_coverage": "TRUE", "read_count": "FALSE"}
+
+        intervals[0]["metric_thresholds"] = {"read_count": "high"}
+        with open(intervals_file, "w") as json_file:
+            json.dump(intervals, json_file)
+        with pytest.raises(ValueError, match="read_count threshold"):
+            TDHunter._import_intervals(intervals_file, dup_threshold=1.1)
+
+    def test_plan_digest_unchanged(self):
+        """ Plans without metric thresholds hash as they did before """
+        plan = IntervalPlan.from_intervals(
+            TDHunter._import_intervals(
+                "./test/test_intervals.json", dup_threshold=1.122995
+            )
+        )
+        assert plan.digest == hashlib.sha1(json.dumps([[
+            ["chr11", 118342351, 118345055],
+            ["chr11", 118373087, 118377386],
+            "MLL_EXON3",
+            "MLL_EXON27",
+            1.122995,
+        ]]).encode()).hexdigest()
+
+
+class TestExonScan(BaseTest):
+    bed = "./test/KMT2A_exons_b37.bed"
+
+    def test_scan_batch(self, tmp_path):
+        """ The duplicated KMT2A exons of the positive sample are found by
+        scanning every exon segment """
+        TDHunter(
+            batch="./test/Batch",
+            exons=[self.bed],
+            out_dir=str(tmp_path),
+            cov_file_pattern=self.cov_file_pattern,
+            run="RUN1",
+        )
+        results = pd.read_csv(str(tmp_path / "RUN1_exon_scan.csv"))
+        assert results["sample_id"].tolist() == [
+            "NegativeSample", "PositiveSample"
+        ]
+        positive = results.iloc[1]
+        assert positive["gene"] == "KMT2A_exons_b37"
+        assert (positive["first_exon"], positive["last_exon"]) == (7, 9)
+        assert (positive["start"], positive["end"]) == (118342351, 118348941)
+        assert positive["fold_change"] == pytest.approx(2.04094541)
+        assert results["fold_change"].iloc[0] < positive["fold_change"]
+
+    def test_scan_segments(self):
+        """ Vectorised segment scores match scoring each segment in turn """
+        rng = np.random.default_rng(1)
+        matrix = rng.gamma(20.0, 0.05, (5, 12))
+        matrix[1, 4:7] = 3.0
+        matrix[3, 2] = np.nan
+        lengths = rng.integers(100, 400, 12)
+        first, last, _, _, fold_change = TDHunter._scan_segments(
+            matrix, lengths, min_exons=2, min_flank=1
+        )
+        for sample, values in enumerate(matrix):
+            valid = ~np.isnan(values)
+            best = (None, -np.inf)
+            for i in range(12):
+                for j in range(i + 1, 13):
+                    inside = np.zeros(12, dtype=bool)
+                    inside[i:j] = True
+                    if (
+                        (inside & valid).sum() < 2
+                        or (valid[:i]).sum() < 1
+                        or (valid[j:]).sum() < 1
+                    ):
+                        continue
+                    means = [
+                        np.average(values[mask & valid],
+                                   weights=lengths[mask & valid])
+                        for mask in [inside, ~inside]
+                    ]
+                    if means[0] / means[1] > best[1]:
+                        best = ((i, j - 1), means[0] / means[1])
+            assert (first[sample], last[sample]) == best[0]
+            assert fold_change[sample] == pytest.approx(best[1])
+        assert (first[1], last[1]) == (4, 6)
+
+    def test_exon_catalog(self, tmp_path):
+        """ BED starts are made 1-based and problems reported together """
+        catalog = TDHunter._import_exon_catalog([self.bed])
+        assert catalog[0][0] == "KMT2A_exons_b37"
+        assert catalog[0][1][0] == ("chr11", 118307142, 118307684)
+        bed = tmp_path / "GENE.bed"
+        bed.write_text("chr1\t10\t20\nchr1\tx\t40\nchr2\t50\t60\n")
+        with pytest.raises(ValueError) as error:
+            TDHunter._import_exon_catalog([str(bed)])
+        assert str(error.value).splitlines() == [
+            "GENE line 2 is not chrom, start, end",
+            "GENE exons are on several chroms",
+            "GENE has 2 exon(s), at least 6 are needed",
+        ]
+
+    def test_plan(self):
+        """ Exon plans keep each gene's exons in genomic order """
+        catalog = TDHunter._import_exon_catalog([self.bed])
+        plan = IntervalPlan.from_exon_catalog(catalog)
+        assert [plan.regions[i] for i in plan.genes[0][1]] == catalog[0][1]
+        assert plan.digest != IntervalPlan.from_exon_catalog(
+            [("OTHER", catalog[0][1])]
+        ).digest
+
+
+class TestBaseline(BaseTest):
+    def build(self, tmp_path):
+        """ Build a baseline of the test batch. """
+        fname = str(tmp_path / "baseline.npz")
+        TDHunter(
+            batch="./test/Batch",
+            intervals=self.intervals,
+            cov_file_pattern=self.cov_file_pattern,
+            baseline_out=fname,
+        )
+        return fname
+
+    def test_build_and_score(self, tmp_path):
+        """ Samples scored against a baseline get z-scores and p-values """
+        baseline = self.build(tmp_path)
+        with np.load(baseline) as archive:
+            assert int(archive["n_samples"]) == 2
+            assert archive["pair_normals"].shape == (2, 1)
+        td = TDHunter(
+            file="./test/PositiveSample.qc.coverage.txt",
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            cov_file_pattern=self.cov_file_pattern,
+            baseline=baseline,
+        )
+        results = pd.read_csv(td.fname)
+        assert results.columns.tolist()[-4:] == [
+            "MLL_EXON3_z_score", "MLL_EXON27_z_score", "z_score", "p_value"
+        ]
+        # the positive sample is one of the two normals
+        assert results["p_value"][0] == pytest.approx(2.0 / 3)
+        assert results["z_score"][0] > 0
+
+    def test_baseline_scores(self):
+        """ Z-scores use the scaled MAD, p-values the sorted normals """
+        baseline = {
+            "region_median": np.array([1.0, 2.0]),
+            "region_mad": np.array([0.5, 0.0]),
+            "pair_median": np.array([1.1]),
+            "pair_mad": np.array([0.1]),
+            "pair_normals": np.array([[1.0], [1.1], [1.2], [np.nan]]),
+        }
+        matrix = np.array([[1.5, 2.0], [2.0, 1.0], [0.0, 0.0]])
+        fold_change = np.array([[1.15], [2.0], [np.nan]])
+        region_z, z_score, p_value = TDHunter._baseline_scores(
+            matrix, fold_change, baseline
+        )
+        assert region_z[0, 0] == pytest.approx(0.5 / (1.4826 * 0.5))
+        assert np.isnan(region_z[0, 1])
+        assert z_score[1, 0] == pytest.approx(0.9 / (1.4826 * 0.1))
+        assert p_value[:2, 0].tolist() == [0.5, 0.25]
+        assert np.isnan(p_value[2, 0])
+
+    def test_baseline_mismatch(self, tmp_path):
+        """ Baselines of another metric or intervals are rejected """
+        baseline = self.build(tmp_path)
+        plan = IntervalPlan.from_intervals(
+            TDHunter._import_intervals(self.intervals, 1.122995)
+        )
+        with pytest.raises(ValueError, match="not mean_coverage"):
+            TDHunter._load_baseline(baseline, plan, "mean_coverage")
+        plan = IntervalPlan.from_intervals(
+            TDHunter._import_intervals(
+                "./test/test_intervals_multi_pair.json", 1.122995
+            )
+        )
+        with pytest.raises(ValueError, match="not in the baseline"):
+            TDHunter._load_baseline(baseline, plan, "normalized_coverage")
+
+
+class TestServe(BaseTest):
+    positive = "./test/PositiveSample.qc.coverage.txt"
+    row = ["PositiveSample", 2.284132, 1.250261, 1.826924138, 0.869416728,
+           "TRUE"]
+
+    def hunter(self, intervals=None):
+        return TDHunter(
+            file=self.positive,
+            intervals=intervals or self.intervals,
+            out_dir=self.out_dir,
+            cov_file_pattern=self.cov_file_pattern,
+        )
+
+    def test_score_request(self):
+        """ Files are scored by path or by content """
+        td = self.hunter()
+        status, result = td._score_request(file=self.positive)
+        assert status == 200
+        assert result["rows"] == [self.row]
+        with open(self.positive, "rb") as cov_file:
+            data = gzip.compress(cov_file.read())
+        status, result = td._score_request(data=data, sample_id="S1")
+        assert result["rows"][0][0] == "S1"
+        assert result["rows"][0][1:] == self.row[1:]
+        status, result = td._score_request(file="./test/missing.txt")
+        assert status == 422
+        # requests don't change the instance shared by the server threads
+        assert td.file == os.path.abspath(self.positive)
+
+    def test_reload(self, tmp_path):
+        """ Changed intervals are reloaded, unusable ones are ignored """
+        intervals = str(tmp_path / "intervals.json")
+        shutil.copy(self.intervals, intervals)
+        td = self.hunter(intervals)
+        assert not td._reload_if_changed()
+        shutil.copy("./test/test_intervals_multi_pair.json", intervals)
+        os.utime(intervals, ns=(0, 0))
+        assert td._reload_if_changed()
+        n_pairs = len(td.plan.pairs)
+        assert n_pairs > 1
+        shutil.copy("./test/test_intervals_malformed.json", intervals)
+        assert not td._reload_if_changed()
+        assert len(td.plan.pairs) == n_pairs
+
+    def test_unix_socket(self, tmp_path):
+        """ Requests are answered over a Unix socket """
+        address = str(tmp_path / "tdh.sock")
+        server = TDHunterUnixServer(address, self.hunter())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        connection = None
+
+        class UnixConnection(http.client.HTTPConnection):
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(address)
+
+        try:
+            connection = UnixConnection("localhost")
+            connection.request("GET", "/health")
+            assert json.loads(
+                connection.getresponse().read()
+            )["pairs"] == 1
+            connection.request(
+                "POST",
+                "/score?file={0}".format(os.path.abspath(self.positive)),
+            )
+            response = connection.getresponse()
+            assert response.status == 200
+            assert json.loads(response.read())["rows"] == [self.row]
+        finally:
+            if connection is not None:
+                connection.close()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            if os.path.exists(address):
+                os.remove(address)
+
+
+class TestStdStreams(BaseTest):
+    positive = "./test/PositiveSample.qc.coverage.txt"
+
+    @pytest.mark.parametrize("compress", [False, True])
+    def test_stdin_to_ndjson(self, compress):
+        """ A coverage file piped to stdin is scored and written to stdout """
+        with open(self.positive, "rb") as cov_file:
+            data = cov_file.read()
+        if compress:
+            data = gzip.compress(data)
+        output = subprocess.run(
+            [
+                sys.executable, "TandemHunter.py", "-F", "-", "--sample-id",
+                "POS", "--intervals", self.intervals, "--stdout", "ndjson",
+            ],
+            input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            check=True,
+        ).stdout.decode()
+        assert [json.loads(line) for line in output.splitlines()] == [{
+            "sample_id": "POS",
+            "MLL_EXON3": 2.284132,
+            "MLL_EXON27": 1.250261,
+            "fold_change": 1.826924138,
+            "log2_fold_change": 0.869416728,
+            "above_cut_off": "TRUE",
+        }]
+
+    def test_batch_to_csv(self, capsys):
+        """ Results go to stdout instead of per-sample files, logs to
+        stderr """
+        TDHunter(
+            batch="./test/Batch",
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            cov_file_pattern=self.cov_file_pattern,
+            stdout_format="csv",
+        )
+        output = capsys.readouterr().out.splitlines()
+        assert output[0].startswith("sample_id,MLL_EXON3")
+        assert [line.split(",")[0] for line in output[1:]] == [
+            "NegativeSample", "PositiveSample"
+        ]
+        assert not glob.glob(os.path.join(self.out_dir, "*.csv"))
+
+
+class TestResultDb(BaseTest):
+    def run(self, db, run):
+        TDHunter(
+            batch="./test/Batch",
+            intervals="./test/test_intervals_multi_pair.json",
+            out_dir=self.out_dir,
+            cov_file_pattern=self.cov_file_pattern,
+            run=run,
+            db=db,
+        )
+
+    def test_store_and_query(self, tmp_path):
+        """ Results of every run are stored once and can be filtered """
+        db = str(tmp_path / "results.db")
+        for run in ["RUN1", "RUN2", "RUN2"]:
+            self.run(db, run)
+        results = TDHunter.query_db(db)
+        # rerunning RUN2 replaces its results
+        assert len(results) == 8
+        assert sorted(set(results["run"])) == ["RUN1", "RUN2"]
+        calls = TDHunter.query_db(
+            db, last_runs=1, pair=("MLL_EXON3", "MLL_EXON27"),
+            calls_only=True,
+        )
+        assert calls[["run", "sample_id", "above_cut_off"]].values.tolist() \
+            == [["RUN2", "PositiveSample", "TRUE"]]
+        assert calls["fold_change"][0] == pytest.approx(1.826924138)
+        assert calls["value1"][0] == pytest.approx(2.284132)
+        assert len(TDHunter.query_db(db, samples=["Neg*"], runs=["RUN1"])) \
+            == 2
+
+    def test_unnamed_runs(self, tmp_path):
+        """ Runs without a name are each stored under their own run id """
+        db = str(tmp_path / "results.db")
+        for _ in range(2):
+            self.run(db, None)
+        results = TDHunter.query_db(db)
+        assert len(results) == 8
+        runs = sorted(set(results["run"]))
+        assert len(runs) == 2
+        digest = IntervalPlan.from_intervals(
+            TDHunter._import_intervals(
+                intervals="./test/test_intervals_multi_pair.json",
+                dup_threshold=1.122995,
+            )
+        ).digest
+        assert all(run.endswith("Z_" + digest[:8]) for run in runs)
+
+    def test_query_export(self, tmp_path):
+        """ The query subcommand writes csv or xlsx """
+        db = str(tmp_path / "results.db")
+        self.run(db, "RUN1")
+        for fname in ["calls.csv", "calls.xlsx"]:
+            tdh_query([
+                "--db", db, "--calls-only", "-o", str(tmp_path / fname)
+            ])
+        csv_df = pd.read_csv(str(tmp_path / "calls.csv"))
+        xlsx_df = pd.read_excel(str(tmp_path / "calls.xlsx"))
+        assert set(csv_df["sample_id"]) == {"PositiveSample"}
+        assert csv_df.equals(xlsx_df)
+
+
+class TestProfile(BaseTest):
+    def test_profile_report(self, tmp_path):
+        """ Stages are reported per file and aggregated for the batch """
+        report_file = str(tmp_path / "profile.json")
+        TDHunter(
+            batch="./test/Batch",
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            cov_file_pattern=self.cov_file_pattern,
+            cohort_dir=str(tmp_path),
+            cohort_formats=["csv"],
+            profile=report_file,
+        )
+        with open(report_file) as json_file:
+            report = json.load(json_file)
+        assert list(report["stages"]) == [
+            "find_coverage_files",
+            "import_intervals",
+            "parse_coverage",
+            "compare_intervals",
+            "write_csv",
+            "write_cohort_csv",
+        ]
+        assert len(report["files"]) == 2
+        parse = report["stages"]["parse_coverage"]
+        assert parse["calls"] == 2
+        assert parse["rows"] == sum(
+            f["stages"]["parse_coverage"]["rows"] for f in report["files"]
+        )
+        assert parse["bytes"] > 0
+        assert parse["max_wall_s"] <= parse["wall_s"]
+
+
+class TestSyntheticCoverage(BaseTest):
+    intervals = "./inputs/intervals_b38.json"
+
+    def test_generated_batch(self, tmp_path):
+        """ Generated files include the intervals and positive samples
+        are called as duplicated
+        """
+        files = generate_batch(
+            "kmt2a", 4, str(tmp_path), self.intervals,
+            positive_fraction=0.5, suffix=self.cov_file_pattern,
+        )
+        assert len(files) == 4
+        td = TDHunter(
+            batch=str(tmp_path),
+            intervals=self.intervals,
+            out_dir=self.out_dir,
+            cov_file_pattern=self.cov_file_pattern,
+        )
+        calls = {
+            record["sample_id"]: record["rows"][0][-1]
+            for record in td.results
+        }
+        assert calls == {
+            "kmt2a_sample_0001": "TRUE",
+            "kmt2a_sample_0002": "TRUE",
+            "kmt2a_sample_0003": "FALSE",
+            "kmt2a_sample_0004": "FALSE",
+        }
+
+
 class TestTDHArgsParser(BaseTest):
     def test_parser_file(self):
         """ File argument should be as expected """
@@ -250,3 +1900,46 @@ class TestTDHArgsParser(BaseTest):
             ["-B", batch, "--intervals", self.intervals]
         )
         assert parser.batch == batch
+
+    def test_parser_processes(self):
+        """ Processes and memory budget are integers """
+        parser = tdh_argument_parser(
+            ["-B", "./test/", "--intervals", self.intervals,
+             "--processes", "2", "--memory-budget", "512"]
+        )
+        assert (parser.processes, parser.memory_budget) == (2, 512)
+
+    @pytest.mark.parametrize(
+        "shard,expected", [("2/8", (2, 8)), ("0/8", None), ("9/8", None),
+                           ("2", None)],
+    )
+    def test_parser_shard(self, shard, expected):
+        """ Shards are given as I/N, from 1/N to N/N """
+        args = ["-B", "./test/", "--intervals", self.intervals,
+                "--shard", shard]
+        if expected is None:
+            with pytest.raises(SystemExit):
+                tdh_argument_parser(args)
+        else:
+            assert tdh_argument_parser(args).shard == expected
+
+    def test_parser_schedule(self):
+        """ Batch files are processed as they are found unless sizing them
+        first is asked for """
+        args = ["-B", "./test/", "--intervals", self.intervals]
+        assert tdh_argument_parser(args).schedule == "discovery"
+        assert tdh_argument_parser(
+            args + ["--schedule", "size"]
+        ).schedule == "size"
+
+    def test_parser_engine(self):
+        """ Engine defaults to auto and only accepts known engines """
+        parser = tdh_argument_parser(
+            ["-B", "./test/", "--intervals", self.intervals]
+        )
+        assert parser.engine == "auto"
+        with pytest.raises(SystemExit):
+            tdh_argument_parser(
+                ["-B", "./test/", "--intervals", self.intervals,
+                 "--engine", "polars"]
+            )
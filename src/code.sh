@@ -1,7 +1,7 @@
 #!/bin/bash
 
 # Runs TandemHunter to produce individual comparison_csv files with PTD predictions
-# Also generates single .xlsx spreadsheet with PTD predictions for query
+# and a single .xlsx spreadsheet with PTD predictions for query
 # per_target_coverage files
 
 
@@ -21,11 +21,8 @@ echo "download_inputs"
 dx-download-all-inputs --parallel
 echo "download_complete"
 ls /home/dnanexus/in/intervals/
-# run script for PTD prediction outputs
-python3 TandemHunter.py -B /home/dnanexus/in/coverage_files/ --intervals /home/dnanexus/in/intervals/* -O /home/dnanexus/out/comparison_csv $advanced_options
-# Run second script
-# collate data into single dataframe
-python3 generate_comparison_csv_to_xls.py --comparison_csv /home/dnanexus/out/comparison_csv/*.pertarget_.cvg_comparison.csv $run
-mv *comparison_csv.xlsx /home/dnanexus/out/comparison_xlsx
+# run script for PTD prediction outputs, collating the results of all
+# samples into a single .xlsx in the same step
+python3 TandemHunter.py -B /home/dnanexus/in/coverage_files/ --intervals /home/dnanexus/in/intervals/* -O /home/dnanexus/out/comparison_csv --cohort-dir /home/dnanexus/out/comparison_xlsx --cohort-formats xlsx $run $advanced_options
 # Upload outputs (from /home/dnanexus/out) to DNAnexus
 dx-upload-all-outputs --parallel